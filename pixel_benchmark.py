@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+"""
+    Benchmarks for pixel_chromosome_view
+
+    Generates synthetic families of raw DNA kits -- siblings inherit from
+    two simulated parents, with recombination points along every
+    chromosome -- in each vendor's download format, then times each stage
+    of the pipeline across sibling counts and SNP densities.
+
+    python3 -m pixel_benchmark --siblings 2 3 4 --densities 5000 20000
+
+    license: GPLv3
+"""
+
+import io
+import os
+import sys
+import gzip
+import time
+import shutil
+import zipfile
+import argparse
+import tempfile
+
+from collections import namedtuple
+
+import numpy as np
+
+import pixel_chromosome_view as pixel_view
+
+
+"""
+Synthetic families.
+
+Every chromosome gets SNPs_per_chromosome biallelic SNPs at random
+positions.  Both parents carry two haplotypes drawn from a per-SNP allele
+frequency; each child takes one haplotype of each parent, switching between
+the parent's two haplotypes at about one crossover per 100 Mb.
+
+The mother is written as a kit too, to serve as the extra match.  Every
+kit misses a few percent of the SNPs, as kits from different chips do,
+and has a few no-calls.
+"""
+SIBLING_NAMES = ['ALICE', 'BRUNO', 'CLARA', 'DAVID', 'EMMA', 'FELIX',
+                 'GRACE', 'HENRY', 'IRENE', 'JONAS']
+EXTRA_MATCH_NAME = 'MOTHER'
+
+BASE_PAIRS = np.frombuffer(b'AGCTACGT', dtype=np.uint8).reshape(-1, 2)
+BP_PER_CROSSOVER = 100000000
+KIT_SNP_COVERAGE = 0.95
+KIT_NO_CALL_RATE = 0.005
+
+
+def get_inherited_haplotype(
+        rng,
+        positions,
+        chromosome_length):
+    "Which of a parent's two haplotypes is passed on, SNP by SNP"
+    crossovers = np.sort(rng.integers(
+            0, chromosome_length,
+            rng.poisson(chromosome_length / BP_PER_CROSSOVER)))
+    return (rng.integers(2)
+            + np.searchsorted(crossovers, positions)) % 2
+
+
+def generate_chromosome(
+        rng,
+        chromosome,
+        SNPs_per_chromosome,
+        sibling_count):
+    """
+    Genotypes of one chromosome for the mother and every sibling, and
+    which parental haplotypes every sibling inherited:
+
+        positions,
+        { name : np.uint8 array (len(positions), 2) },
+        { sibling : np.intp array (2, len(positions)) }  <- mother's, father's
+    """
+    chromosome_length = pixel_view.CHROMOSOME_LENGTHS[chromosome]
+    positions = np.unique(rng.integers(
+            1, chromosome_length, SNPs_per_chromosome)).astype(np.int32)
+    SNP_count = len(positions)
+
+    bases = BASE_PAIRS[rng.integers(len(BASE_PAIRS), size=SNP_count)]
+    allele_frequency = rng.uniform(0.05, 0.5, SNP_count)
+    # each parent's two haplotypes, 0 for the first base, 1 for the second
+    mother = (rng.random((2, SNP_count)) < allele_frequency).astype(np.intp)
+    father = (rng.random((2, SNP_count)) < allele_frequency).astype(np.intp)
+
+    SNP_rows = np.arange(SNP_count)
+    genotypes = {EXTRA_MATCH_NAME: np.stack(
+        (bases[SNP_rows, mother[0]], bases[SNP_rows, mother[1]]), axis=1)}
+    inherited = {}
+
+    for name in SIBLING_NAMES[:sibling_count]:
+        inherited[name] = np.stack((
+            get_inherited_haplotype(rng, positions, chromosome_length),
+            get_inherited_haplotype(rng, positions, chromosome_length)))
+        from_mother = mother[inherited[name][0], SNP_rows]
+        from_father = father[inherited[name][1], SNP_rows]
+        genotypes[name] = np.sort(np.stack(
+            (bases[SNP_rows, from_mother], bases[SNP_rows, from_father]),
+            axis=1), axis=1)
+
+    return positions, genotypes, inherited
+
+
+def get_true_pair_regions(
+        inherited,
+        name_A,
+        name_B):
+    """
+    The region of two siblings at every SNP, from the haplotypes they
+    inherited: FIR_SEGMENT where they share both, HIR_SEGMENT where they
+    share one and NIR_SEGMENT where they share none.  The region codes
+    count the shared haplotypes.
+    """
+    return (inherited[name_A] == inherited[name_B]).sum(
+            axis=0).astype(np.uint8)
+
+
+def iter_kit_rows(
+        rng,
+        chromosome_data,
+        name):
+    "(chromosome, position, genotype) rows of one kit, '--' for no-calls"
+    for chromosome, (positions, genotypes, _) in chromosome_data.items():
+        on_chip = rng.random(len(positions)) < KIT_SNP_COVERAGE
+        no_call = rng.random(len(positions)) < KIT_NO_CALL_RATE
+        kit_genotypes = genotypes[name].copy()
+        kit_genotypes[no_call] = ord('-')
+
+        for position, genotype in zip(
+                positions[on_chip].tolist(),
+                kit_genotypes[on_chip].view('S2').ravel().astype('U2')
+                .tolist()):
+            yield chromosome, position, genotype
+
+
+def write_23andMe_kit(raw_file, kit_rows):
+    raw_file.write("# This data file generated by 23andMe\n"
+                   "# rsid\tchromosome\tposition\tgenotype\n")
+    for row, (chromosome, position, genotype) in enumerate(kit_rows):
+        raw_file.write("rs{0}\t{1}\t{2}\t{3}\n".format(
+            row, chromosome, position, genotype))
+
+
+def write_AncestryDNA_kit(raw_file, kit_rows):
+    raw_file.write("#AncestryDNA raw data download\n"
+                   "rsid\tchromosome\tposition\tallele1\tallele2\n")
+    for row, (chromosome, position, genotype) in enumerate(kit_rows):
+        raw_file.write("rs{0}\t{1}\t{2}\t{3}\t{4}\n".format(
+            row, chromosome, position,
+            *(genotype if genotype != '--' else '00')))
+
+
+def write_quoted_csv_kit(raw_file, kit_rows):
+    raw_file.write("RSID,CHROMOSOME,POSITION,RESULT\n")
+    for row, (chromosome, position, genotype) in enumerate(kit_rows):
+        raw_file.write('"rs{0}","{1}","{2}","{3}"\n'.format(
+            row, chromosome, position, genotype))
+
+
+def write_MyHeritage_kit(raw_file, kit_rows):
+    raw_file.write("# MyHeritage DNA raw data.\n")
+    write_quoted_csv_kit(raw_file, kit_rows)
+
+
+def write_LivingDNA_kit(raw_file, kit_rows):
+    raw_file.write("# Living DNA customer genotype data download file\n"
+                   "# rsid\tchromosome\tposition\tgenotype\n")
+    for row, (chromosome, position, genotype) in enumerate(kit_rows):
+        raw_file.write("rs{0}\t{1}\t{2}\t{3}\n".format(
+            row, chromosome, position, genotype))
+
+
+"""
+Vendor formats the kits are written in, in turn: (file name pattern,
+writer, packaging).  Packaging is how the vendor hands the file out --
+plain text, gzip or a zip archive.
+"""
+KIT_FORMATS = [
+    ('23andMe_{0}_raw.txt', write_23andMe_kit, None),
+    ('AncestryDNA_{0}_raw.txt', write_AncestryDNA_kit, None),
+    ('MyHeritage_{0}_raw.csv', write_MyHeritage_kit, None),
+    ('FTDNA_{0}_raw.csv.gz', write_quoted_csv_kit, 'gzip'),
+    ('LivingDNA_{0}_raw.zip', write_LivingDNA_kit, 'zip'),
+]
+
+
+def write_kit(
+        family_dir,
+        name,
+        kit_format,
+        kit_rows):
+    file_name_pattern, write_raw_file, packaging = kit_format
+    raw_file_name = os.path.join(family_dir, file_name_pattern.format(name))
+
+    if packaging == 'gzip':
+        with gzip.open(raw_file_name, 'wt', compresslevel=1) as raw_file:
+            write_raw_file(raw_file, kit_rows)
+    elif packaging == 'zip':
+        with zipfile.ZipFile(raw_file_name, 'w', zipfile.ZIP_DEFLATED) \
+                as archive, \
+                io.TextIOWrapper(archive.open(
+                    "{0}_raw.txt".format(name), 'w')) as raw_file:
+            write_raw_file(raw_file, kit_rows)
+    else:
+        with open(raw_file_name, 'w') as raw_file:
+            write_raw_file(raw_file, kit_rows)
+
+    return raw_file_name
+
+
+def generate_family(
+        family_dir,
+        sibling_count,
+        SNPs_per_chromosome,
+        chromosomes=pixel_view.AUTOSOMES,
+        seed=0):
+    """
+    Write a mother and sibling_count siblings into family_dir, cycling
+    through KIT_FORMATS.  Returns { name : raw file name }.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(family_dir, exist_ok=True)
+
+    chromosome_data = {
+        chromosome: generate_chromosome(
+            rng, chromosome, SNPs_per_chromosome, sibling_count)
+        for chromosome in chromosomes}
+
+    raw_file_names = {}
+    for kit_number, name in enumerate(
+            SIBLING_NAMES[:sibling_count] + [EXTRA_MATCH_NAME]):
+        raw_file_names[name] = write_kit(
+                family_dir,
+                name,
+                KIT_FORMATS[kit_number % len(KIT_FORMATS)],
+                iter_kit_rows(rng, chromosome_data, name))
+
+    return raw_file_names
+
+
+"""
+One timed stage.  SNPs is the number of SNPs (times pairs, where pairs
+are compared) the stage worked through; peak_RSS_MB is the peak resident
+memory of the process so far, or None where it cannot be read.
+"""
+BenchmarkResult = namedtuple(
+        'BenchmarkResult',
+        ['siblings', 'SNPs_per_chromosome', 'stage', 'seconds', 'SNPs',
+         'peak_RSS_MB'])
+
+STAGES = ['parse', 'load', 'load (cached)', 'get_common_keys',
+          'get_common_key_SNP_dict', 'classify', 'render', 'encode']
+
+
+class StageTimer(object):
+    "Adds up the time and SNPs of each stage over repeated calls"
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.SNPs = dict.fromkeys(STAGES, 0)
+        self.peak_RSS_MB = dict.fromkeys(STAGES)
+
+    def run(self, stage, function, *args):
+        started = time.perf_counter()
+        result = function(*args)
+        self.seconds[stage] += time.perf_counter() - started
+        self.peak_RSS_MB[stage] = pixel_view.get_peak_RSS_MB()
+        return result
+
+
+def benchmark_family(
+        family_dir,
+        sibling_count,
+        chromosomes,
+        cache_dir):
+    """
+    Run the whole pipeline on one generated family, with the extra match,
+    and time every stage.  The raw file cache lives in cache_dir, and the
+    strip cache is switched off so every strip is really drawn.
+    """
+    pixel_view.RAW_FILE_CACHE_DIRECTORY = cache_dir
+    pixel_view.STRIP_CACHE_MEMORY_BYTES = 0
+    pixel_view.STRIP_CACHE_MAX_BYTES = 0
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+    match_pair_combinations, all_matches_list = \
+        pixel_view.get_match_pair_combinations(
+            SIBLING_NAMES[:sibling_count], EXTRA_MATCH_NAME)
+    kit_index = pixel_view.get_kit_index(family_dir)
+    config = pixel_view.get_render_config()
+
+    stage_timer = StageTimer()
+
+    for known_relative in all_matches_list:
+        genotypes_by_chromosome = stage_timer.run(
+                'parse',
+                pixel_view.load_raw_file_by_chromosome,
+                pixel_view.find_kit(known_relative, kit_index)['path'])
+        stage_timer.SNPs['parse'] += sum(
+            len(genotypes.positions)
+            for genotypes in genotypes_by_chromosome.values())
+
+    stage_timer.run('load', pixel_view.load_raw_data_for_all_matches,
+                    all_matches_list, family_dir)
+    raw_data_by_match = stage_timer.run(
+            'load (cached)', pixel_view.load_raw_data_for_all_matches,
+            all_matches_list, family_dir)
+    stage_timer.SNPs['load'] = stage_timer.SNPs['load (cached)'] = \
+        stage_timer.SNPs['parse']
+
+    for chromosome in chromosomes:
+        match_genotypes = \
+            pixel_view.get_match_pixel_dicts_for_siblings_to_render(
+                chromosome, all_matches_list, raw_data_by_match)
+
+        common_SNPs = stage_timer.run(
+                'get_common_keys', pixel_view.get_common_keys,
+                match_genotypes)
+        common_genotypes = stage_timer.run(
+                'get_common_key_SNP_dict', pixel_view.get_common_key_SNP_dict,
+                common_SNPs, match_genotypes)
+        match_table = stage_timer.run(
+                'classify',
+                pixel_view.insert_combo_match_type_into_common_key_SNP_dict,
+                common_genotypes, match_pair_combinations, config)
+        chrom_whole_page_image = stage_timer.run(
+                'render', pixel_view.show_match_graphics,
+                match_table, match_pair_combinations, chromosome, config)
+        stage_timer.run(
+                'encode', pixel_view.save_match_graphics,
+                chrom_whole_page_image, io.BytesIO())
+
+        stage_timer.SNPs['get_common_keys'] += sum(
+            len(genotypes.positions) for genotypes in match_genotypes.values())
+        stage_timer.SNPs['get_common_key_SNP_dict'] += \
+            len(common_SNPs.positions) * len(all_matches_list)
+        stage_timer.SNPs['classify'] += \
+            len(common_SNPs.positions) * len(match_pair_combinations)
+        stage_timer.SNPs['render'] += \
+            len(match_table.positions) * len(match_pair_combinations)
+        stage_timer.SNPs['encode'] = stage_timer.SNPs['render']
+
+    return stage_timer
+
+
+def run_benchmarks(
+        sibling_counts,
+        densities,
+        chromosomes,
+        work_dir,
+        seed=0):
+    """
+    Benchmark every (sibling count, SNP density) combination.  One family
+    with the most siblings is generated per density; smaller sibling
+    counts use the first siblings of it.  Yields BenchmarkResult rows.
+    """
+    for SNPs_per_chromosome in densities:
+        family_dir = os.path.join(
+                work_dir, "family_{0}".format(SNPs_per_chromosome))
+        generate_family(family_dir, max(sibling_counts), SNPs_per_chromosome,
+                        chromosomes, seed)
+
+        for sibling_count in sibling_counts:
+            stage_timer = benchmark_family(
+                    family_dir, sibling_count, chromosomes,
+                    os.path.join(work_dir, 'cache'))
+
+            for stage in STAGES:
+                yield BenchmarkResult(
+                        sibling_count,
+                        SNPs_per_chromosome,
+                        stage,
+                        stage_timer.seconds[stage],
+                        stage_timer.SNPs[stage],
+                        stage_timer.peak_RSS_MB[stage])
+
+
+def format_benchmark_result(
+        benchmark_result):
+    SNPs_per_second = (benchmark_result.SNPs / benchmark_result.seconds
+                       if benchmark_result.seconds else 0)
+    return "{0:>8} {1:>10} {2:<24} {3:>9.3f} {4:>14,.0f} {5:>9}".format(
+            benchmark_result.siblings,
+            benchmark_result.SNPs_per_chromosome,
+            benchmark_result.stage,
+            benchmark_result.seconds,
+            SNPs_per_second,
+            "{0:.0f}".format(benchmark_result.peak_RSS_MB)
+            if benchmark_result.peak_RSS_MB is not None else '-')
+
+
+def get_argument_parser():
+    parser = argparse.ArgumentParser(
+            description="Time each pipeline stage on synthetic families.")
+    parser.add_argument(
+            '--siblings', type=int, nargs='+', default=[2, 3, 4],
+            help="sibling counts to benchmark (default: 2 3 4)")
+    parser.add_argument(
+            '--densities', type=int, nargs='+', default=[5000, 20000],
+            help="SNPs per chromosome to benchmark (default: 5000 20000)")
+    parser.add_argument(
+            '--chromosomes', nargs='+', default=['1', '2'],
+            help="chromosomes to generate and render, 1-22 or 'all' "
+                 "(default: 1 2)")
+    parser.add_argument(
+            '--work-dir', default=None,
+            help="where to write the generated kits; kept when given, "
+                 "otherwise a temporary directory is used and removed")
+    parser.add_argument(
+            '--seed', type=int, default=0,
+            help="random seed of the kit generator (default: 0)")
+    return parser
+
+
+def main(argv=None):
+    parser = get_argument_parser()
+    args = parser.parse_args(argv)
+
+    try:
+        chromosomes = pixel_view.parse_chromosome_list(args.chromosomes)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    if not all(1 <= sibling_count <= len(SIBLING_NAMES)
+               for sibling_count in args.siblings):
+        parser.error("--siblings must be 1-{0}".format(len(SIBLING_NAMES)))
+
+    pixel_view.VERBOSITY = 0
+    work_dir = os.path.abspath(
+            args.work_dir or tempfile.mkdtemp(prefix='pixel_benchmark_'))
+
+    print("{0:>8} {1:>10} {2:<24} {3:>9} {4:>14} {5:>9}".format(
+        'siblings', 'SNPs/chrom', 'stage', 'seconds', 'SNPs/second',
+        'peak MB'))
+    try:
+        for benchmark_result in run_benchmarks(
+                args.siblings, args.densities, chromosomes, work_dir,
+                args.seed):
+            print(format_benchmark_result(benchmark_result))
+            sys.stdout.flush()
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
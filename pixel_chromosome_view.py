@@ -39,20 +39,66 @@ __date__ = "2021/01/01"
 __license__ = "GPLv3"
 __version__ = "1.0.1"
 
-import csv
+import io
 import os
+import re
 import sys
+import gzip
+import json
+import time
+import zipfile
+import shutil
+import hashlib
+import argparse
+import threading
 import inspect
 import pprint
 
+from array import array
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                wait, FIRST_COMPLETED)
+from multiprocessing import shared_memory
+from functools import lru_cache, wraps
 from itertools import islice
-from collections import OrderedDict
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from xml.etree import ElementTree
 from itertools import combinations
-
-from PIL import Image, ImageDraw, ImageFont
-
-from pixel_config import *
-
+from typing import NamedTuple, Optional
+
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows; peak RSS is then not sampled
+    resource = None
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows; the raw file cache then relies on
+    # RAW_FILE_CACHE_GRACE_SECONDS alone between processes
+    fcntl = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    # optional; only the 'parquet' and 'arrow' exports need it
+    pyarrow = None
+
+import pixel_config
+from pixel_config import (
+    DATA_FILE_DIRECTORY, siblings_to_render, extra_match,
+    RAW_FILE_CACHE_DIRECTORY, RAW_FILE_CACHE_MAX_BYTES, RAW_FILE_LOAD_THREADS,
+    STRIP_CACHE_MEMORY_BYTES, STRIP_CACHE_MAX_BYTES, INSTRUMENT,
+    EXPORT_ROW_GROUP_SIZE)
+
+# debugging output of pp_2/lp_2 (2) and pp_3/lp_3 (3), printed to stderr;
+# headless runs set it to 0 unless --verbose is given
 VERBOSITY = 2
 
 this_dir = os.path.dirname(os.path.abspath(inspect.stack()[0][1]))
@@ -61,48 +107,304 @@ font_library_path = os.path.join(this_dir, "fonts")
 helpful_debugging_utility_usages = """
 
        #  pretty print functions
-       pp_2(str(inspect.stack()[0][2]), "Print something on onee line", here)
+       pp_2("Print something on onee line", here)
 
        # line print functions
-       lp_2(str(inspect.stack()[0][2]), "print data structure, str(here))
+       lp_2("print data structure", str(here))
 
+   The caller's line number is only looked up when the line is printed.
    """
 pp = pprint.PrettyPrinter(indent=4)
 
-def lp_2(line_no, name, value):
+def get_caller_line_no():
+    return sys._getframe(2).f_lineno
+
+def lp_2(name, value):
     if VERBOSITY > 1:
-        print("{0}_{1} = {2}\n".format(line_no, name, value))
+        print("{0}_{1} = {2}\n".format(get_caller_line_no(), name, value),
+              file=sys.stderr)
 
-def lp_3(line_no, name, value):
+def lp_3(name, value):
     if VERBOSITY > 2:
-        print("{0}_{1} = {2}\n".format(line_no, name, value))
+        print("{0}_{1} = {2}\n".format(get_caller_line_no(), name, value),
+              file=sys.stderr)
 
 
-def pp_2(line_no, description, data_structure):
+def pp_2(description, data_structure):
     if VERBOSITY > 1:
-        print("\n{0} -- {1} ==>".format(line_no, description))
-        pp.pprint(data_structure)
-        print("")
+        print("\n{0} -- {1} ==>".format(get_caller_line_no(), description),
+              file=sys.stderr)
+        print(pp.pformat(data_structure), file=sys.stderr)
+        print("", file=sys.stderr)
 
-def pp_3(line_no, description, data_structure):
+def pp_3(description, data_structure):
     if VERBOSITY > 2:
-        print("\n{0} -- {1} ==>".format(line_no, description))
-        pp.pprint(data_structure)
-        print("")
+        print("\n{0} -- {1} ==>".format(get_caller_line_no(), description),
+              file=sys.stderr)
+        print(pp.pformat(data_structure), file=sys.stderr)
+        print("", file=sys.stderr)
 
 def take(n, iterable):
     "Return first n items of the iterable as a list"
     return list(islice(iterable, n))
 
 
+"""
+Instrumentation.
+
+Off until enable_instrumentation is called (--instrument on the command
+line), and then:
+
+    stage timers : with timed_stage('classify'): ...  adds up the wall time
+                   and calls of a stage and samples the peak RSS after it;
+                   stages may nest, e.g. 'parse' runs inside 'load'
+    counters     : count('rows parsed', n)
+
+In 'jsonl' mode every finished stage is written as a JSON line, followed
+by the totals; in 'summary' mode only the totals, as a table.  While
+instrumentation is off, timed_stage and count return after checking a
+single global.
+"""
+INSTRUMENT_MODES = ('summary', 'jsonl')
+
+instrumentation = None
+
+
+def get_peak_RSS_MB():
+    "Peak resident memory of this process so far, None where unknown"
+    if resource is None:
+        return None
+    peak_RSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes everywhere else
+    return peak_RSS / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+class Instrumentation(object):
+    """
+    Stage times and counters of one run.  Events are written to
+    output_file, or kept in self.events when it is None (as in worker
+    processes, which hand them to the parent with get_report).
+    """
+
+    def __init__(self, mode='summary', output_file=None):
+        self.mode = mode
+        self.output_file = output_file
+        self.events = []
+        self.stage_seconds = OrderedDict()
+        self.stage_calls = OrderedDict()
+        self.counters = OrderedDict()
+        self.peak_RSS_MB = None
+        self._lock = threading.Lock()
+
+    def emit(self, event):
+        if self.mode != 'jsonl':
+            return
+        if self.output_file is None:
+            self.events.append(event)
+        else:
+            self.output_file.write(json.dumps(event) + '\n')
+
+    def add_stage(self, stage, seconds):
+        peak_RSS_MB = get_peak_RSS_MB()
+        with self._lock:
+            self.stage_seconds[stage] = \
+                self.stage_seconds.get(stage, 0.0) + seconds
+            self.stage_calls[stage] = self.stage_calls.get(stage, 0) + 1
+            if peak_RSS_MB is not None:
+                self.peak_RSS_MB = max(self.peak_RSS_MB or 0, peak_RSS_MB)
+            self.emit({'event': 'stage', 'stage': stage,
+                       'seconds': round(seconds, 6),
+                       'thread': threading.current_thread().name,
+                       'peak_rss_mb': peak_RSS_MB, 'pid': os.getpid()})
+
+    def add_count(self, counter, amount):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def get_report(self):
+        "Everything recorded, as plain data that can cross a process pool"
+        with self._lock:
+            return {'events': list(self.events),
+                    'stage_seconds': dict(self.stage_seconds),
+                    'stage_calls': dict(self.stage_calls),
+                    'counters': dict(self.counters),
+                    'peak_rss_mb': self.peak_RSS_MB}
+
+    def merge(self, report):
+        "Add the report of another process (see get_report)"
+        for event in report['events']:
+            self.emit(event)
+        with self._lock:
+            for stage, seconds in report['stage_seconds'].items():
+                self.stage_seconds[stage] = \
+                    self.stage_seconds.get(stage, 0.0) + seconds
+                self.stage_calls[stage] = (self.stage_calls.get(stage, 0)
+                                           + report['stage_calls'][stage])
+            for counter, amount in report['counters'].items():
+                self.counters[counter] = \
+                    self.counters.get(counter, 0) + amount
+            if report['peak_rss_mb'] is not None:
+                self.peak_RSS_MB = max(self.peak_RSS_MB or 0,
+                                       report['peak_rss_mb'])
+
+    def write_summary(self):
+        output_file = self.output_file or sys.stderr
+        report = self.get_report()
+
+        if self.mode == 'jsonl':
+            del report['events']
+            output_file.write(json.dumps(dict(report, event='totals')) + '\n')
+            return
+
+        output_file.write("{0:<28} {1:>7} {2:>10}\n".format(
+            'stage', 'calls', 'seconds'))
+        for stage, seconds in report['stage_seconds'].items():
+            output_file.write("{0:<28} {1:>7} {2:>10.3f}\n".format(
+                stage, report['stage_calls'][stage], seconds))
+        output_file.write("\n{0:<28} {1:>18}\n".format('counter', 'total'))
+        for counter, amount in report['counters'].items():
+            output_file.write("{0:<28} {1:>18,}\n".format(counter, amount))
+        if report['peak_rss_mb'] is not None:
+            output_file.write("\n{0:<28} {1:>15.0f} MB\n".format(
+                'peak RSS', report['peak_rss_mb']))
+
+
+def enable_instrumentation(
+        mode='summary',
+        output_file=None):
+    global instrumentation
+    instrumentation = Instrumentation(mode, output_file)
+    return instrumentation
+
+
+def disable_instrumentation():
+    "Switch instrumentation off, returning what it recorded"
+    global instrumentation
+    finished_instrumentation, instrumentation = instrumentation, None
+    return finished_instrumentation
+
+
+@contextmanager
+def timed_stage(
+        stage):
+    if instrumentation is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        instrumentation.add_stage(stage, time.perf_counter() - started)
+
+
+def timed(
+        stage):
+    "timed_stage for a whole function, as a decorator"
+    def decorate(function):
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            if instrumentation is None:
+                return function(*args, **kwargs)
+            with timed_stage(stage):
+                return function(*args, **kwargs)
+        return timed_function
+    return decorate
+
+
+def count(
+        counter,
+        amount=1):
+    if instrumentation is not None:
+        instrumentation.add_count(counter, amount)
+
+
+@lru_cache(maxsize=None)
+def get_font(
+        face,
+        size):
+    """
+    Load a TrueType font from the fonts directory once per process.
+
+    Every (face, size) combination is parsed from disk only the first time
+    it is asked for; later calls, for any chromosome or batch run, share
+    the same ImageFont object.
+
+    Faces not found in the fonts directory are left for PIL to resolve
+    from the system font paths.
+    """
+    font_file = os.path.join(font_library_path, face)
+    if not os.path.isfile(font_file):
+        font_file = face
+    return ImageFont.truetype(font_file, size)
+
+
+"""
+Render settings.
+
+Everything that decides what a page looks like, under the same names as
+in pixel_config.  A RenderConfig is immutable and hashable, so it is
+handed explicitly down the pipeline, shared between threads and worker
+processes, and usable as a cache key:
+
+    config = get_render_config()                        <- pixel_config
+    config = get_render_config(TARGET_PAGE_WIDTH=2000)  <- with overrides
+    config = config._replace(AXIS_MODE='bp')
+
+Process-wide resources -- where the kits and caches live, cache sizes,
+threads and the server address -- stay plain pixel_config settings.
+"""
+class RenderConfig(NamedTuple):
+    FILTER_COMPLETELY_MATCHED_SEGMENTS: bool
+    SEGMENT_NOISE_TOLERANCE: int
+    SEGMENT_MIN_SNPS: int
+    SEGMENT_MIN_BP: int
+    TILE_SIZE: int
+    TILE_FORMAT: str
+    TARGET_PAGE_WIDTH: Optional[int]
+    COLUMN_AGGREGATE: str
+    AXIS_MODE: str
+    BP_PER_PIXEL: int
+    MILESTONE_BP_SPACING: int
+    TICKER_BP_SPACING: int
+    FULLY_IDENTICAL_SNP_COLOR: str
+    NO_MATCH_SNP_COLOR: str
+    HALF_IDENTICAL_SNP_COLOR: str
+    BACKGROUND_COLOR: str
+    CHROMOSOME_BASE_COLOR: str
+    HEIGHT_OF_CHROMOSOME_IMAGE: int
+    SPACE_BETWEEN_MATCHES: int
+    CHROM_PAGE_LEFT_BORDER: int
+    CHROM_PAGE_TEXT_BORDER: int
+    CHROM_TITLE_TEXT_FONT_SIZE: int
+    CHROM_MATCH_TEXT_FONT_SIZE: int
+    CHROM_PAGE_RIGHT_BORDER: int
+    CHROM_PAGE_TOP_BORDER: int
+    CHROM_PAGE_TITLE_SPACE: int
+    CHROM_PAGE_BOTTOM_BORDER: int
+    MINIMUM_PAGE_WIDTH: int
+    MILESTONE_SPACING: int
+    TICKER_SPACING: int
+    MILESTONE_VERTICAL_POSITION: int
+    TICKER_VERTICAL_POSITION: int
+    TICKMARK_FONT: str
+    TICKMARK_FONT_SIZE: int
+    MILESTONE_FONT_SIZE: int
+
+
+def get_render_config(
+        **overrides):
+    "A RenderConfig of the pixel_config settings, with any overrides"
+    settings = {name: getattr(pixel_config, name)
+                for name in RenderConfig._fields}
+    settings.update(overrides)
+    return RenderConfig(**settings)
 
-CHROMOSOME_TO_RENDER = None
 
 def get_match_pair_combinations(
         siblings_to_render,
         extra_match):
-
-    all_matches_list = siblings_to_render
+    "The pairs to compare and every match involved; the input is not changed"
+    all_matches_list = list(siblings_to_render)
 
     match_pair_combinations = [
         (siblings_to_render[m[0]], siblings_to_render[m[1]]) for m in
@@ -113,180 +415,1133 @@ def get_match_pair_combinations(
 
         all_matches_list.append(extra_match)
 
-    pp_2(str(inspect.stack()[0][2]), "match_pair_combinations",
-         match_pair_combinations)
+    pp_2("match_pair_combinations", match_pair_combinations)
 
     return match_pair_combinations, all_matches_list
 
 
-def get_match_pixel_dicts_for_siblings_to_render(
-        all_matches_list):
+AUTOSOMES = list(range(1, 23))
+
+
+RAW_FILE_EXTENSIONS = ('.txt', '.csv', '.tsv')
+RAW_FILE_ARCHIVE_EXTENSIONS = ('.gz', '.zip')
+
+
+def is_raw_file_name(
+        file_name):
+    """
+    True for .txt, .csv and .tsv files, on their own or compressed as
+    .gz or .zip (e.g. 'JULIE_raw.csv.gz' or 'JULIE_raw_dna.zip').
     """
-    For each match, read the raw file and construct a dictionary with this structure:
+    base_name, extension = os.path.splitext(file_name.lower())
+    if extension == '.zip':
+        return True
+    if extension == '.gz':
+        extension = os.path.splitext(base_name)[1]
+    return extension in RAW_FILE_EXTENSIONS
 
-        { match_name_1 : { SNP_location_1 : ( tuple of SNP values A and B ),
-                           SNP_location_2 : ( tuple of SNP values A and B ),
-                           SNP_location_3 : ( tuple of SNP values A and B ),
-                         },
-          match_name_1 : { SNP_location_1 : ( tuple of SNP values A and B ),
-                           SNP_location_2 : ( tuple of SNP values A and B ),
-                           SNP_location_4 : ( tuple of SNP values A and B ),
-                         },
-         match_name_3 : { SNP_location_2 : ( tuple of SNP values A and B ),
-                          SNP_location_3 : ( tuple of SNP values A and B ),
-                          SNP_location_4 : ( tuple of SNP values A and B ),
-                         },
+
+@contextmanager
+def open_raw_file(
+        this_kr_raw_file):
+    """
+    Open a raw DNA download for streaming text reads, decompressing .gz
+    files and the first raw file inside a .zip archive on the fly.
+    """
+    extension = os.path.splitext(this_kr_raw_file.lower())[1]
+
+    if extension == '.gz':
+        with gzip.open(this_kr_raw_file, 'rt', encoding='utf-8-sig') \
+                as raw_file:
+            yield raw_file
+
+    elif extension == '.zip':
+        with zipfile.ZipFile(this_kr_raw_file) as raw_archive:
+            member_names = [name for name in raw_archive.namelist()
+                            if is_raw_file_name(name)
+                            and not name.lower().endswith(
+                                RAW_FILE_ARCHIVE_EXTENSIONS)]
+            if not member_names:
+                raise ValueError("no raw DNA file inside {0}".format(
+                    this_kr_raw_file))
+            with raw_archive.open(member_names[0]) as raw_member:
+                yield io.TextIOWrapper(raw_member, encoding='utf-8-sig')
+
+    else:
+        with open(this_kr_raw_file, 'r', encoding='utf-8-sig') as raw_file:
+            yield raw_file
+
+
+def iter_raw_data_lines(
+        raw_file):
+    """
+    Lazily yield the data lines of an open raw file, dropping comment
+    and column header lines.  Nothing is read ahead of the consumer.
+    """
+    for line in raw_file:
+        if (line.startswith('#')
+                or line.startswith('SNP')
+                or not line.strip()):
+            continue
+        yield line
+
+
+def iter_raw_rows(
+        raw_lines,
+        delimiter='\t'):
+    "Split each raw data line into its fields, one row at a time"
+    for line in raw_lines:
+        yield line.rstrip('\r\n').split(delimiter)
+
+
+"""
+Vendor parsers.
+
+Every vendor has a sniff function, which gets the first lines of a raw
+file and says whether the file is in that vendor's format, and a parser,
+which turns the data lines into (chromosome, position, genotype) string
+tuples with a two-character genotype.  Vendors are tried in registration
+order, so the specific header checks come before the generic
+column-layout fallbacks at the end.
+"""
+RAW_FILE_PARSERS = OrderedDict()
+RAW_FILE_SNIFF_LINES = 50
+
+
+def register_raw_file_parser(
+        vendor,
+        sniff):
+    def register(parse_raw_lines):
+        RAW_FILE_PARSERS[vendor] = (sniff, parse_raw_lines)
+        return parse_raw_lines
+    return register
+
+
+def get_header_text(
+        header_lines):
+    return ''.join(header_lines)
+
+
+def parse_combined_genotype_tsv(
+        raw_lines):
+    "rsid <tab> chromosome <tab> position <tab> genotype"
+    for raw_row in iter_raw_rows(raw_lines):
+        if len(raw_row) >= 4:
+            yield raw_row[1], raw_row[2], raw_row[3]
+
+
+def parse_split_alleles_tsv(
+        raw_lines):
+    "rsid <tab> chromosome <tab> position <tab> allele1 <tab> allele2"
+    for raw_row in iter_raw_rows(raw_lines):
+        if len(raw_row) >= 5:
+            yield raw_row[1], raw_row[2], raw_row[3] + raw_row[4]
+
+
+def parse_quoted_csv(
+        raw_lines):
+    "\"rsid\",\"chromosome\",\"position\",\"genotype\" (quotes optional)"
+    for line in raw_lines:
+        raw_row = line.rstrip('\r\n').replace('"', '').split(',')
+        if len(raw_row) >= 4:
+            yield raw_row[1], raw_row[2], raw_row[3]
+
+
+register_raw_file_parser(
+    'AncestryDNA',
+    lambda header_lines: 'AncestryDNA' in get_header_text(header_lines))(
+        parse_split_alleles_tsv)
+
+register_raw_file_parser(
+    '23andMe',
+    lambda header_lines: '23andMe' in get_header_text(header_lines))(
+        parse_combined_genotype_tsv)
+
+register_raw_file_parser(
+    'MyHeritage',
+    lambda header_lines: 'MyHeritage' in get_header_text(header_lines))(
+        parse_quoted_csv)
+
+register_raw_file_parser(
+    'LivingDNA',
+    lambda header_lines: 'Living DNA' in get_header_text(header_lines)
+                         or 'LivingDNA' in get_header_text(header_lines))(
+        parse_combined_genotype_tsv)
+
+register_raw_file_parser(
+    'FTDNA',
+    lambda header_lines: any(
+        line.replace('"', '').upper().startswith('RSID,CHROMOSOME,POSITION')
+        for line in header_lines))(
+        parse_quoted_csv)
+
+register_raw_file_parser(
+    'allele1/allele2 TSV',
+    lambda header_lines: any(
+        len(line.split('\t')) == 5 for line in header_lines
+        if not line.startswith('#')))(
+        parse_split_alleles_tsv)
+
+register_raw_file_parser(
+    'genotype TSV',
+    lambda header_lines: any(
+        len(line.split('\t')) == 4 for line in header_lines
+        if not line.startswith('#')))(
+        parse_combined_genotype_tsv)
+
+
+def detect_raw_file_vendor(
+        this_kr_raw_file):
+    """
+    Sniff the first lines of a raw file and return the name of the
+    registered vendor format it is in.
+    """
+    with open_raw_file(this_kr_raw_file) as raw_file:
+        header_lines = list(islice(raw_file, RAW_FILE_SNIFF_LINES))
+
+    for vendor, (sniff, parse_raw_lines) in RAW_FILE_PARSERS.items():
+        if sniff(header_lines):
+            return vendor
+
+    raise ValueError("unrecognized raw DNA file format: {0}".format(
+        this_kr_raw_file))
+
+
+"""
+Columnar genotype store.
+
+    positions : sorted np.int32 array of SNP locations on one chromosome
+    alleles   : np.uint8 array of shape (len(positions), 2) holding the
+                two allele values of each SNP as ASCII codes (b'A' == 65)
+
+Single-character alleles compare exactly like the strings they came from,
+so b'A' == b'A' for the codes just as 'A' == 'A' for the raw values.
+"""
+ChromosomeGenotypes = namedtuple(
+        'ChromosomeGenotypes',
+        ['positions', 'alleles'])
+
+
+def build_chromosome_genotypes(
+        positions_buffer,
+        alleles_buffer):
+    """
+    Turn the raw parse buffers of one chromosome into a ChromosomeGenotypes,
+    sorted by position.  As with a dict, the last row read for a repeated
+    position wins.
+    """
+    positions = np.frombuffer(positions_buffer, dtype=np.int32)
+    alleles = np.frombuffer(alleles_buffer, dtype=np.uint8).reshape(-1, 2)
+
+    order = np.argsort(positions, kind='stable')
+    positions = positions[order]
+    alleles = alleles[order]
+
+    last_of_each_position = np.ones(len(positions), dtype=bool)
+    last_of_each_position[:-1] = positions[1:] != positions[:-1]
+
+    return ChromosomeGenotypes(
+            positions[last_of_each_position],
+            alleles[last_of_each_position])
+
+
+@timed('parse')
+def load_raw_file_by_chromosome(
+        this_kr_raw_file):
+    """
+    Read a raw DNA file ONCE and split it into per-chromosome partitions:
+
+        { 1 : ChromosomeGenotypes(positions=array([ 752566,  776546, ...]),
+                                  alleles=array([[65, 71],
+                                                 [65, 65], ...])),
+          2 : ChromosomeGenotypes(...),
+          ...
+          22 : ChromosomeGenotypes(...),
         }
 
-        Keep in mind that different testing companies include a different
-        subset of SNP locations, so each match dict may have different keys.
+        Only the autosomes (1-22) are kept; X, Y and MT rows are skipped,
+        as are rows that do not carry exactly two allele values.
+
+        The vendor format is detected from the file header and the file,
+        compressed or not, is streamed line by line through the vendor's
+        parser, so the raw text is never held in memory as a whole.
     """
-    match_SNP_values_dict = {}
+    vendor = detect_raw_file_vendor(this_kr_raw_file)
+    parse_raw_lines = RAW_FILE_PARSERS[vendor][1]
 
-    data_dir_name = DATA_FILE_DIRECTORY
-    data_file_dir = os.path.join(this_dir, "{0}".format(data_dir_name))
-    source_data_file_names = os.listdir(data_file_dir)
+    chromosome_keys = {str(chromosome): chromosome for chromosome in AUTOSOMES}
+    positions_by_chromosome = {
+        chromosome: array('i') for chromosome in AUTOSOMES}
+    alleles_by_chromosome = {
+        chromosome: bytearray() for chromosome in AUTOSOMES}
 
-    raw_file_names = [f for f in source_data_file_names if 'raw' in f]
+    lp_2("raw file format", vendor)
 
-    for known_relative in all_matches_list:
-        match_SNP_values_dict[known_relative] = {}
+    with open_raw_file(this_kr_raw_file) as raw_file:
+        for raw_chromosome, raw_position, raw_row_data in parse_raw_lines(
+                iter_raw_data_lines(raw_file)):
+
+            chromosome = chromosome_keys.get(raw_chromosome)
+            if chromosome is None or len(raw_row_data) != 2:
+                continue
+
+            positions_by_chromosome[chromosome].append(int(raw_position))
+            alleles_by_chromosome[chromosome] += raw_row_data.encode(
+                'latin-1')
+
+    count('rows parsed', sum(len(positions_by_chromosome[chromosome])
+                             for chromosome in AUTOSOMES))
+
+    return {chromosome: build_chromosome_genotypes(
+                positions_by_chromosome[chromosome],
+                alleles_by_chromosome[chromosome])
+            for chromosome in AUTOSOMES}
+
+
+"""
+Persistent cache of parsed raw files.
+
+    RAW_FILE_CACHE_DIRECTORY/
+        index.json          { raw file path : { 'size', 'mtime_ns', 'sha256' } }
+        index.lock          held while index.json is updated
+        <sha256>_v<N>/      one entry per distinct raw file content
+            positions.npy   int32 positions of chromosomes 1-22, concatenated
+            alleles.npy     uint8 (SNPs, 2) alleles, in the same order
+            offsets.npy     where each chromosome starts and ends
+
+A raw file whose size and mtime still match its index record is loaded
+straight from its entry with memory-mapped arrays, without being read or
+hashed.  Otherwise its content hash decides whether an existing entry
+can be reused or the file must be parsed.  RAW_FILE_CACHE_VERSION is part
+of the entry name and must be bumped whenever parsing changes.
+"""
+RAW_FILE_CACHE_VERSION = 2
+RAW_FILE_CACHE_INDEX = 'index.json'
+RAW_FILE_CACHE_LOCK = 'index.lock'
+# an entry no index record points to is only deleted once it is this
+# old, since another process may have just stored it
+RAW_FILE_CACHE_GRACE_SECONDS = 600
+
+# kits are loaded on several threads; index updates go one at a time
+raw_file_cache_lock = threading.Lock()
+
+
+@contextmanager
+def raw_file_cache_locked(
+        cache_dir):
+    """
+    Hold the raw file cache index against other threads and, where fcntl
+    is available, against other processes sharing the cache directory
+    (the CLI and the server, or several CLI runs).
+    """
+    with raw_file_cache_lock:
+        if fcntl is None:
+            yield
+            return
+        lock_file_name = os.path.join(cache_dir, RAW_FILE_CACHE_LOCK)
+        with open(lock_file_name, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_raw_file_cache_dir():
+    "The cache directory, or None when the cache is switched off"
+    if not RAW_FILE_CACHE_DIRECTORY:
+        return None
+    return os.path.join(this_dir, RAW_FILE_CACHE_DIRECTORY)
+
+
+def hash_raw_file(
+        this_kr_raw_file):
+    raw_file_hash = hashlib.sha256()
+    with open(this_kr_raw_file, 'rb') as raw_file:
+        for chunk in iter(lambda: raw_file.read(1 << 20), b''):
+            raw_file_hash.update(chunk)
+    return raw_file_hash.hexdigest()
+
+
+def read_raw_file_cache_index(
+        cache_dir):
+    try:
+        with open(os.path.join(cache_dir, RAW_FILE_CACHE_INDEX)) as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_raw_file_cache_index(
+        cache_dir,
+        raw_file_cache_index):
+    "Replace the index atomically, so readers never see a partial file"
+    index_file_name = os.path.join(cache_dir, RAW_FILE_CACHE_INDEX)
+    temporary_file_name = "{0}.{1}.tmp".format(index_file_name, os.getpid())
+    with open(temporary_file_name, 'w') as index_file:
+        json.dump(raw_file_cache_index, index_file, indent=1, sort_keys=True)
+    os.replace(temporary_file_name, index_file_name)
+
+
+def get_raw_file_cache_entry_dir(
+        cache_dir,
+        raw_file_sha256):
+    return os.path.join(cache_dir, "{0}_v{1}".format(
+        raw_file_sha256, RAW_FILE_CACHE_VERSION))
+
+
+def save_raw_data_to_cache(
+        entry_dir,
+        genotypes_by_chromosome):
+    """
+    Write one parsed raw file as a cache entry.  The entry is assembled in
+    a temporary directory and renamed into place, so a half-written entry
+    is never visible.
+    """
+    chromosomes = sorted(genotypes_by_chromosome)
+    offsets = np.zeros((len(chromosomes), 3), dtype=np.int64)
+    offsets[:, 0] = chromosomes
+    offsets[:, 2] = np.cumsum([
+        len(genotypes_by_chromosome[chromosome].positions)
+        for chromosome in chromosomes])
+    offsets[1:, 1] = offsets[:-1, 2]
+
+    temporary_dir = "{0}.{1}.tmp".format(entry_dir, os.getpid())
+    os.makedirs(temporary_dir, exist_ok=True)
+    np.save(os.path.join(temporary_dir, 'offsets.npy'), offsets)
+    np.save(os.path.join(temporary_dir, 'positions.npy'), np.concatenate(
+        [genotypes_by_chromosome[chromosome].positions
+         for chromosome in chromosomes]))
+    np.save(os.path.join(temporary_dir, 'alleles.npy'), np.concatenate(
+        [genotypes_by_chromosome[chromosome].alleles
+         for chromosome in chromosomes]))
+
+    try:
+        os.rename(temporary_dir, entry_dir)
+    except OSError:
+        # another process stored the same content first
+        shutil.rmtree(temporary_dir, ignore_errors=True)
+
+
+def load_raw_data_from_cache(
+        entry_dir):
+    """
+    Map a cache entry back into { chromosome : ChromosomeGenotypes }.
+    The arrays are read-only views on memory-mapped files.
+    """
+    offsets = np.load(os.path.join(entry_dir, 'offsets.npy'))
+    positions = np.load(os.path.join(entry_dir, 'positions.npy'), mmap_mode='r')
+    alleles = np.load(os.path.join(entry_dir, 'alleles.npy'), mmap_mode='r')
+
+    os.utime(entry_dir)
+
+    return {int(chromosome): ChromosomeGenotypes(
+                positions[start:end], alleles[start:end])
+            for chromosome, start, end in offsets.tolist()}
+
+
+def get_directory_size(
+        directory):
+    return sum(entry.stat().st_size for entry in os.scandir(directory)
+               if entry.is_file())
+
+
+def evict_raw_file_cache(
+        cache_dir,
+        raw_file_cache_index,
+        max_bytes,
+        keep_entry_dir=None):
+    """
+    Drop index records of raw files that were changed or removed, delete
+    entries no record points to (once they are older than
+    RAW_FILE_CACHE_GRACE_SECONDS), then delete the least recently used
+    entries until the cache fits in max_bytes.  keep_entry_dir, the entry
+    being loaded, is never deleted, even when it alone exceeds max_bytes.
+    """
+    for raw_file_path, record in list(raw_file_cache_index.items()):
         try:
-            kr_raw_file_name = [rfn for rfn in raw_file_names
-                                if known_relative in rfn
-                                and rfn.split('.')[ -1] == 'txt'][0]
+            raw_file_stat = os.stat(raw_file_path)
+        except OSError:
+            del raw_file_cache_index[raw_file_path]
+            continue
+        if (raw_file_stat.st_size != record['size']
+                or raw_file_stat.st_mtime_ns != record['mtime_ns']):
+            del raw_file_cache_index[raw_file_path]
+
+    used_entry_dirs = {
+        get_raw_file_cache_entry_dir(cache_dir, record['sha256'])
+        for record in raw_file_cache_index.values()}
+
+    unused_before = time.time() - RAW_FILE_CACHE_GRACE_SECONDS
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if not entry.is_dir():
+            continue
+        if entry.path not in used_entry_dirs:
+            if not (entry.name.endswith('.tmp')
+                    or entry.name == STRIP_CACHE_SUBDIRECTORY
+                    or entry.stat().st_mtime > unused_before):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            continue
+        entries.append((entry.stat().st_mtime, get_directory_size(entry.path),
+                        entry.path))
+
+    cache_bytes = sum(entry_bytes for _, entry_bytes, _ in entries)
+    for _, entry_bytes, entry_dir in sorted(entries):
+        if cache_bytes <= max_bytes:
+            break
+        if entry_dir == keep_entry_dir:
+            continue
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        cache_bytes -= entry_bytes
+        for raw_file_path, record in list(raw_file_cache_index.items()):
+            if get_raw_file_cache_entry_dir(
+                    cache_dir, record['sha256']) == entry_dir:
+                del raw_file_cache_index[raw_file_path]
+
+
+@timed('load')
+def load_raw_file_with_cache(
+        this_kr_raw_file,
+        kit=None):
+    """
+    load_raw_file_by_chromosome, backed by the persistent raw file cache.
+    The kit index record of the file, as find_kit returns it, saves
+    hashing the file again -- as long as its size and mtime are still
+    those of the file.
+    """
+    cache_dir = get_raw_file_cache_dir()
+    if cache_dir is None:
+        return load_raw_file_by_chromosome(this_kr_raw_file)
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    raw_file_path = os.path.abspath(this_kr_raw_file)
+    raw_file_stat = os.stat(raw_file_path)
+    raw_file_cache_index = read_raw_file_cache_index(cache_dir)
+
+    record = raw_file_cache_index.get(raw_file_path)
+    if (record is not None
+            and record['size'] == raw_file_stat.st_size
+            and record['mtime_ns'] == raw_file_stat.st_mtime_ns):
+        entry_dir = get_raw_file_cache_entry_dir(cache_dir, record['sha256'])
+        if os.path.isdir(entry_dir):
+            try:
+                genotypes_by_chromosome = load_raw_data_from_cache(entry_dir)
+            except FileNotFoundError:
+                # another process evicted the entry while it was read
+                pass
+            else:
+                count('raw file cache hits')
+                return genotypes_by_chromosome
+
+    raw_file_sha256 = None
+    if (kit is not None
+            and kit['size'] == raw_file_stat.st_size
+            and kit['mtime_ns'] == raw_file_stat.st_mtime_ns):
+        raw_file_sha256 = kit['sha256']
+    if raw_file_sha256 is None:
+        raw_file_sha256 = hash_raw_file(raw_file_path)
+    entry_dir = get_raw_file_cache_entry_dir(cache_dir, raw_file_sha256)
+    genotypes_by_chromosome = None
+    if not os.path.isdir(entry_dir):
+        genotypes_by_chromosome = load_raw_file_by_chromosome(raw_file_path)
+
+    # the entry must be in the index before anyone evicts, or it would
+    # look unused; the lock also keeps other processes' index updates
+    # from being lost.  It is mapped before the lock is released, so a
+    # later eviction cannot pull it away.
+    with raw_file_cache_locked(cache_dir):
+        cached_genotypes_by_chromosome = None
+        if os.path.isdir(entry_dir):
+            try:
+                cached_genotypes_by_chromosome = \
+                    load_raw_data_from_cache(entry_dir)
+            except FileNotFoundError:
+                # left half deleted by an interrupted eviction
+                shutil.rmtree(entry_dir, ignore_errors=True)
+        if cached_genotypes_by_chromosome is None:
+            save_raw_data_to_cache(
+                    entry_dir,
+                    genotypes_by_chromosome
+                    or load_raw_file_by_chromosome(raw_file_path))
+            cached_genotypes_by_chromosome = \
+                load_raw_data_from_cache(entry_dir)
+
+        raw_file_cache_index = read_raw_file_cache_index(cache_dir)
+        raw_file_cache_index[raw_file_path] = {
+            'size': raw_file_stat.st_size,
+            'mtime_ns': raw_file_stat.st_mtime_ns,
+            'sha256': raw_file_sha256,
+        }
+        evict_raw_file_cache(
+                cache_dir,
+                raw_file_cache_index,
+                RAW_FILE_CACHE_MAX_BYTES,
+                entry_dir)
+        write_raw_file_cache_index(cache_dir, raw_file_cache_index)
 
-            lp_2(str(inspect.stack()[0][2]), "kr_raw_file_name",
-                 str(kr_raw_file_name))
+    return cached_genotypes_by_chromosome
 
-        except IndexError as e:
-            lp_2(str(inspect.stack()[0][2]),
-                 "no such file found for {0}".format(known_relative), str(e))
-            sys.exit()
 
-        this_kr_raw_file = os.path.join(data_file_dir, kr_raw_file_name)
+"""
+Raw file discovery index.
+
+For every raw file in a data directory the kit index records its size,
+mtime, detected vendor, content hash and the name tokens of its file
+name, and is saved next to the raw file cache:
+
+    { 'dir_mtime_ns' : 1609459200000000000,
+      'files' : { '23andMe_JULIE_raw_dna.txt' : { 'size', 'mtime_ns',
+                                                  'vendor', 'sha256',
+                                                  'name_tokens' }, }, }
+
+A file belongs to a person when the person's name appears as whole
+tokens of the file name, so 'JAN' finds 'Ancestry_JAN_raw.txt' but not
+'Ancestry_JANE_raw.txt'.  The directory is only rescanned when its mtime
+changes, and then only new or changed files are sniffed again.  Hashes
+are computed the first time a kit is actually used.  Overwriting a file
+in place leaves the directory mtime alone, so find_kit checks the size
+and mtime of the files it picks from as well.
+"""
+KIT_INDEX_VERSION = 1
+kit_index_lock = threading.Lock()
+
+KitIndex = namedtuple(
+        'KitIndex',
+        ['data_file_dir', 'index_data', 'people'])
+
+_kit_indexes = {}
+
+
+class KitNotFoundError(LookupError):
+    pass
 
-        with open(this_kr_raw_file, 'r', encoding='utf-8-sig') as raw_file:
-            raw_reader = csv.reader([row for row in raw_file
-                                     if not row.startswith ('#')
-                                     and not row.startswith ('SNP')
-                                     and not row.startswith('SNP')],
-                                    delimiter='\t')
-            for raw_row in raw_reader:
 
-                if 'Ancestry' in kr_raw_file_name:
-                    if str(raw_row[1]) != str(CHROMOSOME_TO_RENDER):
-                        continue
-                    if raw_row[3] not in ['A', 'C', 'G', 'T']:
-                        pass
-                    raw_row_data = (raw_row[3], raw_row[4])
+def get_name_tokens(
+        name):
+    return [token for token in re.split(r'[^0-9A-Za-z]+', name) if token]
 
-                else:
-                    if str(raw_row[1]) != str(CHROMOSOME_TO_RENDER):
-                        continue
-                    if raw_row[3][0] not in ['A', 'C', 'G', 'T']:
-                            pass
-                    raw_row_data = (raw_row[3][0], raw_row[3][1])
 
-                match_SNP_values_dict[known_relative][
-                    int(raw_row[2])] = raw_row_data
+def get_kit_index_file(
+        data_file_dir):
+    cache_dir = get_raw_file_cache_dir()
+    if cache_dir is None:
+        return None
+    return os.path.join(cache_dir, "kits_{0}_v{1}.json".format(
+        hashlib.sha1(data_file_dir.encode('utf-8')).hexdigest(),
+        KIT_INDEX_VERSION))
 
-        pp_3(str(inspect.stack()[0][2]),
-             "MATCH_PIXELS for {0}".format(known_relative),
-             take(10, match_SNP_values_dict[known_relative].items()))
 
-    return match_SNP_values_dict
+def read_kit_index_file(
+        kit_index_file):
+    if kit_index_file is None:
+        return None
+    try:
+        with open(kit_index_file) as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return None
 
 
+def write_kit_index_file(
+        kit_index_file,
+        kit_index_data):
+    if kit_index_file is None:
+        return
+    os.makedirs(os.path.dirname(kit_index_file), exist_ok=True)
+    temporary_file_name = "{0}.{1}.tmp".format(kit_index_file, os.getpid())
+    with open(temporary_file_name, 'w') as index_file:
+        json.dump(kit_index_data, index_file, indent=1, sort_keys=True)
+    os.replace(temporary_file_name, kit_index_file)
+
+
+def build_people_index(
+        files):
+    "{ name token : [ file names containing it ] }"
+    people = {}
+    for file_name, record in files.items():
+        for token in set(record['name_tokens']):
+            people.setdefault(token, []).append(file_name)
+    return people
+
+
+def scan_data_file_dir(
+        data_file_dir,
+        previous_files):
+    """
+    List the raw files of data_file_dir, reusing the records of files whose
+    size and mtime have not changed and sniffing only the rest.
+    """
+    files = {}
+    for entry in os.scandir(data_file_dir):
+        if (not entry.is_file() or 'raw' not in entry.name
+                or not is_raw_file_name(entry.name)):
+            continue
+
+        entry_stat = entry.stat()
+        record = previous_files.get(entry.name)
+        if (record is not None
+                and record['size'] == entry_stat.st_size
+                and record['mtime_ns'] == entry_stat.st_mtime_ns):
+            files[entry.name] = record
+            continue
+
+        try:
+            vendor = detect_raw_file_vendor(entry.path)
+        except (OSError, ValueError, UnicodeDecodeError) as e:
+            lp_2("skipping unreadable raw file {0}".format(entry.name), str(e))
+            continue
+
+        files[entry.name] = {
+            'size': entry_stat.st_size,
+            'mtime_ns': entry_stat.st_mtime_ns,
+            'vendor': vendor,
+            'sha256': None,
+            'name_tokens': get_name_tokens(
+                entry.name.split('.')[0]),
+        }
+    return files
+
+
+def get_kit_index(
+        data_file_dir):
+    """
+    The up-to-date KitIndex of data_file_dir.  Kept in memory for the life
+    of the process and on disk between runs; rescanned only when the
+    directory's mtime has changed.  Raises KitNotFoundError when there is
+    no such directory.
+    """
+    data_file_dir = os.path.abspath(data_file_dir)
+    try:
+        dir_mtime_ns = os.stat(data_file_dir).st_mtime_ns
+    except FileNotFoundError:
+        raise KitNotFoundError(
+            "no raw DNA directory {0}".format(data_file_dir))
+
+    kit_index = _kit_indexes.get(data_file_dir)
+    if kit_index is not None and kit_index.index_data['dir_mtime_ns'] \
+            == dir_mtime_ns:
+        return kit_index
+
+    with kit_index_lock:
+        kit_index_file = get_kit_index_file(data_file_dir)
+        kit_index_data = read_kit_index_file(kit_index_file) or {
+            'dir_mtime_ns': None, 'files': {}}
+
+        if kit_index_data['dir_mtime_ns'] != dir_mtime_ns:
+            kit_index_data = {
+                'dir_mtime_ns': dir_mtime_ns,
+                'files': scan_data_file_dir(
+                    data_file_dir, kit_index_data['files']),
+            }
+            write_kit_index_file(kit_index_file, kit_index_data)
+
+        kit_index = KitIndex(
+                data_file_dir,
+                kit_index_data,
+                build_people_index(kit_index_data['files']))
+        _kit_indexes[data_file_dir] = kit_index
+    return kit_index
+
+
+def refresh_kit_record(
+        kit_index,
+        file_name):
+    """
+    The index record of file_name, sniffed again -- and its hash dropped --
+    when the file's size or mtime have changed.  None when the file is
+    gone or can no longer be read.
+    """
+    record = kit_index.index_data['files'][file_name]
+    raw_file_path = os.path.join(kit_index.data_file_dir, file_name)
+    try:
+        raw_file_stat = os.stat(raw_file_path)
+    except OSError:
+        return None
+    if (record['size'] == raw_file_stat.st_size
+            and record['mtime_ns'] == raw_file_stat.st_mtime_ns):
+        return record
+
+    try:
+        vendor = detect_raw_file_vendor(raw_file_path)
+    except (OSError, ValueError, UnicodeDecodeError) as e:
+        lp_2("skipping unreadable raw file {0}".format(file_name), str(e))
+        return None
+
+    with kit_index_lock:
+        record.update(
+            size=raw_file_stat.st_size,
+            mtime_ns=raw_file_stat.st_mtime_ns,
+            vendor=vendor,
+            sha256=None)
+        write_kit_index_file(
+                get_kit_index_file(kit_index.data_file_dir),
+                kit_index.index_data)
+    return record
+
+
+def find_kit(
+        known_relative,
+        kit_index,
+        vendor=None):
+    """
+    Look up a person's raw file in the kit index:
+
+        { 'path', 'vendor', 'sha256', ... }
+
+    When a person has kits from several vendors the first vendor in
+    RAW_FILE_PARSERS order is used unless vendor is given; among several
+    kits of one vendor the newest file wins.
+    """
+    name_tokens = get_name_tokens(known_relative)
+    files = kit_index.index_data['files']
+
+    candidates = []
+    for file_name in kit_index.people.get(name_tokens[0] if name_tokens
+                                          else known_relative, []):
+        file_tokens = files[file_name]['name_tokens']
+        if any(file_tokens[start:start + len(name_tokens)] == name_tokens
+               for start in range(len(file_tokens))):
+            candidates.append(file_name)
+
+    candidates = [file_name for file_name in candidates
+                  if refresh_kit_record(kit_index, file_name) is not None]
+
+    if vendor is not None:
+        candidates = [file_name for file_name in candidates
+                      if files[file_name]['vendor'] == vendor]
+
+    if not candidates:
+        raise KitNotFoundError(
+            "no raw DNA file found for {0} in {1}".format(
+                known_relative, kit_index.data_file_dir))
+
+    vendor_order = list(RAW_FILE_PARSERS)
+    kr_raw_file_name = min(
+            candidates,
+            key=lambda file_name: (
+                vendor_order.index(files[file_name]['vendor']),
+                -files[file_name]['mtime_ns']))
+
+    record = files[kr_raw_file_name]
+    this_kr_raw_file = os.path.join(kit_index.data_file_dir, kr_raw_file_name)
+
+    if record['sha256'] is None:
+        record = dict(record)
+        record['sha256'] = hash_raw_file(this_kr_raw_file)
+        raw_file_stat = os.stat(this_kr_raw_file)
+        # a file changed while it was hashed keeps no hash
+        if (raw_file_stat.st_size == record['size']
+                and raw_file_stat.st_mtime_ns == record['mtime_ns']):
+            with kit_index_lock:
+                files[kr_raw_file_name]['sha256'] = record['sha256']
+                write_kit_index_file(
+                        get_kit_index_file(kit_index.data_file_dir),
+                        kit_index.index_data)
+        else:
+            record['sha256'] = None
+
+    lp_2("kr_raw_file_name", str(kr_raw_file_name))
+
+    return dict(record, path=this_kr_raw_file)
+
+
+def load_raw_data_for_all_matches(
+        all_matches_list,
+        data_dir_name=None):
+    """
+    Parse every match's raw file a single time, for all 22 chromosomes:
+
+        { match_name_1 : { 1 : ChromosomeGenotypes(positions, alleles),
+                           2 : ChromosomeGenotypes(positions, alleles),
+                         },
+          match_name_2 : { ... },
+        }
+
+    The result can be handed to get_match_pixel_dicts_for_siblings_to_render
+    once per chromosome without touching the raw files again.  Files that
+    were parsed on an earlier run come from the raw file cache.
+
+    The kits are hashed, read and decoded on up to RAW_FILE_LOAD_THREADS
+    threads, so on slow or network storage the wait for one file overlaps
+    with the others.  No more kits are started than there are threads.
+
+    data_dir_name defaults to DATA_FILE_DIRECTORY from pixel_config.
+    Raises KitNotFoundError when a match has no raw file there.
+    """
+    if data_dir_name is None:
+        data_dir_name = DATA_FILE_DIRECTORY
+    data_file_dir = os.path.join(this_dir, "{0}".format(data_dir_name))
+    kit_index = get_kit_index(data_file_dir)
+
+    def load_kit(known_relative):
+        kit = find_kit(known_relative, kit_index)
+        return load_raw_file_with_cache(kit['path'], kit)
+
+    raw_data = {}
+    load_threads = max(RAW_FILE_LOAD_THREADS, 1)
+
+    with ThreadPoolExecutor(max_workers=load_threads) as executor:
+        loading = {}
+        for known_relative in all_matches_list:
+            if len(loading) >= load_threads:
+                done, _ = wait(loading, return_when=FIRST_COMPLETED)
+                for future in done:
+                    raw_data[loading.pop(future)] = future.result()
+            loading[executor.submit(load_kit, known_relative)] = \
+                known_relative
+
+        for future in wait(loading)[0]:
+            raw_data[loading[future]] = future.result()
+
+    return {known_relative: raw_data[known_relative]
+            for known_relative in all_matches_list}
+
+
+def get_match_pixel_dicts_for_siblings_to_render(
+        chromosome,
+        all_matches_list,
+        raw_data_by_match=None):
+    """
+    For each match, take the chromosome partition of the raw file:
+
+        { match_name_1 : ChromosomeGenotypes(positions, alleles),
+          match_name_2 : ChromosomeGenotypes(positions, alleles),
+          match_name_3 : ChromosomeGenotypes(positions, alleles),
+        }
+
+        Keep in mind that different testing companies include a different
+        subset of SNP locations, so each match may have different positions.
+
+        Pass raw_data_by_match (from load_raw_data_for_all_matches) to avoid
+        re-reading the raw files for every chromosome.
+    """
+    if raw_data_by_match is None:
+        raw_data_by_match = load_raw_data_for_all_matches(all_matches_list)
+
+    match_genotypes = {}
+
+    for known_relative in all_matches_list:
+        match_genotypes[known_relative] = \
+            raw_data_by_match[known_relative][int(chromosome)]
+
+        pp_3("MATCH_PIXELS for {0}".format(known_relative),
+             list(zip(match_genotypes[known_relative].positions[:10],
+                      match_genotypes[known_relative].alleles[:10].tolist())))
+
+    return match_genotypes
+
+
+"""
+SNP positions shared by all matches:
+
+    positions : sorted np.int32 array of the common SNP locations
+    indices   : { match_name : np.intp array }, where
+                match_genotypes[match_name].positions[indices[match_name]]
+                equals positions, element for element
+"""
+CommonSNPs = namedtuple(
+        'CommonSNPs',
+        ['positions', 'indices'])
+
+
+@timed('common SNPs')
 def get_common_keys(
-        match_SNP_values_dict):
+        match_genotypes):
     """
-    Read and compare all matches, and get a list of ONLY those
-    SNP locations ('rsid') that are represented in ALL of the matches.
+    Read and compare all matches, and get a sorted array of ONLY those
+    SNP locations that are represented in ALL of the matches.
     
     Otherwise you will get blank spots, chromosome images of different lengths,
      or simply generate errors when trying to compare them.
+
+    Every match's positions array is already sorted and unique, so the
+    arrays are merged pairwise with np.intersect1d, carrying along the
+    index of each surviving SNP in every match's own arrays.  The common
+    positions come out sorted and aligned with those index vectors.
     """
-    list_of_match_pixel_dicts = []
-    for kr_key in match_SNP_values_dict.keys():
+    names = list(match_genotypes.keys())
+
+    common_SNP_positions = match_genotypes[names[0]].positions
+    indices = {names[0]: np.arange(len(common_SNP_positions), dtype=np.intp)}
 
-        list_of_match_pixel_dicts.append(match_SNP_values_dict[kr_key])
+    for kr_key in names[1:]:
+        common_SNP_positions, kept, kr_indices = np.intersect1d(
+                common_SNP_positions,
+                match_genotypes[kr_key].positions,
+                assume_unique=True,
+                return_indices=True)
 
-    common_SNP_keys = set.intersection(*map(set, list_of_match_pixel_dicts))
+        for previous_key in indices:
+            indices[previous_key] = indices[previous_key][kept]
+        indices[kr_key] = kr_indices
 
-    return common_SNP_keys
+    count('SNPs intersected', sum(len(match_genotypes[kr_key].positions)
+                                  for kr_key in names))
+    count('common SNPs', len(common_SNP_positions))
 
+    return CommonSNPs(common_SNP_positions, indices)
 
+
+"""
+Genotypes of all matches, restricted to the common SNP positions:
+
+    positions : sorted np.int32 array of the common SNP locations
+    names     : tuple of match names, in the order of the first axis of alleles
+    alleles   : np.uint8 array of shape (len(names), len(positions), 2)
+"""
+CommonGenotypes = namedtuple(
+        'CommonGenotypes',
+        ['positions', 'names', 'alleles'])
+
+
+@timed('gather genotypes')
 def get_common_key_SNP_dict(
-        common_SNP_keys,
-        match_SNP_values_dict):
+        common_SNPs,
+        match_genotypes):
     """
-    Restructure the data dict to look like this, with only SNPs in all files:
-    
-    
-        { SNP_location_1 : { match_name_1 : ( tuple of SNP values A and B ),
-                             match_name_2 : ( tuple of SNP values A and B ),
-                             match_name_3 : ( tuple of SNP values A and B ),
-                           },
-          SNP_location_2  : { match_name_1  : ( tuple of SNP values A and B ),
-                             match_name_2 : ( tuple of SNP values A and B ),
-                             match_name_3 : ( tuple of SNP values A and B ),
-                           },
-         SNP_location_3  : { match_name_1  : ( tuple of SNP values A and B ),
-                             match_name_2 : ( tuple of SNP values A and B ),
-                             match_name_3 : ( tuple of SNP values A and B ),
-                           },
-        }
+    Gather every match's alleles at the common SNP positions into a single
+    array, one row per match, aligned column by column:
+
+        CommonGenotypes(
+            positions=array([ 752566,  776546, ...]),
+            names=('JULIE', 'ALLISON', 'COLLETTE'),
+            alleles=array([[[65, 71], [65, 65], ...],     <- JULIE
+                           [[65, 65], [65, 65], ...],     <- ALLISON
+                           [[71, 71], [65, 71], ...]]))   <- COLLETTE
     """
-    common_key_SNP_dict = {}
-    for common_SNP_key in common_SNP_keys:
-        common_key_SNP_dict[common_SNP_key] = {}
-        for kr_key in match_SNP_values_dict.keys():
-            common_key_SNP_dict[common_SNP_key][kr_key] = \
-                match_SNP_values_dict[kr_key][common_SNP_key]
+    names = tuple(match_genotypes.keys())
+    alleles = np.empty((len(names), len(common_SNPs.positions), 2),
+                       dtype=np.uint8)
+
+    for row, kr_key in enumerate(names):
+        np.take(match_genotypes[kr_key].alleles, common_SNPs.indices[kr_key],
+                axis=0, out=alleles[row])
+
+    return CommonGenotypes(common_SNPs.positions, names, alleles)
 
-    return common_key_SNP_dict
 
+"""
+Match classes, stored as small ints so each pair's result is one np.uint8
+per SNP rather than one string per SNP.
+"""
+NO_MATCH_SNP = 0
+HALF_MATCH_SNP = 1
+FULL_MATCH_SNP = 2
+
+"""
+Result of the match classification, only SNPs kept for rendering:
+
+    positions     : sorted np.int32 array of SNP locations
+    names         : tuple of match names
+    alleles       : np.uint8 array (len(names), len(positions), 2)
+    pair_labels   : tuple of unique labels such as 'JUL_ALL_Match', one per
+                    pair (see get_match_pair_labels)
+    match_classes : np.uint8 array (len(pair_labels), len(positions))
+                    holding NO_MATCH_SNP, HALF_MATCH_SNP or FULL_MATCH_SNP
+"""
+MatchTable = namedtuple(
+        'MatchTable',
+        ['positions', 'names', 'alleles', 'pair_labels', 'match_classes'])
+
+
+def get_name_abbreviations(
+        names):
+    """
+    { name : abbreviation }, the first three letters of each name, or as
+    many more as it takes to tell it from the other names: MARY and MARIA
+    become MARY and MARI, JOHN and JOHNNY become JOHN and JOHNN.
+    """
+    name_abbreviations = {}
+    for name in names:
+        length = 3
+        while length < len(name) and any(
+                other_name != name and other_name[:length] == name[:length]
+                for other_name in names):
+            length += 1
+        name_abbreviations[name] = name[:length]
+    return name_abbreviations
+
+
+def get_match_pair_labels(
+        match_pair_combinations,
+        names):
+    "One label such as 'JUL_ALL_Match' per pair, unique within the family"
+    name_abbreviations = get_name_abbreviations(names)
+    return tuple(
+        "{0}_{1}_Match".format(name_abbreviations[match_pair_combination[0]],
+                               name_abbreviations[match_pair_combination[1]])
+        for match_pair_combination in match_pair_combinations)
+
+
+def classify_match_pairs(
+        alleles,
+        pair_rows,
+        filter_rows):
+    """
+    Classify every pair at every SNP in bulk.
+
+    alleles is the (matches, SNPs, 2) array of CommonGenotypes, pair_rows a
+    list of (row_A, row_B) tuples and filter_rows the rows that take part in
+    the all-identical noise filter.
+
+    Returns the (pairs, SNPs) np.uint8 match-class matrix and a boolean mask
+    that is False where every allele of every filter_rows match is the same.
+
+        full match : A1 == B1 and A2 == B2, or A1 == B2 and A2 == B1
+        half match : any one of the four allele comparisons is equal
+        no match   : none of them are
+    """
+    pair_rows = np.asarray(pair_rows, dtype=np.intp).reshape(-1, 2)
 
+    mpA = alleles[pair_rows[:, 0]]
+    mpB = alleles[pair_rows[:, 1]]
+    mpA_1, mpA_2 = mpA[..., 0], mpA[..., 1]
+    mpB_1, mpB_2 = mpB[..., 0], mpB[..., 1]
+
+    same_11 = mpA_1 == mpB_1
+    same_22 = mpA_2 == mpB_2
+    same_12 = mpA_1 == mpB_2
+    same_21 = mpA_2 == mpB_1
+
+    full_match = (same_11 & same_22) | (same_12 & same_21)
+    half_match = same_11 | same_22 | same_12 | same_21
+
+    match_classes = np.full(full_match.shape, NO_MATCH_SNP, dtype=np.uint8)
+    match_classes[half_match] = HALF_MATCH_SNP
+    match_classes[full_match] = FULL_MATCH_SNP
+
+    return match_classes, get_varying_SNPs(alleles, filter_rows)
+
+
+def get_varying_SNPs(
+        alleles,
+        filter_rows):
+    "False where every allele of every filter_rows match is the same"
+    filter_alleles = alleles[list(filter_rows)]
+    return (filter_alleles != filter_alleles[:1, :, :1]).any(axis=(0, 2))
+
+
+@timed('classify')
 def insert_combo_match_type_into_common_key_SNP_dict(
-        common_key_SNP_dict,
-        match_pair_combinations):
-    """
-    transform the dataset into this structure, one entry for each SNP
-    containing calculated match type (RED-YELLOW-GREEN):
-
-    { SNP_1 : {
-                'position': 289061,
-                'JULIE': ('A', 'G'),
-                'ALLISON': ('A', 'A'),
-                'COLLETTE': ('A', 'G'),
-                'J_A_Match': 'halfMatchSNP',
-                'J_C_Match': 'fullMatchSNP',
-                'A_C_Match': 'halfMatchSNP',
-            },
-     SNP_1 : {
-                'position': 289061,
-                'JULIE': ('G', 'G'),
-                'ALLISON': ('T', 'T'),
-                'COLLETTE': ('G', 'G'),
-                'J_A_Match': 'noMatchSNP',
-                'J_C_Match': 'fullMatchSNP',
-                'A_C_Match': 'noMatchSNP',
-            },
-     SNP_1 : {
-                'position': 289061,
-                'JULIE': ('A', 'G'),
-                'ALLISON': ('A', 'A'),
-                'COLLETTE': ('A', 'G'),
-                'J_A_Match': 'halfMatchSNP',
-                'J_C_Match': 'fullMatchSNP',
-                'A_C_Match': 'halfMatchSNP',
-            },
-    ),
-
-    """
-
-    useless_because_everything_is_identical_SNP_list = []
+        common_genotypes,
+        match_pair_combinations,
+        config=None):
+    """
+    Calculate the match type (RED-YELLOW-GREEN) of every pair at every SNP:
+
+    MatchTable(
+        positions=array([289061, 289075, 289102, ...]),
+        names=('JULIE', 'ALLISON', 'COLLETTE'),
+        alleles=array(...),
+        pair_labels=('JUL_ALL_Match', 'JUL_COL_Match', 'ALL_COL_Match'),
+        match_classes=array([[1, 0, 1, ...],      <- halfMatch, noMatch, ...
+                             [2, 2, 2, ...],      <- fullMatch, fullMatch, ...
+                             [1, 0, 1, ...]]))
+
+    """
+
     """
     It is helpful to filter out 'noise' segments where all matches have the exact 
     same values.  These are SNPs where some variation is often found throughout 
@@ -297,69 +1552,428 @@ def insert_combo_match_type_into_common_key_SNP_dict(
     
     The file has a setting for this, default is True
     """
-    for SNP in common_key_SNP_dict:
-        SNP_across_the_board_vals_list = []
-        for sib in siblings_to_render:
-            this_sib_vals = common_key_SNP_dict[SNP][sib][0:2]
-            SNP_across_the_board_vals_list += this_sib_vals
-        if len(set(SNP_across_the_board_vals_list)) == 1:
-            useless_because_everything_is_identical_SNP_list.append(SNP)
-
-    for SNP in common_key_SNP_dict:
-
-        common_key_SNP_dict[SNP]['position'] = SNP
-
-        for match_pair_combination in match_pair_combinations:
-            mp_abbr = "{0}_{1}_Match".format(match_pair_combination[0][:3],
-                                             match_pair_combination[1][:3])
-
-            mpA = common_key_SNP_dict[SNP][
-                "{0}".format(match_pair_combination[0])]
-            mpB = common_key_SNP_dict[SNP][
-                "{0}".format(match_pair_combination[1])]
-            mpA_1 = mpA[0]
-            mpA_2 = mpA[1]
-            mpB_1 = mpB[0]
-            mpB_2 = mpB[1]
-            if (mpA_1 == mpB_1 and mpA_2 == mpB_2) or (
-                    mpA_1 == mpB_2 and mpA_2 == mpB_1):
-                match_type = 'fullMatchSNP'
-            elif (mpA_1 == mpB_1 or mpA_2 == mpB_2) or (
-                    mpA_1 == mpB_2 or mpA_2 == mpB_1):
-                match_type = 'halfMatchSNP'
+    if config is None:
+        config = get_render_config()
+
+    name_rows = {name: row for row, name in enumerate(common_genotypes.names)}
+
+    pair_labels = get_match_pair_labels(match_pair_combinations,
+                                        common_genotypes.names)
+    pair_rows = [(name_rows[match_pair_combination[0]],
+                  name_rows[match_pair_combination[1]])
+                 for match_pair_combination in match_pair_combinations]
+    match_classes, not_everything_is_identical = classify_match_pairs(
+            common_genotypes.alleles,
+            pair_rows,
+            range(len(common_genotypes.names)))
+
+    if config.FILTER_COMPLETELY_MATCHED_SEGMENTS is True:
+        kept = not_everything_is_identical
+        count('SNPs filtered',
+              len(kept) - int(np.count_nonzero(kept)))
+
+    else:
+        kept = slice(None)
+
+    match_table = MatchTable(
+            common_genotypes.positions[kept],
+            common_genotypes.names,
+            common_genotypes.alleles[:, kept],
+            pair_labels,
+            match_classes[:, kept])
+
+    pp_3("match_table",
+         list(zip(match_table.positions[:10],
+                  match_table.match_classes[:, :10].T.tolist())))
+
+    return match_table
+
+
+"""
+Segment engine.
+
+Visual phasing reads a chromosome as regions rather than single SNPs:
+
+    FIR : fully identical region  -- both alleles shared
+    HIR : half identical region   -- one allele shared
+    NIR : non identical region    -- no allele shared
+
+A pair's regions are found from its match classes.  HIR is every stretch
+without noMatch SNPs, FIR every stretch of fullMatch SNPs inside a HIR,
+and NIR what is left.  Up to noise_tolerance SNPs that break a stretch
+within any min_SNPs SNPs are treated as genotyping noise and bridged, and
+stretches shorter than min_SNPs SNPs or min_bp base pairs are dropped.
+
+Region codes use the same numbers as the match class they stand for.
+"""
+NIR_SEGMENT = NO_MATCH_SNP
+HIR_SEGMENT = HALF_MATCH_SNP
+FIR_SEGMENT = FULL_MATCH_SNP
+
+SEGMENT_NAMES = {
+    NIR_SEGMENT: 'NIR',
+    HIR_SEGMENT: 'HIR',
+    FIR_SEGMENT: 'FIR',
+}
+
+"""
+One region of one pair.  start_index and end_index (inclusive) are SNP
+columns of the MatchTable, start_position and end_position their SNP
+locations.
+"""
+MatchSegment = namedtuple(
+        'MatchSegment',
+        ['pair_label', 'region', 'start_index', 'end_index',
+         'start_position', 'end_position', 'SNP_count'])
+
+
+def get_runs(
+        values):
+    """
+    Run-length encode a 1-D array: (run starts, run lengths, run values).
+    """
+    if len(values) == 0:
+        return (np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp),
+                values[:0])
+    starts = np.concatenate(
+            ([0], np.flatnonzero(values[1:] != values[:-1]) + 1))
+    lengths = np.diff(np.append(starts, len(values)))
+    return starts, lengths, values[starts]
+
+
+def drop_short_stretches(
+        in_stretch,
+        positions,
+        min_SNPs,
+        min_bp):
+    "Drop stretches of a boolean mask shorter than min_SNPs SNPs or min_bp"
+    starts, lengths, run_values = get_runs(in_stretch)
+    ends = starts + lengths - 1
+    too_short = (lengths < min_SNPs) | (
+        (positions[ends] - positions[starts]) < min_bp)
+    return np.repeat(run_values & ~too_short, lengths)
+
+
+def clean_up_stretches(
+        in_stretch,
+        positions,
+        noise_tolerance,
+        min_SNPs,
+        min_bp):
+    """
+    Find the stretches of a boolean mask that hold up with noise: every
+    window of min_SNPs SNPs with at most noise_tolerance False SNPs lies
+    in a stretch, False SNPs inside such windows are bridged, and the
+    stretches are trimmed to start and end on True SNPs.  Stretches
+    shorter than min_SNPs SNPs or min_bp are dropped.
+
+    Deciding by the density of breaking SNPs, rather than by the length
+    of each gap, keeps the region apart from the one below it: there the
+    breaking SNPs come one to three at a time as well, only many more of
+    them.
+    """
+    window = max(min_SNPs, 1)
+    SNP_count = len(in_stretch)
+    if SNP_count < window:
+        return np.zeros(SNP_count, dtype=bool)
+
+    breaks = np.concatenate(([0], np.cumsum(~in_stretch)))
+    clean_windows = np.concatenate(([0], np.cumsum(
+        (breaks[window:] - breaks[:-window]) <= noise_tolerance)))
+    # SNP i lies in the windows starting at i - window + 1 ... i
+    SNPs = np.arange(SNP_count)
+    first_window = np.maximum(SNPs - window + 1, 0)
+    last_window = np.minimum(SNPs, SNP_count - window)
+    covered = clean_windows[last_window + 1] > clean_windows[first_window]
+
+    starts, lengths, run_values = get_runs(covered & in_stretch)
+    covered_count = np.concatenate(([0], np.cumsum(covered)))
+    bridged = ~run_values & (
+        covered_count[starts + lengths] - covered_count[starts] == lengths)
+
+    return drop_short_stretches(
+            np.repeat(run_values | bridged, lengths),
+            positions, min_SNPs, min_bp)
+
+
+def get_pair_regions(
+        pair_match_classes,
+        positions,
+        config=None):
+    """
+    Label every SNP of one pair NIR_SEGMENT, HIR_SEGMENT or FIR_SEGMENT,
+    with the SEGMENT_* settings of config.
+    """
+    if config is None:
+        config = get_render_config()
+    noise_tolerance = config.SEGMENT_NOISE_TOLERANCE
+    min_SNPs = config.SEGMENT_MIN_SNPS
+    min_bp = config.SEGMENT_MIN_BP
+
+    half_identical = clean_up_stretches(
+            pair_match_classes != NO_MATCH_SNP,
+            positions, noise_tolerance, min_SNPs, min_bp)
+    fully_identical = clean_up_stretches(
+            (pair_match_classes == FULL_MATCH_SNP) & half_identical,
+            positions, noise_tolerance, min_SNPs, min_bp)
+
+    pair_regions = np.full(len(pair_match_classes), NIR_SEGMENT,
+                           dtype=np.uint8)
+    pair_regions[half_identical] = HIR_SEGMENT
+    pair_regions[fully_identical] = FIR_SEGMENT
+    return pair_regions
+
+
+@timed('segments')
+def find_match_segments(
+        match_table,
+        config=None):
+    """
+    Collapse every pair's match classes into FIR/HIR/NIR segments:
+
+        { 'JUL_ALL_Match' : [ MatchSegment('JUL_ALL_Match', 'HIR', 0, 5123,
+                                           752566, 28512980, 5124),
+                              MatchSegment('JUL_ALL_Match', 'FIR', 5124, ...),
+                            ],
+          'JUL_COL_Match' : [ ... ],
+        }
+    """
+    positions = match_table.positions
+    match_segments = {}
+
+    for pair_label, pair_match_classes in zip(match_table.pair_labels,
+                                              match_table.match_classes):
+        pair_regions = get_pair_regions(
+                pair_match_classes, positions, config)
+        starts, lengths, regions = get_runs(pair_regions)
+        ends = starts + lengths - 1
+
+        match_segments[pair_label] = [
+            MatchSegment(pair_label, SEGMENT_NAMES[region], start, end,
+                         start_position, end_position, SNP_count)
+            for start, end, region, start_position, end_position, SNP_count
+            in zip(starts.tolist(), ends.tolist(), regions.tolist(),
+                   positions[starts].tolist(), positions[ends].tolist(),
+                   lengths.tolist())]
+
+    return match_segments
+
+
+def write_match_segments(
+        match_segments,
+        output_file):
+    "Write the segments of every pair as one tab-separated table"
+    with open(output_file, 'w') as segments_file:
+        segments_file.write('\t'.join(MatchSegment._fields) + '\n')
+        for pair_segments in match_segments.values():
+            for segment in pair_segments:
+                segments_file.write(
+                    '\t'.join(str(value) for value in segment) + '\n')
+
+
+"""
+Match table export.
+
+The MatchTable of a chromosome and its segments as columnar files, for
+tools that want the match classes without running the pipeline again.
+Each family gets a <family>_export directory with one entry per
+chromosome:
+
+    'npz'     : chr7.npz, a compressed numpy archive
+    'npy'     : chr7/<array>.npy, uncompressed, so every array can be
+                opened with np.load(..., mmap_mode='r')
+    'parquet' : chr7.parquet and chr7_segments.parquet, zstd compressed,
+                in row groups of EXPORT_ROW_GROUP_SIZE SNPs  (pyarrow)
+    'arrow'   : chr7.arrow and chr7_segments.arrow, uncompressed Arrow IPC
+                files in batches of EXPORT_ROW_GROUP_SIZE SNPs, ready for
+                pyarrow.memory_map  (pyarrow)
+
+The numpy formats hold these arrays:
+
+    positions               (SNPs,) int32
+    names                   (matches,) str
+    alleles                 (matches, SNPs, 2) uint8, allele letters
+    pair_labels             (pairs,) str
+    match_classes           (pairs, SNPs) uint8, NO/HALF/FULL_MATCH_SNP
+    segment_<field>         one entry per segment, for every MatchSegment
+                            field
+
+The Arrow tables have a 'position' column, one genotype column ('AG')
+per match and one match class column per pair, named from the full names
+('JULIE_ALLISON_Match'); the segment tables have one column per
+MatchSegment field.
+"""
+EXPORT_FORMATS = ('npz', 'npy', 'parquet', 'arrow')
+PYARROW_EXPORT_FORMATS = ('parquet', 'arrow')
+
+
+def get_export_dir(
+        output_dir,
+        all_matches_list):
+    return os.path.join(output_dir, "{0}_export".format(
+        "_".join(all_matches_list)))
+
+
+def get_match_table_arrays(
+        match_table,
+        match_segments):
+    "The arrays of the numpy export formats, by name"
+    segments = [segment for pair_segments in match_segments.values()
+                for segment in pair_segments]
+
+    match_table_arrays = {
+        'positions': np.asarray(match_table.positions, dtype=np.int32),
+        'names': np.array(match_table.names, dtype=str),
+        'alleles': np.asarray(match_table.alleles, dtype=np.uint8),
+        'pair_labels': np.array(match_table.pair_labels, dtype=str),
+        'match_classes': np.asarray(match_table.match_classes,
+                                    dtype=np.uint8),
+    }
+    for field_number, field in enumerate(MatchSegment._fields):
+        field_values = [segment[field_number] for segment in segments]
+        if field in ('pair_label', 'region'):
+            match_table_arrays['segment_' + field] = np.array(
+                    field_values, dtype=str)
+        else:
+            match_table_arrays['segment_' + field] = np.array(
+                    field_values, dtype=np.int64)
+    return match_table_arrays
+
+
+def get_pair_column_names(
+        match_table):
+    "The full-name column of each pair label, e.g. 'JULIE_ALLISON_Match'"
+    names = match_table.names
+    match_pair_combinations = [(name_A, name_B) for name_A in names
+                               for name_B in names if name_A != name_B]
+    pair_column_names = {
+        pair_label: "{0}_{1}_Match".format(*match_pair_combination)
+        for pair_label, match_pair_combination in zip(
+            get_match_pair_labels(match_pair_combinations, names),
+            match_pair_combinations)}
+    return [pair_column_names[pair_label]
+            for pair_label in match_table.pair_labels]
+
+
+def get_match_table_arrow_tables(
+        match_table,
+        match_segments):
+    "(SNP table, segment table) of the Arrow export formats"
+    SNP_columns = {'position': pyarrow.array(match_table.positions)}
+    for name, match_alleles in zip(match_table.names, match_table.alleles):
+        SNP_columns[name] = pyarrow.array(
+                np.ascontiguousarray(match_alleles).view('S2').ravel()
+                .astype('U2'))
+    for pair_column_name, pair_match_classes in zip(
+            get_pair_column_names(match_table), match_table.match_classes):
+        SNP_columns[pair_column_name] = pyarrow.array(pair_match_classes)
+
+    match_table_arrays = get_match_table_arrays(match_table, match_segments)
+    segment_columns = {
+        field: pyarrow.array(match_table_arrays['segment_' + field])
+        for field in MatchSegment._fields}
+
+    return (pyarrow.table(SNP_columns), pyarrow.table(segment_columns))
+
+
+@timed('export')
+def export_match_table(
+        match_table,
+        match_segments,
+        export_dir,
+        chromosome,
+        export_format='npz'):
+    """
+    Write the MatchTable and segments of one chromosome to export_dir in
+    one of the EXPORT_FORMATS.  Returns the names of the files written.
+    """
+    if export_format in PYARROW_EXPORT_FORMATS and pyarrow is None:
+        raise ValueError("the {0} export needs pyarrow".format(export_format))
+
+    os.makedirs(export_dir, exist_ok=True)
+    name = os.path.join(export_dir, "chr{0}".format(chromosome))
+
+    if export_format == 'npz':
+        np.savez_compressed(
+                name + '.npz',
+                **get_match_table_arrays(match_table, match_segments))
+        return [name + '.npz']
+
+    elif export_format == 'npy':
+        os.makedirs(name, exist_ok=True)
+        output_files = []
+        for array_name, match_table_array in get_match_table_arrays(
+                match_table, match_segments).items():
+            output_files.append(os.path.join(name, array_name + '.npy'))
+            np.save(output_files[-1], match_table_array)
+        return output_files
+
+    elif export_format in PYARROW_EXPORT_FORMATS:
+        output_files = [name + '.' + export_format,
+                        name + '_segments.' + export_format]
+        for table, output_file in zip(
+                get_match_table_arrow_tables(match_table, match_segments),
+                output_files):
+            if export_format == 'parquet':
+                pyarrow.parquet.write_table(
+                        table, output_file,
+                        row_group_size=EXPORT_ROW_GROUP_SIZE,
+                        compression='zstd')
             else:
-                match_type = 'noMatchSNP'
+                with pyarrow.ipc.new_file(output_file,
+                                          table.schema) as arrow_file:
+                    arrow_file.write_table(
+                            table, max_chunksize=EXPORT_ROW_GROUP_SIZE)
+        return output_files
 
-            common_key_SNP_dict[SNP][mp_abbr] = match_type
+    raise ValueError("unknown export format {0!r}".format(export_format))
 
-    if FILTER_COMPLETELY_MATCHED_SEGMENTS is True:
 
-        no_across_the_board_matches_SNP_dict = {
-                key: val for key, val
-                in common_key_SNP_dict.items()
-                if key not in useless_because_everything_is_identical_SNP_list}
+def load_exported_match_table(
+        export_path,
+        mmap_mode='r'):
+    """
+    Read back a 'npz' file or 'npy' directory written by export_match_table:
 
-        processed_and_sorted_SNP_dict = OrderedDict(
-            sorted(no_across_the_board_matches_SNP_dict.items()))
+        (MatchTable, { pair label : [MatchSegment, ...] })
 
+    The arrays of a 'npy' directory are memory-mapped with mmap_mode, so
+    only the parts used are ever read from disk.
+    """
+    if os.path.isdir(export_path):
+        def load_array(array_name):
+            return np.load(os.path.join(export_path, array_name + '.npy'),
+                           mmap_mode=mmap_mode)
     else:
-        processed_and_sorted_SNP_dict = OrderedDict(
-            sorted(common_key_SNP_dict.items()))
+        npz_file = np.load(export_path)
+
+        def load_array(array_name):
+            return npz_file[array_name]
+
+    match_table = MatchTable(
+            load_array('positions'),
+            tuple(load_array('names').tolist()),
+            load_array('alleles'),
+            tuple(load_array('pair_labels').tolist()),
+            load_array('match_classes'))
 
-    pp_3(str(inspect.stack()[0][2]),
-         "processed_and_sorted_SNP_dict",
-         take(10, processed_and_sorted_SNP_dict.items()))
+    match_segments = {pair_label: []
+                      for pair_label in match_table.pair_labels}
+    for segment in zip(*(load_array('segment_' + field).tolist()
+                         for field in MatchSegment._fields)):
+        match_segments[segment[0]].append(MatchSegment(*segment))
 
-    return processed_and_sorted_SNP_dict
+    return match_table, match_segments
 
 
 def create_comparison_base_strip_image(
         width,
-        height):
+        height,
+        color):
     comarison_base_strip_image = Image.new(
             'RGB',
             (width, height),
-            color=BACKGROUND_COLOR)
+            color=color)
     return comarison_base_strip_image
 
 
@@ -374,190 +1988,1919 @@ def create_chrom_whole_page_image(
     return chromosome_full_page_image
 
 
-def draw_single_SNP_line(
-        width,
+"""
+Columns of a base-pair axis that hold no SNP at all.
+"""
+NO_SNP_COLUMN = 3
+
+def get_SNP_colors(
+        config):
+    return {
+        NO_MATCH_SNP: config.NO_MATCH_SNP_COLOR,
+        HALF_MATCH_SNP: config.HALF_IDENTICAL_SNP_COLOR,
+        FULL_MATCH_SNP: config.FULLY_IDENTICAL_SNP_COLOR,
+        NO_SNP_COLUMN: config.CHROMOSOME_BASE_COLOR,
+    }
+
+
+def get_SNP_color_lookup_table(
+        config):
+    """
+    One RGB row per possible match class value, so a whole vector of match
+    classes maps to pixel colors with a single fancy-indexing operation.
+    Unknown classes are drawn 'white'.  Built once per set of colors.
+    """
+    return build_SNP_color_lookup_table(
+            tuple(sorted(get_SNP_colors(config).items())))
+
+
+# keyed on the colors alone: a server sees many configs but few colors
+@lru_cache(maxsize=None)
+def build_SNP_color_lookup_table(
+        SNP_colors):
+    SNP_color_lookup_table = np.empty((256, 3), dtype=np.uint8)
+    SNP_color_lookup_table[:] = ImageColor.getrgb('white')
+    for match_class, color in SNP_colors:
+        SNP_color_lookup_table[match_class] = ImageColor.getrgb(color)
+    SNP_color_lookup_table.flags.writeable = False
+    return SNP_color_lookup_table
+
+
+def draw_SNP_lines(
+        pair_match_classes,
         height,
-        color):
-    single_SNP_line = Image.new(
+        config):
+    """
+    Draw one SNP per pixel column for a whole pair at once: the match
+    classes go through the color lookup table into a (height x SNPs x 3)
+    uint8 buffer, which becomes the image without any per-SNP drawing.
+    """
+    SNP_line_colors = get_SNP_color_lookup_table(config)[pair_match_classes]
+    SNP_lines_buffer = np.ascontiguousarray(np.broadcast_to(
+            SNP_line_colors, (height,) + SNP_line_colors.shape))
+    SNP_lines_image = Image.frombuffer(
             'RGB',
-            (width, height),
-            color=color)
-    return single_SNP_line
+            (len(pair_match_classes), height),
+            SNP_lines_buffer.tobytes(),
+            'raw', 'RGB', 0, 1)
+    return SNP_lines_image
 
 
-def show_match_graphics(
-        processed_and_sorted_SNP_dict_table,
-        match_pair_combinations):
-    file_lines = len(processed_and_sorted_SNP_dict_table)
+def draw_comparison_strip(
+        pair_match_classes,
+        config,
+        tickmarks=()):
+    """
+    Build a pair's strip: SNP lines below SPACE_BETWEEN_MATCHES, with the
+    precomputed tickmarks (see get_tickmarks) above them.
+
+    A tick mark drawn at column N reaches into the columns to its right,
+    and those columns used to be painted afterwards, one SNP at a time.
+    To keep the image identical, the SNP lines are pasted in chunks that
+    end at each tick mark column, and the mark is drawn right after its
+    chunk.
+    """
+    file_lines = len(pair_match_classes)
+    HEIGHT_OF_CHROMOSOME_IMAGE = config.HEIGHT_OF_CHROMOSOME_IMAGE
+    SPACE_BETWEEN_MATCHES = config.SPACE_BETWEEN_MATCHES
+
+    comparison_base_strip_image = create_comparison_base_strip_image(
+            file_lines,
+            HEIGHT_OF_CHROMOSOME_IMAGE + SPACE_BETWEEN_MATCHES,
+            config.BACKGROUND_COLOR)
+    count('pixels drawn', file_lines
+          * (HEIGHT_OF_CHROMOSOME_IMAGE + SPACE_BETWEEN_MATCHES))
+
+    if file_lines == 0:
+        return comparison_base_strip_image
+
+    SNP_lines_image = draw_SNP_lines(
+            pair_match_classes, HEIGHT_OF_CHROMOSOME_IMAGE, config)
+
+    if not tickmarks:
+        comparison_base_strip_image.paste(
+                SNP_lines_image, (0, SPACE_BETWEEN_MATCHES))
+        return comparison_base_strip_image
+
+    tickmark_draw = ImageDraw.Draw(comparison_base_strip_image)
+
+    pasted_up_to = 0
+    for base_position, milestone_label in list(tickmarks) + [
+            (file_lines, None)]:
+
+        chunk_end = min(base_position + 1, file_lines)
+        if chunk_end > pasted_up_to:
+            comparison_base_strip_image.paste(
+                    SNP_lines_image.crop(
+                        (pasted_up_to, 0,
+                         chunk_end, HEIGHT_OF_CHROMOSOME_IMAGE)),
+                    (pasted_up_to, SPACE_BETWEEN_MATCHES))
+            pasted_up_to = chunk_end
+
+        if base_position >= file_lines:
+            break
+
+        if milestone_label is not None:
+            tickmark_draw.multiline_text(
+                    (base_position,
+                    SPACE_BETWEEN_MATCHES + config.MILESTONE_VERTICAL_POSITION),
+                    milestone_label,
+                    font=get_font(config.TICKMARK_FONT,
+                                  config.MILESTONE_FONT_SIZE),
+                    fill='black')
+
+        else:
+            tickmark_draw.text(
+                    (base_position,
+                     SPACE_BETWEEN_MATCHES + config.TICKER_VERTICAL_POSITION),
+                    ".",
+                    font=get_font(config.TICKMARK_FONT,
+                                  config.TICKMARK_FONT_SIZE),
+                    fill='black')
+
+    return comparison_base_strip_image
+
+
+"""
+Strip cache.
+
+A comparison strip is fully determined by the match classes of its
+columns, the tick marks on it and the drawing settings, so it is stored
+under a digest of exactly those.  The match classes stand for the pair,
+the chromosome, the common SNP set, the noise filter and the column
+binning at once; a strip therefore comes back for any page that shows the
+same pair over the same columns, whatever the other pairs are.
+
+Strips are kept in memory, least recently used first out beyond
+STRIP_CACHE_MEMORY_BYTES, and as PNG files in the STRIP_CACHE_SUBDIRECTORY
+of the raw file cache, trimmed the same way to STRIP_CACHE_MAX_BYTES.
+Writing a strip file costs more than drawing the strip again, so the
+files only pay off when strips are expensive (very wide pages, slow
+disks); STRIP_CACHE_MAX_BYTES is 0, switching them off, by default.
+"""
+STRIP_CACHE_VERSION = 1
+STRIP_CACHE_SUBDIRECTORY = 'strips'
+
+strip_cache = OrderedDict()
+strip_cache_bytes = 0
+strip_cache_lock = threading.Lock()
+# bytes of strip files on disk as far as this process knows, None until
+# the directory has been scanned once
+strip_cache_file_bytes = None
+
+
+def get_strip_cache_key(
+        pair_match_classes,
+        config,
+        tickmarks):
+    strip_cache_key = hashlib.sha256(repr((
+        STRIP_CACHE_VERSION,
+        sorted(get_SNP_colors(config).items()),
+        config.BACKGROUND_COLOR,
+        config.HEIGHT_OF_CHROMOSOME_IMAGE,
+        config.SPACE_BETWEEN_MATCHES,
+        config.TICKMARK_FONT,
+        config.TICKMARK_FONT_SIZE,
+        config.MILESTONE_FONT_SIZE,
+        config.TICKER_VERTICAL_POSITION,
+        config.MILESTONE_VERTICAL_POSITION,
+        list(tickmarks))).encode('utf-8'))
+    strip_cache_key.update(
+        np.ascontiguousarray(pair_match_classes, dtype=np.uint8).data)
+    return strip_cache_key.hexdigest()
+
+
+def get_strip_cache_dir():
+    cache_dir = get_raw_file_cache_dir()
+    if cache_dir is None or not STRIP_CACHE_MAX_BYTES:
+        return None
+    return os.path.join(cache_dir, STRIP_CACHE_SUBDIRECTORY)
+
+
+def remember_strip_image(
+        strip_cache_key,
+        comparison_base_strip_image):
+    "Keep a strip in memory, dropping the least recently used beyond the limit"
+    global strip_cache_bytes
+
+    strip_bytes = (comparison_base_strip_image.width
+                   * comparison_base_strip_image.height * 3)
+    if strip_bytes > STRIP_CACHE_MEMORY_BYTES:
+        return
+
+    with strip_cache_lock:
+        if strip_cache_key in strip_cache:
+            return
+        strip_cache[strip_cache_key] = comparison_base_strip_image
+        strip_cache_bytes += strip_bytes
+        while strip_cache_bytes > STRIP_CACHE_MEMORY_BYTES:
+            _, evicted_image = strip_cache.popitem(last=False)
+            strip_cache_bytes -= evicted_image.width * evicted_image.height * 3
+
+
+def evict_strip_cache_files(
+        strip_cache_dir,
+        max_bytes):
+    "Delete the least recently used strip files beyond max_bytes; bytes left"
+    strip_files = sorted(
+        (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+        for entry in os.scandir(strip_cache_dir)
+        if entry.is_file() and not entry.name.endswith('.tmp'))
+
+    cache_bytes = sum(file_bytes for _, file_bytes, _ in strip_files)
+    for _, file_bytes, strip_file in strip_files:
+        if cache_bytes <= max_bytes:
+            break
+        try:
+            os.remove(strip_file)
+        except OSError:
+            pass
+        cache_bytes -= file_bytes
+    return cache_bytes
+
+
+def add_strip_cache_file_bytes(
+        strip_cache_dir,
+        file_bytes):
+    """
+    Count a newly written strip file, and only scan the directory once
+    the running total passes STRIP_CACHE_MAX_BYTES.  The scan evicts down
+    to three quarters of that, so it is not repeated for every strip that
+    follows, and picks up the files other processes wrote.
+    """
+    global strip_cache_file_bytes
+
+    with strip_cache_lock:
+        if strip_cache_file_bytes is not None:
+            strip_cache_file_bytes += file_bytes
+            if strip_cache_file_bytes <= STRIP_CACHE_MAX_BYTES:
+                return
+        evict_to_bytes = (STRIP_CACHE_MAX_BYTES
+                          if strip_cache_file_bytes is None
+                          else STRIP_CACHE_MAX_BYTES * 3 // 4)
+
+    cache_bytes = evict_strip_cache_files(strip_cache_dir, evict_to_bytes)
+    with strip_cache_lock:
+        strip_cache_file_bytes = cache_bytes
+
+
+def get_comparison_strip(
+        pair_match_classes,
+        config,
+        tickmarks=()):
+    """
+    draw_comparison_strip, through the strip cache: memory first, then
+    disk, and only then drawn (and stored in both).
+    """
+    strip_cache_key = get_strip_cache_key(
+            pair_match_classes, config, tickmarks)
+
+    with strip_cache_lock:
+        comparison_base_strip_image = strip_cache.get(strip_cache_key)
+        if comparison_base_strip_image is not None:
+            strip_cache.move_to_end(strip_cache_key)
+            count('strips reused')
+            return comparison_base_strip_image
+
+    strip_cache_dir = get_strip_cache_dir()
+    strip_file = strip_cache_dir and os.path.join(
+            strip_cache_dir, "{0}.png".format(strip_cache_key))
+
+    if strip_file and os.path.isfile(strip_file):
+        try:
+            comparison_base_strip_image = Image.open(strip_file)
+            comparison_base_strip_image.load()
+            os.utime(strip_file)
+            count('strips reused')
+        except OSError:
+            comparison_base_strip_image = None
+
+    if comparison_base_strip_image is None:
+        comparison_base_strip_image = draw_comparison_strip(
+                pair_match_classes,
+                config,
+                tickmarks)
+
+        # a chromosome without common SNPs draws an empty strip, which
+        # PNG cannot hold
+        if strip_file and comparison_base_strip_image.width:
+            os.makedirs(strip_cache_dir, exist_ok=True)
+            temporary_file_name = "{0}.{1}.{2}.tmp".format(
+                    strip_file, os.getpid(), threading.get_ident())
+            comparison_base_strip_image.save(
+                    temporary_file_name, 'PNG', compress_level=1)
+            file_bytes = os.path.getsize(temporary_file_name)
+            os.replace(temporary_file_name, strip_file)
+            add_strip_cache_file_bytes(strip_cache_dir, file_bytes)
+
+    remember_strip_image(strip_cache_key, comparison_base_strip_image)
+
+    return comparison_base_strip_image
+
+
+"""
+Axis modes.
+
+    'snp' : columns follow the SNPs in order; a milestone (the position in
+            Mb) every MILESTONE_SPACING columns and a ticker dot every
+            TICKER_SPACING columns
+    'bp'  : columns are fixed base-pair windows starting at position 0, so
+            the same place on a chromosome is at the same x for every kit;
+            a milestone every MILESTONE_BP_SPACING and a ticker every
+            TICKER_BP_SPACING base pairs
+
+Chromosome lengths (GRCh37, the build used by the vendor raw files) give
+every bp-axis page of a chromosome the same width.
+"""
+AXIS_MODES = ('snp', 'bp')
+
+CHROMOSOME_LENGTHS = {
+    1: 249250621, 2: 243199373, 3: 198022430, 4: 191154276,
+    5: 180915260, 6: 171115067, 7: 159138663, 8: 146364022,
+    9: 141213431, 10: 135534747, 11: 135006516, 12: 133851895,
+    13: 115169878, 14: 107349540, 15: 102531392, 16: 90354753,
+    17: 81195210, 18: 78077248, 19: 59128983, 20: 63025520,
+    21: 48129895, 22: 51304566,
+}
+
+
+def get_tickmarks(
+        column_positions,
+        config,
+        bp_per_pixel=None):
+    """
+    Work out every tick mark of a page once, before anything is drawn:
+
+        [ (column, "12.3\n|"), (column, None), ... ]
+
+    in column order, a label for milestones and None for ticker dots.
+    column_positions holds the first position of every column; on the
+    'bp' axis every column is bp_per_pixel base pairs wide.
+    """
+    column_count = len(column_positions)
+    if column_count == 0:
+        return []
+
+    if config.AXIS_MODE == 'snp':
+        milestone_columns = np.arange(
+                0, column_count, config.MILESTONE_SPACING)
+        ticker_columns = np.arange(0, column_count, config.TICKER_SPACING)
+        milestone_positions = column_positions[milestone_columns]
 
-    if FILTER_COMPLETELY_MATCHED_SEGMENTS:
-        title = "Pixel View Raw SNPs for Chr {0} -- filtered".format(
-            CHROMOSOME_TO_RENDER)
     else:
-        title = "Pixel View Raw SNPs for Chr {0} -- unfiltered".format(
-            CHROMOSOME_TO_RENDER)
+        axis_end = int(column_positions[-1]) + bp_per_pixel
+        milestone_positions = np.arange(
+                0, axis_end, config.MILESTONE_BP_SPACING)
+        milestone_columns = np.searchsorted(
+                column_positions, milestone_positions, side='right') - 1
+        ticker_columns = np.searchsorted(
+                column_positions,
+                np.arange(0, axis_end, config.TICKER_BP_SPACING),
+                side='right') - 1
+
+    milestone_labels = {
+        column: "{:0.1f}\n|".format(position / 1000000)
+        for column, position in zip(milestone_columns.tolist(),
+                                    milestone_positions.tolist())}
+
+    return [(column, milestone_labels.get(column))
+            for column in np.union1d(milestone_columns,
+                                     ticker_columns).tolist()]
+
+
+def get_bp_columns(
+        match_table,
+        bp_per_pixel,
+        chromosome_length=0,
+        aggregate='majority'):
+    """
+    Bin the SNPs of a MatchTable into fixed windows of bp_per_pixel base
+    pairs, starting at position 0 and running to chromosome_length (or the
+    last SNP, if further).  Window edges are found by binary search over
+    the sorted positions.
 
-    matches_to_show = len(match_pair_combinations)
-    chrom_whole_page_image = create_chrom_whole_page_image(
+    Returns (column positions, column match classes) like
+    get_match_columns; windows without SNPs get NO_SNP_COLUMN.
+    """
+    positions = match_table.positions
+
+    axis_end = max(chromosome_length,
+                   int(positions[-1]) + 1 if len(positions) else 1)
+    column_positions = np.arange(0, axis_end, bp_per_pixel, dtype=np.int64)
+    column_edges = np.searchsorted(
+            positions, np.append(column_positions, axis_end))
+
+    pair_count = len(match_table.pair_labels)
+    column_counts = np.empty(
+            (pair_count, len(column_positions), MATCH_CLASS_COUNT),
+            dtype=np.int64)
+    for match_class in range(MATCH_CLASS_COUNT):
+        class_running_total = np.zeros(
+                (pair_count, len(positions) + 1), dtype=np.int64)
+        np.cumsum(match_table.match_classes == match_class, axis=1,
+                  out=class_running_total[:, 1:])
+        column_counts[..., match_class] = (
+            class_running_total[:, column_edges[1:]]
+            - class_running_total[:, column_edges[:-1]])
+
+    column_match_classes = aggregate_match_class_counts(
+            column_counts, aggregate)
+    column_match_classes[:, column_edges[1:] == column_edges[:-1]] = \
+        NO_SNP_COLUMN
+
+    return column_positions, column_match_classes
 
-            max((file_lines
-                 + CHROM_PAGE_LEFT_BORDER
-                 + CHROM_PAGE_RIGHT_BORDER),
-                MINIMUM_PAGE_WIDTH),
 
-            (CHROM_PAGE_TOP_BORDER
-            + CHROM_PAGE_BOTTOM_BORDER
-            + CHROM_PAGE_TITLE_SPACE)
-                + (matches_to_show * (
-                    HEIGHT_OF_CHROMOSOME_IMAGE
-                    + SPACE_BETWEEN_MATCHES)),
+"""
+Level of detail.
 
-            BACKGROUND_COLOR)
+With a target page width, several SNPs share one pixel column.  Each
+column shows one class for all of its SNPs, picked by an aggregate:
 
-    lp_3(str(inspect.stack()[0][2]), "matches_to_show", str(matches_to_show))
+    'majority' : the most common class in the column (ties go to the
+                 worse class)
+    'worst'    : the worst class present (noMatch over halfMatch over
+                 fullMatch), so no single mismatch disappears
 
-    page_draw = ImageDraw.Draw(chrom_whole_page_image)
-    page_draw.text((CHROM_PAGE_LEFT_BORDER, CHROM_PAGE_TOP_BORDER), title,
-            font=ImageFont.truetype(os.path.join(font_library_path, "Arial Bold.ttf"),
-                                    CHROM_TITLE_TEXT_FONT_SIZE), fill='black')
+Columns are built from a pyramid of class counts.  Level k holds, for
+every block of 2**k consecutive SNPs, how many are noMatch, halfMatch
+and fullMatch.  A page is drawn from the coarsest level whose blocks are
+no wider than one column, so the work is proportional to the number of
+output columns, not to the number of SNPs.
+"""
+COLUMN_AGGREGATES = ('majority', 'worst')
+MATCH_CLASS_COUNT = 3
 
-    match_shown_number = 0
-    FLAG_TICKMARKS_ARE_PRINTED = False
 
-    for match_pair_combination in match_pair_combinations:
+def get_match_class_counts(
+        match_classes,
+        class_count=MATCH_CLASS_COUNT):
+    "(pairs, SNPs) classes to (pairs, SNPs, class_count) one-hot counts"
+    return (match_classes[..., None]
+            == np.arange(class_count, dtype=np.uint8)).astype(np.uint16)
+
+
+def build_match_class_pyramid(
+        match_classes,
+        class_count=MATCH_CLASS_COUNT):
+    """
+    Precompute the count pyramid of a (pairs, SNPs) match class matrix:
+    a list whose entry k - 1 is the (pairs, ceil(SNPs / 2**k), class_count)
+    array of counts of level k, up to the level with a single block.
+    """
+    match_class_pyramid = []
+    level_counts = get_match_class_counts(match_classes, class_count)
+
+    while level_counts.shape[1] > 1:
+        if level_counts.shape[1] % 2:
+            level_counts = np.concatenate(
+                    (level_counts,
+                     np.zeros(level_counts.shape[:1] + (1, class_count),
+                              dtype=level_counts.dtype)), axis=1)
+        if (len(match_class_pyramid) + 1 == 16
+                and level_counts.dtype == np.uint16):
+            level_counts = level_counts.astype(np.uint32)
+        level_counts = level_counts[:, 0::2] + level_counts[:, 1::2]
+        match_class_pyramid.append(level_counts)
+
+    return match_class_pyramid
+
+
+def aggregate_match_class_counts(
+        column_counts,
+        aggregate):
+    if aggregate == 'majority':
+        return np.argmax(column_counts, axis=-1).astype(np.uint8)
+    elif aggregate == 'worst':
+        return np.argmax(column_counts > 0, axis=-1).astype(np.uint8)
+    raise ValueError("unknown column aggregate {0!r}".format(aggregate))
+
+
+def get_match_columns(
+        match_table,
+        columns,
+        aggregate='majority',
+        match_class_pyramid=None):
+    """
+    Bin the SNPs of a MatchTable into at most columns pixel columns.
+
+    Returns (column positions, column match classes): the position of the
+    first SNP of every column and the (pairs, columns) aggregated classes.
+    With no more SNPs than columns, the SNPs are returned unchanged.
+    """
+    SNP_count = len(match_table.positions)
+    if SNP_count <= columns:
+        return match_table.positions, match_table.match_classes
+
+    level = int(np.log2(SNP_count / columns))
+    if level == 0:
+        level_counts = get_match_class_counts(match_table.match_classes)
+    else:
+        if match_class_pyramid is None:
+            match_class_pyramid = build_match_class_pyramid(
+                    match_table.match_classes)
+        level = min(level, len(match_class_pyramid))
+        level_counts = match_class_pyramid[level - 1]
+
+    column_edges = (np.arange(columns, dtype=np.int64)
+                    * SNP_count) // columns
+    block_edges = column_edges >> level
+
+    column_counts = np.add.reduceat(level_counts, block_edges, axis=1)
+
+    return (match_table.positions[block_edges << level],
+            aggregate_match_class_counts(column_counts, aggregate))
 
 
-        mp_abbr = "{0}_{1}_Match".format(match_pair_combination[0][:3],
-                                         match_pair_combination[1][:3])
+def get_match_class_pyramid(
+        match_table,
+        config=None):
+    """
+    The count pyramid that pages of match_table are binned from under
+    config, or None when they need none (one column per SNP, or the 'bp'
+    axis).  Building it takes a pass over every SNP, so it is built once
+    per MatchTable and handed to every page drawn from it.
+    """
+    if config is None:
+        config = get_render_config()
+    if config.AXIS_MODE != 'snp' or not config.TARGET_PAGE_WIDTH:
+        return None
+    return build_match_class_pyramid(match_table.match_classes)
+
+
+def get_page_columns(
+        match_table,
+        chromosome,
+        config,
+        match_class_pyramid=None):
+    """
+    The pixel columns of a page, as show_match_graphics lays them out:
 
-        base_position = 0
+        (column positions, (pairs, columns) column match classes,
+         bp per pixel of the 'bp' axis)
+    """
+    page_width = config.TARGET_PAGE_WIDTH
+    aggregate = config.COLUMN_AGGREGATE
+    bp_per_pixel = config.BP_PER_PIXEL
+
+    strip_width = max((page_width or 0)
+                      - config.CHROM_PAGE_LEFT_BORDER
+                      - config.CHROM_PAGE_RIGHT_BORDER, 1)
+
+    if config.AXIS_MODE == 'bp':
+        chromosome_length = CHROMOSOME_LENGTHS.get(chromosome, 0)
+        if page_width:
+            bp_per_pixel = -(-max(chromosome_length,
+                                  int(match_table.positions[-1]) + 1
+                                  if len(match_table.positions) else 1)
+                             // strip_width)
+        column_positions, column_match_classes = get_bp_columns(
+                match_table,
+                bp_per_pixel,
+                chromosome_length,
+                aggregate)
+
+    elif page_width:
+        column_positions, column_match_classes = get_match_columns(
+                match_table,
+                strip_width,
+                aggregate,
+                match_class_pyramid)
+    else:
+        column_positions = match_table.positions
+        column_match_classes = match_table.match_classes
+
+    return column_positions, column_match_classes, bp_per_pixel
+
+
+def get_page_title(
+        chromosome,
+        config):
+    if config.FILTER_COMPLETELY_MATCHED_SEGMENTS:
+        return "Pixel View Raw SNPs for Chr {0} -- filtered".format(
+            chromosome)
+    return "Pixel View Raw SNPs for Chr {0} -- unfiltered".format(chromosome)
+
+
+def get_page_size(
+        file_lines,
+        matches_to_show,
+        config):
+    "(width, height) of a page: file_lines columns, matches_to_show strips"
+    return (max((file_lines
+                 + config.CHROM_PAGE_LEFT_BORDER
+                 + config.CHROM_PAGE_RIGHT_BORDER),
+                config.MINIMUM_PAGE_WIDTH),
+
+            (config.CHROM_PAGE_TOP_BORDER
+             + config.CHROM_PAGE_BOTTOM_BORDER
+             + config.CHROM_PAGE_TITLE_SPACE)
+            + (matches_to_show * (
+                config.HEIGHT_OF_CHROMOSOME_IMAGE
+                + config.SPACE_BETWEEN_MATCHES)))
+
+
+def get_strip_top(
+        match_shown_number,
+        config):
+    "Where the strip of the match_shown_number-th pair starts on the page"
+    return (config.CHROM_PAGE_TOP_BORDER + config.CHROM_PAGE_TITLE_SPACE
+            + (match_shown_number * (
+                config.HEIGHT_OF_CHROMOSOME_IMAGE
+                + config.SPACE_BETWEEN_MATCHES)))
+
+
+@timed('render')
+def show_match_graphics(
+        match_table,
+        match_pair_combinations,
+        chromosome,
+        config=None,
+        match_class_pyramid=None,
+        strip_images=None):
+    """
+    Draw the page for one chromosome.
+
+    On the 'snp' axis, without a TARGET_PAGE_WIDTH every SNP gets its own
+    pixel column; with one, the SNPs are binned into the columns that fit
+    (see get_match_columns).  On the 'bp' axis every column is
+    BP_PER_PIXEL base pairs wide, or as wide as makes the chromosome fit
+    TARGET_PAGE_WIDTH.  Without a config, the pixel_config settings are
+    used.
+
+    strip_images, if given, is a dict of comparison strips from an earlier
+    page with exactly the same columns, keyed on (pair label, tick marks
+    drawn); strips found there are reused and new ones are added to it.
+    """
+    if config is None:
+        config = get_render_config()
 
-        comparison_base_strip_image = create_comparison_base_strip_image(
-                file_lines, HEIGHT_OF_CHROMOSOME_IMAGE + SPACE_BETWEEN_MATCHES)
+    CHROM_PAGE_LEFT_BORDER = config.CHROM_PAGE_LEFT_BORDER
+    CHROM_PAGE_TOP_BORDER = config.CHROM_PAGE_TOP_BORDER
 
-        tickmark_draw = ImageDraw.Draw(comparison_base_strip_image)
+    column_positions, column_match_classes, bp_per_pixel = get_page_columns(
+            match_table,
+            chromosome,
+            config,
+            match_class_pyramid)
 
-        for SNP in processed_and_sorted_SNP_dict_table:
+    file_lines = len(column_positions)
+    tickmarks = get_tickmarks(column_positions, config, bp_per_pixel)
+    title = get_page_title(chromosome, config)
 
-            relevant_match = processed_and_sorted_SNP_dict_table[SNP][mp_abbr]
-            color = 'white'
-            if relevant_match == 'noMatchSNP':
-                color = NO_MATCH_SNP_COLOR
-            elif relevant_match == 'halfMatchSNP':
-                color = HALF_IDENTICAL_SNP_COLOR
-            elif relevant_match == 'fullMatchSNP':
-                color = FULLY_IDENTICAL_SNP_COLOR
+    matches_to_show = len(match_pair_combinations)
+    chrom_whole_page_image = create_chrom_whole_page_image(
+            *get_page_size(file_lines, matches_to_show, config),
+            config.BACKGROUND_COLOR)
 
-            paste_position = (base_position, SPACE_BETWEEN_MATCHES)
+    lp_3("matches_to_show", str(matches_to_show))
 
-            single_pixel_line = draw_single_SNP_line(WIDTH_OF_SNP_LINE,
-                    HEIGHT_OF_CHROMOSOME_IMAGE, color)
+    page_draw = ImageDraw.Draw(chrom_whole_page_image)
+    page_draw.text((CHROM_PAGE_LEFT_BORDER, CHROM_PAGE_TOP_BORDER), title,
+            font=get_font("Arial Bold.ttf", config.CHROM_TITLE_TEXT_FONT_SIZE),
+            fill='black')
 
-            comparison_base_strip_image.paste(single_pixel_line,
-                    (paste_position))
+    match_shown_number = 0
+    FLAG_TICKMARKS_ARE_PRINTED = False
 
-            if FLAG_TICKMARKS_ARE_PRINTED is False:
-                
+    for mp_abbr in get_match_pair_labels(match_pair_combinations,
+                                         match_table.names):
 
-                if base_position % MILESTONE_SPACING == 0:
-                    tickmark_draw.multiline_text(
-                            (base_position,
-                            SPACE_BETWEEN_MATCHES + MILESTONE_VERTICAL_POSITION),
-                            "{:0.1f}\n|".format(SNP / 1000000),
-                            font=ImageFont.truetype(
-                                    os.path.join(font_library_path,
-                                                 "Arial.ttf"),
-                                    MILESTONE_FONT_SIZE), fill='black')
-                    
-                elif base_position % TICKER_SPACING == 0:
-                    tickmark_draw.text(
-                            (base_position,
-                             SPACE_BETWEEN_MATCHES + TICKER_VERTICAL_POSITION),
-                            ".",
-                            font=ImageFont.truetype(
-                                os.path.join(font_library_path, "Arial.ttf"),
-                                TICKMARK_FONT_SIZE), fill='black')
+        pair_match_classes = column_match_classes[
+            match_table.pair_labels.index(mp_abbr)]
 
-            base_position += 1
+        strip_key = (mp_abbr, FLAG_TICKMARKS_ARE_PRINTED is False)
+        if strip_images is not None and strip_key in strip_images:
+            comparison_base_strip_image = strip_images[strip_key]
+        else:
+            comparison_base_strip_image = get_comparison_strip(
+                    pair_match_classes,
+                    config,
+                    tickmarks if FLAG_TICKMARKS_ARE_PRINTED is False else ())
+            if strip_images is not None:
+                strip_images[strip_key] = comparison_base_strip_image
 
         chrom_whole_page_image.paste(
                 comparison_base_strip_image,
-
                 (CHROM_PAGE_LEFT_BORDER,
-
-                (CHROM_PAGE_TOP_BORDER + CHROM_PAGE_TITLE_SPACE
-                    + (match_shown_number * (
-                        HEIGHT_OF_CHROMOSOME_IMAGE
-                        + SPACE_BETWEEN_MATCHES)))))
+                 get_strip_top(match_shown_number, config)))
 
         draw = ImageDraw.Draw(chrom_whole_page_image)
 
-        arial = ImageFont.truetype(
-                os.path.join(font_library_path,
-                             "Arial Bold.ttf"),
-                CHROM_MATCH_TEXT_FONT_SIZE)
+        arial = get_font("Arial Bold.ttf", config.CHROM_MATCH_TEXT_FONT_SIZE)
 
         draw.text((
-                CHROM_PAGE_TEXT_BORDER,
-
-                (CHROM_PAGE_TOP_BORDER
-                    + CHROM_PAGE_TITLE_SPACE
-                    + (match_shown_number
-                       * (HEIGHT_OF_CHROMOSOME_IMAGE
-                            + SPACE_BETWEEN_MATCHES)))),
-
+                config.CHROM_PAGE_TEXT_BORDER,
+                get_strip_top(match_shown_number, config)),
                 mp_abbr, font=arial, fill='black')
 
         match_shown_number += 1
         FLAG_TICKMARKS_ARE_PRINTED = True
 
-    chrom_whole_page_image.show()
+    return chrom_whole_page_image
 
 
-if __name__ == '__main__':
+def get_chromosome_match_table(
+        chromosome,
+        match_pair_combinations,
+        all_matches_list,
+        raw_data_by_match=None,
+        config=None):
+    """
+    Run the data side of the pipeline for one chromosome: MatchTable.
+    """
+    match_genotypes = \
+        get_match_pixel_dicts_for_siblings_to_render(
+            chromosome,
+            all_matches_list,
+            raw_data_by_match)
+
+    common_SNPs = \
+        get_common_keys(
+                match_genotypes)
+
+    common_genotypes = \
+        get_common_key_SNP_dict(
+                common_SNPs,
+                match_genotypes)
+
+    match_table = \
+        insert_combo_match_type_into_common_key_SNP_dict(
+            common_genotypes,
+            match_pair_combinations,
+            config)
 
-    def get_valid_chromosome_number():
-        global CHROMOSOME_TO_RENDER
-        SUGGESTED_CHROMOSOME_TO_RENDER = input("""
-            "Enter a valid chromosome number to process 1-22  
-            
-            or type 'quit' to exit program     """)
+    return match_table
 
-        if SUGGESTED_CHROMOSOME_TO_RENDER == 'quit':
-            print("goodbye")
-            sys.exit()
 
-        elif SUGGESTED_CHROMOSOME_TO_RENDER in [str(i) for i in range(1, 23)]:
-            CHROMOSOME_TO_RENDER = int(SUGGESTED_CHROMOSOME_TO_RENDER)
+def render_chromosome(
+        chromosome,
+        match_pair_combinations,
+        all_matches_list,
+        raw_data_by_match=None,
+        config=None):
+    """
+    Run the whole pipeline for one chromosome and return the page image.
+    """
+    match_table = get_chromosome_match_table(
+            chromosome,
+            match_pair_combinations,
+            all_matches_list,
+            raw_data_by_match,
+            config)
+
+    return show_match_graphics(
+            match_table,
+            match_pair_combinations,
+            chromosome,
+            config)
+
+
+def render_all_chromosomes(
+        match_pair_combinations,
+        all_matches_list,
+        chromosomes=AUTOSOMES,
+        data_dir_name=None,
+        config=None):
+    """
+    Batch mode: parse each raw file once, then render every chromosome
+    from that single parse.
+    Yields (chromosome, MatchTable, count pyramid or None, page image) for
+    each chromosome; the pyramid can be handed on to save_chromosome_outputs.
+    """
+    raw_data_by_match = load_raw_data_for_all_matches(
+            all_matches_list,
+            data_dir_name)
+
+    for chromosome in chromosomes:
+        match_table = get_chromosome_match_table(
+                chromosome,
+                match_pair_combinations,
+                all_matches_list,
+                raw_data_by_match,
+                config)
+        match_class_pyramid = get_match_class_pyramid(match_table, config)
+
+        yield chromosome, match_table, match_class_pyramid, \
+            show_match_graphics(
+                match_table,
+                match_pair_combinations,
+                chromosome,
+                config,
+                match_class_pyramid)
+
+
+"""
+Incremental re-render.
+
+Adding a sibling or an extra match to a family that is already on screen
+only ever narrows the common SNP set, so the earlier work still holds:
+
+    - parsed kits are kept, only the new kit is read
+    - the common positions are intersected with the new kit alone, and
+      every earlier match's alleles are cut down to the surviving SNPs
+    - match classes of earlier pairs are cut down the same way; only the
+      pairs with the new match are classified
+    - a chromosome's MatchTable and count pyramid are kept until the
+      family changes
+    - comparison strips are reused while a chromosome's columns stay
+      the same
+
+Match classes are kept for every common SNP, before the noise filter,
+since a new match can bring back SNPs the filter dropped before.
+
+Per chromosome state:
+
+    RenderState(
+        positions=array([ 752566,  776546, ...]),
+        names=('JULIE', 'ALLISON'),
+        alleles=array(...),                          <- (names, positions, 2)
+        pair_classes={ ('JULIE', 'ALLISON') : array([1, 2, 2, ...]) })
+"""
+RenderState = namedtuple(
+        'RenderState',
+        ['positions', 'names', 'alleles', 'pair_classes'])
+
+
+class IncrementalRenderSession(object):
+    """
+    One family, rendered chromosome by chromosome, that can grow:
+
+        session = IncrementalRenderSession(['JULIE', 'ALLISON'])
+        session.render(7).show()
+        session.add_sibling('COLLETTE')
+        session.render(7).show()         <- only COLLETTE's pairs are new
+
+    Without a config, the pixel_config settings are used, as for
+    show_match_graphics.
+    """
 
+    def __init__(self,
+                 siblings_to_render,
+                 extra_match='',
+                 data_dir_name=None,
+                 config=None):
+        self.siblings_to_render = list(siblings_to_render)
+        self.extra_match = extra_match or ''
+        self.data_dir_name = data_dir_name
+        self.config = config if config is not None else get_render_config()
+
+        self.raw_data_by_match = {}
+        self._render_states = {}
+        self._match_tables = {}
+        self._strip_images = {}
+
+        self._load_kits(self.get_match_pair_combinations()[1])
+
+    def get_match_pair_combinations(self):
+        "(match_pair_combinations, all_matches_list) of the family as it is now"
+        return get_match_pair_combinations(
+                list(self.siblings_to_render),
+                self.extra_match)
+
+    def _load_kits(self, names):
+        new_names = [name for name in names
+                     if name not in self.raw_data_by_match]
+        if new_names:
+            self.raw_data_by_match.update(load_raw_data_for_all_matches(
+                    new_names,
+                    self.data_dir_name))
+
+    def add_sibling(self, name):
+        if name in self.siblings_to_render or name == self.extra_match:
+            raise ValueError("{0} is already rendered".format(name))
+
+        self._load_kits([name])
+        self.siblings_to_render.append(name)
+        self._add_match_to_render_states(name)
+
+    def set_extra_match(self, name):
+        """
+        Add the extra match, or swap it for another one.  Swapping widens the
+        common SNP set again, so then every chromosome starts over from the
+        parsed kits.
+        """
+        if name == self.extra_match:
+            return
+        if name in self.siblings_to_render:
+            raise ValueError("{0} is already rendered".format(name))
+
+        self._load_kits([name])
+        if self.extra_match:
+            self._render_states.clear()
+            self._match_tables.clear()
+            self._strip_images.clear()
+            self.extra_match = name
         else:
-            get_valid_chromosome_number()
+            self.extra_match = name
+            self._add_match_to_render_states(name)
+
+    def _add_match_to_render_states(self, name):
+        self._match_tables.clear()
+        for chromosome, render_state in list(self._render_states.items()):
+            chromosome_genotypes = self.raw_data_by_match[name][chromosome]
+
+            positions, kept, new_indices = np.intersect1d(
+                    render_state.positions,
+                    chromosome_genotypes.positions,
+                    assume_unique=True,
+                    return_indices=True)
+
+            names = render_state.names + (name,)
+            alleles = np.concatenate(
+                    (render_state.alleles[:, kept],
+                     chromosome_genotypes.alleles[new_indices][np.newaxis]))
+            pair_classes = {
+                match_pair_combination: match_classes[kept]
+                for match_pair_combination, match_classes
+                in render_state.pair_classes.items()}
+
+            self._render_states[chromosome] = self._classify_new_pairs(
+                    RenderState(positions, names, alleles, pair_classes))
+
+    def _classify_new_pairs(self, render_state):
+        name_rows = {name: row for row, name in enumerate(render_state.names)}
+        new_pairs = [match_pair_combination for match_pair_combination
+                     in self.get_match_pair_combinations()[0]
+                     if match_pair_combination
+                     not in render_state.pair_classes]
+
+        match_classes = classify_match_pairs(
+                render_state.alleles,
+                [(name_rows[match_pair_combination[0]],
+                  name_rows[match_pair_combination[1]])
+                 for match_pair_combination in new_pairs],
+                ())[0]
+        render_state.pair_classes.update(zip(new_pairs, match_classes))
+
+        lp_3("new pairs", str(new_pairs))
+
+        return render_state
+
+    def _get_render_state(self, chromosome):
+        render_state = self._render_states.get(chromosome)
+        if render_state is None:
+            match_genotypes = get_match_pixel_dicts_for_siblings_to_render(
+                    chromosome,
+                    self.get_match_pair_combinations()[1],
+                    self.raw_data_by_match)
+            common_genotypes = get_common_key_SNP_dict(
+                    get_common_keys(match_genotypes),
+                    match_genotypes)
+            render_state = self._classify_new_pairs(RenderState(
+                    common_genotypes.positions,
+                    common_genotypes.names,
+                    common_genotypes.alleles,
+                    {}))
+            self._render_states[chromosome] = render_state
+        return render_state
+
+    def get_match_table(self, chromosome):
+        "The MatchTable of one chromosome, as get_chromosome_match_table"
+        render_state = self._get_render_state(chromosome)
+        match_pair_combinations, all_matches_list = \
+            self.get_match_pair_combinations()
+
+        rows = [render_state.names.index(name) for name in all_matches_list]
+        alleles = render_state.alleles[rows]
+
+        if self.config.FILTER_COMPLETELY_MATCHED_SEGMENTS is True:
+            kept = get_varying_SNPs(alleles, range(len(rows)))
+            count('SNPs filtered',
+                  len(kept) - int(np.count_nonzero(kept)))
+        else:
+            kept = slice(None)
+
+        # a family of one has no pairs yet
+        match_classes = np.empty(
+                (len(match_pair_combinations), len(render_state.positions)),
+                dtype=np.uint8)
+        for pair_row, match_pair_combination in enumerate(
+                match_pair_combinations):
+            match_classes[pair_row] = \
+                render_state.pair_classes[match_pair_combination]
+
+        return MatchTable(
+                render_state.positions[kept],
+                tuple(all_matches_list),
+                alleles[:, kept],
+                get_match_pair_labels(match_pair_combinations,
+                                      all_matches_list),
+                match_classes[:, kept])
+
+    def _get_match_table_and_pyramid(self, chromosome):
+        "The MatchTable of one chromosome and its count pyramid, kept"
+        match_table_and_pyramid = self._match_tables.get(chromosome)
+        if match_table_and_pyramid is None:
+            match_table = self.get_match_table(chromosome)
+            match_table_and_pyramid = (
+                match_table, get_match_class_pyramid(match_table, self.config))
+            self._match_tables[chromosome] = match_table_and_pyramid
+        return match_table_and_pyramid
+
+    def _get_strip_images(self, chromosome, match_table):
+        "Strips drawn for this chromosome, if its columns are unchanged"
+        positions, strip_images = self._strip_images.get(chromosome,
+                                                         (None, None))
+        if positions is None or not np.array_equal(positions,
+                                                   match_table.positions):
+            strip_images = {}
+            self._strip_images[chromosome] = (match_table.positions,
+                                              strip_images)
+        return strip_images
+
+    def render(self, chromosome):
+        "Render one chromosome and return the page image"
+        match_table, match_class_pyramid = \
+            self._get_match_table_and_pyramid(chromosome)
+
+        return show_match_graphics(
+                match_table,
+                self.get_match_pair_combinations()[0],
+                chromosome,
+                self.config,
+                match_class_pyramid,
+                strip_images=self._get_strip_images(chromosome, match_table))
 
-    get_valid_chromosome_number()
 
-    match_pair_combinations, all_matches_list \
-        = get_match_pair_combinations(
-            siblings_to_render,
-            extra_match)
+"""
+Output formats for headless runs.  PNG compression is zlib level 0-9;
+WebP is written losslessly, so the compression level is its method 0-6.
+"""
+OUTPUT_FORMATS = {
+    'png': {'format': 'PNG', 'compression_option': 'compress_level',
+            'default_compression': 6, 'max_compression': 9,
+            'options': {}},
+    'webp': {'format': 'WEBP', 'compression_option': 'method',
+             'default_compression': 4, 'max_compression': 6,
+             'options': {'lossless': True, 'quality': 100}},
+}
+
+
+def get_output_file_name(
+        all_matches_list,
+        chromosome,
+        image_format,
+        suffix=''):
+    return "{0}_chr{1}{2}.{3}".format(
+            "_".join(all_matches_list), chromosome, suffix, image_format)
+
+
+@timed('encode')
+def save_match_graphics(
+        chrom_whole_page_image,
+        output_file,
+        image_format='png',
+        compression_level=None):
+    """
+    Write a rendered page straight to disk instead of opening a viewer.
+    """
+    output_format = OUTPUT_FORMATS[image_format]
+    if compression_level is None:
+        compression_level = output_format['default_compression']
 
-    match_SNP_values_dict = \
-        get_match_pixel_dicts_for_siblings_to_render(
-            all_matches_list)
+    save_options = dict(output_format['options'])
+    save_options[output_format['compression_option']] = compression_level
 
-    common_SNP_keys = \
-        get_common_keys(
-                match_SNP_values_dict)
+    chrom_whole_page_image.save(
+            output_file, output_format['format'], **save_options)
 
-    common_key_SNP_dict = \
-        get_common_key_SNP_dict(
-                common_SNP_keys,
-                match_SNP_values_dict)
 
-    processed_and_sorted_SNP_dict_table = \
-        insert_combo_match_type_into_common_key_SNP_dict(
-            common_key_SNP_dict,
-            match_pair_combinations)
+def share_raw_data(
+        raw_data_by_match):
+    """
+    Copy every match's parsed chromosomes into one block of shared memory
+    per match, so worker processes can map the arrays instead of receiving
+    pickled copies.
+
+    Returns the SharedMemory blocks (the caller must close and unlink
+    them) and a small picklable layout description:
+
+        { match_name : ( shared_memory_name,
+                         { chromosome : ( positions_offset,
+                                          alleles_offset,
+                                          SNP_count ), } ), }
+    """
+    shared_memory_blocks = []
+    shared_raw_data_layout = {}
+
+    for known_relative, genotypes_by_chromosome in raw_data_by_match.items():
+        chromosomes = sorted(genotypes_by_chromosome)
+        SNP_counts = [len(genotypes_by_chromosome[chromosome].positions)
+                      for chromosome in chromosomes]
+        positions_bytes = sum(SNP_counts) * np.dtype(np.int32).itemsize
+
+        shared_block = shared_memory.SharedMemory(
+                create=True, size=max(positions_bytes + sum(SNP_counts) * 2, 1))
+        shared_memory_blocks.append(shared_block)
+
+        chromosome_layout = {}
+        positions_offset = 0
+        alleles_offset = positions_bytes
+        for chromosome, SNP_count in zip(chromosomes, SNP_counts):
+            genotypes = genotypes_by_chromosome[chromosome]
+            np.ndarray((SNP_count,), dtype=np.int32, buffer=shared_block.buf,
+                       offset=positions_offset)[:] = genotypes.positions
+            np.ndarray((SNP_count, 2), dtype=np.uint8, buffer=shared_block.buf,
+                       offset=alleles_offset)[:] = genotypes.alleles
+
+            chromosome_layout[chromosome] = (
+                positions_offset, alleles_offset, SNP_count)
+            positions_offset += SNP_count * np.dtype(np.int32).itemsize
+            alleles_offset += SNP_count * 2
+
+        shared_raw_data_layout[known_relative] = (
+            shared_block.name, chromosome_layout)
+
+    return shared_memory_blocks, shared_raw_data_layout
+
+
+def attach_shared_raw_data(
+        shared_raw_data_layout):
+    """
+    Rebuild raw_data_by_match as array views on the shared memory blocks
+    described by share_raw_data.  Returns the attached blocks as well,
+    which must stay referenced for as long as the arrays are used.
+    """
+    shared_memory_blocks = []
+    raw_data_by_match = {}
+
+    for known_relative, (shared_memory_name, chromosome_layout) \
+            in shared_raw_data_layout.items():
+        shared_block = shared_memory.SharedMemory(name=shared_memory_name)
+        shared_memory_blocks.append(shared_block)
+
+        raw_data_by_match[known_relative] = {
+            chromosome: ChromosomeGenotypes(
+                np.ndarray((SNP_count,), dtype=np.int32,
+                           buffer=shared_block.buf, offset=positions_offset),
+                np.ndarray((SNP_count, 2), dtype=np.uint8,
+                           buffer=shared_block.buf, offset=alleles_offset))
+            for chromosome, (positions_offset, alleles_offset, SNP_count)
+            in chromosome_layout.items()}
+
+    return shared_memory_blocks, raw_data_by_match
+
+
+_worker_shared_memory_blocks = []
+_worker_raw_data_by_match = None
+_worker_instrument_mode = None
+
+
+def init_render_worker(
+        shared_raw_data_layout,
+        instrument_mode=None,
+        verbosity=VERBOSITY):
+    global _worker_shared_memory_blocks, _worker_raw_data_by_match, \
+        _worker_instrument_mode, VERBOSITY
+    _worker_shared_memory_blocks, _worker_raw_data_by_match = \
+        attach_shared_raw_data(shared_raw_data_layout)
+    _worker_instrument_mode = instrument_mode
+    VERBOSITY = verbosity
+
+
+"""
+Deep Zoom tiles.
+
+For browsing, every rendered page can be published as a Deep Zoom image
+(the format OpenSeadragon and similar viewers read):
+
+    <family>_tiles/
+        manifest.json            chromosome order, sizes and .dzi files
+        chr1.dzi                 Deep Zoom descriptor of chromosome 1
+        chr1_files/
+            columns.npy          the page's (pairs, columns) match classes
+            page.json            title, pair labels, tick marks, settings
+            <level>/<col>_<row>.png
+
+Level max_level is the page itself and every level below it is half the
+size of the one above, down to level 0 at a single pixel.  The page is
+never stored as one image -- a large family's page can be bigger than
+PIL will open.  Each tile is drawn on its own from the columns it shows:
+at full size straight from columns.npy, and below that from a count
+pyramid of the columns (see build_match_class_pyramid), each level pixel
+aggregating its 2**k columns with the page's COLUMN_AGGREGATE.  Borders,
+strip heights and text shrink with the level, and text too small to read
+is left out.
+
+Tiles are only drawn when they are first asked for through
+DeepZoomTiles.get_tile, then kept on disk, so a viewer pays only for the
+part of the genome it shows.
+"""
+DEEP_ZOOM_NAMESPACE = 'http://schemas.microsoft.com/deepzoom/2008'
+DEEP_ZOOM_COLUMNS = 'columns.npy'
+DEEP_ZOOM_PAGE_LAYOUT = 'page.json'
+DEEP_ZOOM_SOURCE_VERSION = 1
+TILE_MANIFEST = 'manifest.json'
+# text drawn smaller than this many pixels is left out of a tile
+MINIMUM_TILE_FONT_SIZE = 2
+
 
-    show_match_graphics(
-            processed_and_sorted_SNP_dict_table,
-            match_pair_combinations)
+def get_tile_dir(
+        output_dir,
+        all_matches_list):
+    return os.path.join(output_dir, "{0}_tiles".format(
+        "_".join(all_matches_list)))
+
+
+def get_page_text_items(
+        title,
+        pair_labels,
+        tickmarks,
+        config):
+    """
+    Every piece of text on a page, as show_match_graphics draws it:
+
+        [ (x, y, text, font face, font size), ... ]
+    """
+    text_items = [(config.CHROM_PAGE_LEFT_BORDER, config.CHROM_PAGE_TOP_BORDER,
+                   title, "Arial Bold.ttf", config.CHROM_TITLE_TEXT_FONT_SIZE)]
+    text_items.extend(
+        (config.CHROM_PAGE_TEXT_BORDER, get_strip_top(match_shown_number,
+                                                      config),
+         mp_abbr, "Arial Bold.ttf", config.CHROM_MATCH_TEXT_FONT_SIZE)
+        for match_shown_number, mp_abbr in enumerate(pair_labels))
+
+    if pair_labels:
+        tickmark_top = get_strip_top(0, config) + config.SPACE_BETWEEN_MATCHES
+        for base_position, milestone_label in tickmarks:
+            if milestone_label is not None:
+                text_items.append((
+                    config.CHROM_PAGE_LEFT_BORDER + base_position,
+                    tickmark_top + config.MILESTONE_VERTICAL_POSITION,
+                    milestone_label, config.TICKMARK_FONT,
+                    config.MILESTONE_FONT_SIZE))
+            else:
+                text_items.append((
+                    config.CHROM_PAGE_LEFT_BORDER + base_position,
+                    tickmark_top + config.TICKER_VERTICAL_POSITION,
+                    ".", config.TICKMARK_FONT, config.TICKMARK_FONT_SIZE))
+    return text_items
+
+
+class DeepZoomTiles(object):
+    """
+    The lazily drawn tile pyramid of one page, stored under tile_dir as
+    <name>.dzi and <name>_files/.  Safe to share between threads.
+    """
+
+    def __init__(self, tile_dir, name):
+        self.tile_dir = tile_dir
+        self.name = name
+        self.files_dir = os.path.join(tile_dir, "{0}_files".format(name))
+
+        descriptor = ElementTree.parse(
+                os.path.join(tile_dir, "{0}.dzi".format(name))).getroot()
+        size = descriptor.find('{{{0}}}Size'.format(DEEP_ZOOM_NAMESPACE))
+        self.tile_size = int(descriptor.get('TileSize'))
+        self.tile_format = descriptor.get('Format')
+        self.width = int(size.get('Width'))
+        self.height = int(size.get('Height'))
+        self.max_level = int(np.ceil(np.log2(max(self.width, self.height, 1))))
+
+        with open(os.path.join(self.files_dir,
+                               DEEP_ZOOM_PAGE_LAYOUT)) as layout_file:
+            page_layout = json.load(layout_file)
+        if page_layout.get('version') != DEEP_ZOOM_SOURCE_VERSION:
+            raise ValueError("tile source of {0} is from another version; "
+                             "render it again".format(name))
+        self.config = RenderConfig(**page_layout['config'])
+        self.column_match_classes = np.load(
+                os.path.join(self.files_dir, DEEP_ZOOM_COLUMNS),
+                mmap_mode='r')
+        self.text_items = get_page_text_items(
+                page_layout['title'],
+                page_layout['pair_labels'],
+                [tuple(tickmark) for tickmark in page_layout['tickmarks']],
+                self.config)
+
+        self._column_pyramid = None
+        self._lock = threading.Lock()
+
+    def get_level_size(self, level):
+        scale = 2 ** (self.max_level - level)
+        return (-(-self.width // scale), -(-self.height // scale))
+
+    def get_tile_count(self, level):
+        level_width, level_height = self.get_level_size(level)
+        return (-(-level_width // self.tile_size),
+                -(-level_height // self.tile_size))
+
+    def get_level_columns(self, level, first, last):
+        """
+        The (pairs, last - first) classes of strip columns first to last
+        at a level: the page's own columns at max_level, aggregated over
+        2**k of them k levels below.
+        """
+        k = self.max_level - level
+        if k == 0:
+            return np.asarray(self.column_match_classes[:, first:last])
+
+        with self._lock:
+            if self._column_pyramid is None:
+                self._column_pyramid = build_match_class_pyramid(
+                        np.asarray(self.column_match_classes),
+                        NO_SNP_COLUMN + 1)
+            column_pyramid = self._column_pyramid
+
+        if not column_pyramid:
+            level_counts = get_match_class_counts(
+                    np.asarray(self.column_match_classes), NO_SNP_COLUMN + 1)
+        else:
+            level_counts = column_pyramid[min(k, len(column_pyramid)) - 1]
+        return aggregate_match_class_counts(
+                level_counts[:, first:last], self.config.COLUMN_AGGREGATE)
+
+    def draw_tile_image(self, level, left, top, right, bottom):
+        "The part left, top, right, bottom of the page at a level"
+        config = self.config
+        scale = 2 ** (self.max_level - level)
+
+        tile_buffer = np.empty((bottom - top, right - left, 3), dtype=np.uint8)
+        tile_buffer[:] = ImageColor.getrgb(config.BACKGROUND_COLOR)
+
+        pair_count, file_lines = self.column_match_classes.shape
+        strip_left = round(config.CHROM_PAGE_LEFT_BORDER / scale)
+        first = max(left - strip_left, 0)
+        last = min(right - strip_left, -(-file_lines // scale))
+        if first < last:
+            SNP_line_colors = get_SNP_color_lookup_table(config)[
+                self.get_level_columns(level, first, last)]
+            for match_shown_number in range(pair_count):
+                lines_top = (get_strip_top(match_shown_number, config)
+                             + config.SPACE_BETWEEN_MATCHES)
+                lines_bottom = max(
+                        round((lines_top + config.HEIGHT_OF_CHROMOSOME_IMAGE)
+                              / scale),
+                        round(lines_top / scale) + 1)
+                lines_top = round(lines_top / scale)
+                if lines_top < bottom and lines_bottom > top:
+                    tile_buffer[max(lines_top, top) - top:
+                                min(lines_bottom, bottom) - top,
+                                strip_left + first - left:
+                                strip_left + last - left] = \
+                        SNP_line_colors[match_shown_number]
+
+        tile_image = Image.fromarray(tile_buffer, 'RGB')
+        tile_draw = ImageDraw.Draw(tile_image)
+        for x, y, text, face, font_size in self.text_items:
+            font_size //= scale
+            if font_size < MINIMUM_TILE_FONT_SIZE:
+                continue
+            x, y = x / scale - left, y / scale - top
+            # text reaches right and down from (x, y), a few sizes at most
+            if (x >= right - left or y >= bottom - top
+                    or x + font_size * len(text) < 0 or y + 2 * font_size < 0):
+                continue
+            tile_draw.multiline_text((x, y), text,
+                                     font=get_font(face, font_size),
+                                     fill='black')
+
+        count('pixels drawn', tile_image.width * tile_image.height)
+        return tile_image
+
+    def get_tile(self, level, col, row):
+        """
+        Path of one tile, drawing it the first time it is asked for.
+        Raises ValueError for tiles outside the pyramid.
+        """
+        columns, rows = self.get_tile_count(level) if 0 <= level \
+            <= self.max_level else (0, 0)
+        if not (0 <= col < columns and 0 <= row < rows):
+            raise ValueError("no tile {0}/{1}_{2} in {3}".format(
+                level, col, row, self.name))
+
+        tile_file = os.path.join(self.files_dir, str(level),
+                                 "{0}_{1}.{2}".format(
+                                     col, row, self.tile_format))
+        if os.path.isfile(tile_file):
+            return tile_file
+
+        left, top = col * self.tile_size, row * self.tile_size
+        level_width, level_height = self.get_level_size(level)
+        tile_image = self.draw_tile_image(
+                level, left, top,
+                min(left + self.tile_size, level_width),
+                min(top + self.tile_size, level_height))
+
+        os.makedirs(os.path.dirname(tile_file), exist_ok=True)
+        temporary_file_name = "{0}.{1}.{2}.tmp".format(
+                tile_file, os.getpid(), threading.get_ident())
+        save_match_graphics(tile_image, temporary_file_name,
+                            self.tile_format)
+        os.replace(temporary_file_name, tile_file)
+        return tile_file
+
+    def generate_all_tiles(self):
+        "Draw every tile up front, e.g. for hosting as plain static files"
+        for level in range(self.max_level, -1, -1):
+            columns, rows = self.get_tile_count(level)
+            for col in range(columns):
+                for row in range(rows):
+                    self.get_tile(level, col, row)
+
+
+@timed('tiles')
+def save_deep_zoom_source(
+        match_table,
+        chromosome,
+        tile_dir,
+        name,
+        config=None,
+        match_class_pyramid=None):
+    """
+    Store what the tiles of a page are drawn from: its column match
+    classes, the layout of its text and the .dzi descriptor, with the
+    TILE_SIZE and TILE_FORMAT of config.  No tiles are drawn yet.
+    Returns the descriptor file name.
+    """
+    if config is None:
+        config = get_render_config()
+
+    column_positions, column_match_classes, bp_per_pixel = get_page_columns(
+            match_table, chromosome, config, match_class_pyramid)
+    page_width, page_height = get_page_size(
+            len(column_positions), len(match_table.pair_labels), config)
+
+    files_dir = os.path.join(tile_dir, "{0}_files".format(name))
+    if os.path.isdir(files_dir):
+        shutil.rmtree(files_dir)
+    os.makedirs(files_dir)
+    np.save(os.path.join(files_dir, DEEP_ZOOM_COLUMNS),
+            np.ascontiguousarray(column_match_classes, dtype=np.uint8))
+    with open(os.path.join(files_dir, DEEP_ZOOM_PAGE_LAYOUT),
+              'w') as layout_file:
+        json.dump({
+            'version': DEEP_ZOOM_SOURCE_VERSION,
+            'title': get_page_title(chromosome, config),
+            'pair_labels': list(match_table.pair_labels),
+            'tickmarks': get_tickmarks(column_positions, config, bp_per_pixel),
+            'config': config._asdict(),
+        }, layout_file, indent=1)
+
+    descriptor = ElementTree.Element(
+            'Image', TileSize=str(config.TILE_SIZE), Overlap='0',
+            Format=config.TILE_FORMAT, xmlns=DEEP_ZOOM_NAMESPACE)
+    ElementTree.SubElement(
+            descriptor, 'Size',
+            Width=str(page_width),
+            Height=str(page_height))
+
+    descriptor_file = os.path.join(tile_dir, "{0}.dzi".format(name))
+    ElementTree.ElementTree(descriptor).write(
+            descriptor_file, encoding='utf-8', xml_declaration=True)
+    return descriptor_file
+
+
+def write_tile_manifest(
+        tile_dir,
+        chromosomes):
+    """
+    List the Deep Zoom images of a whole-genome tile set, in chromosome
+    order, so a viewer can lay the chromosomes out without opening them.
+    """
+    tile_manifest = {'chromosomes': []}
+    for chromosome in chromosomes:
+        name = "chr{0}".format(chromosome)
+        deep_zoom_tiles = DeepZoomTiles(tile_dir, name)
+        tile_manifest['tile_size'] = deep_zoom_tiles.tile_size
+        tile_manifest['format'] = deep_zoom_tiles.tile_format
+        tile_manifest['chromosomes'].append({
+            'chromosome': chromosome,
+            'dzi': "{0}.dzi".format(name),
+            'width': deep_zoom_tiles.width,
+            'height': deep_zoom_tiles.height,
+            'max_level': deep_zoom_tiles.max_level,
+        })
+
+    manifest_file = os.path.join(tile_dir, TILE_MANIFEST)
+    with open(manifest_file, 'w') as manifest:
+        json.dump(tile_manifest, manifest, indent=1)
+    return manifest_file
+
+
+def save_chromosome_outputs(
+        chromosome,
+        match_table,
+        chrom_whole_page_image,
+        all_matches_list,
+        output_dir,
+        image_format='png',
+        compression_level=None,
+        segments=False,
+        tiles=False,
+        config=None,
+        export_format=None,
+        match_class_pyramid=None):
+    """
+    Save a rendered chromosome page, plus its FIR/HIR/NIR segment table
+    when segments is set, its Deep Zoom source when tiles is set and its
+    match table in export_format when that is given.  The count pyramid
+    the page was drawn with saves building it again for the tiles.
+    Returns the names of the files written.
+    """
+    output_files = [os.path.join(output_dir, get_output_file_name(
+        all_matches_list, chromosome, image_format))]
+    save_match_graphics(
+            chrom_whole_page_image,
+            output_files[0],
+            image_format,
+            compression_level)
+
+    if segments or export_format:
+        match_segments = find_match_segments(match_table, config)
+
+    if segments:
+        output_files.append(os.path.join(output_dir, get_output_file_name(
+            all_matches_list, chromosome, 'tsv', '_segments')))
+        write_match_segments(
+                match_segments,
+                output_files[-1])
+
+    if export_format:
+        output_files.extend(export_match_table(
+                match_table,
+                match_segments,
+                get_export_dir(output_dir, all_matches_list),
+                chromosome,
+                export_format))
+
+    if tiles:
+        output_files.append(save_deep_zoom_source(
+                match_table,
+                chromosome,
+                get_tile_dir(output_dir, all_matches_list),
+                "chr{0}".format(chromosome),
+                config,
+                match_class_pyramid))
+
+    return output_files
+
+
+def render_and_save_chromosome_in_worker(
+        render_job):
+    """
+    Pool task: render one chromosome from the shared genotype arrays and
+    save it, so only the output file names travel back to the parent,
+    with the instrumentation report of the job when it is switched on.
+    """
+    (chromosome, match_pair_combinations, all_matches_list,
+     output_dir, image_format, compression_level, segments,
+     tiles, config, export_format) = render_job
+
+    if _worker_instrument_mode:
+        enable_instrumentation(_worker_instrument_mode)
+
+    match_table = get_chromosome_match_table(
+            chromosome,
+            match_pair_combinations,
+            all_matches_list,
+            _worker_raw_data_by_match,
+            config)
+    match_class_pyramid = get_match_class_pyramid(match_table, config)
+
+    output_files = save_chromosome_outputs(
+            chromosome,
+            match_table,
+            show_match_graphics(match_table, match_pair_combinations,
+                                chromosome, config, match_class_pyramid),
+            all_matches_list,
+            output_dir,
+            image_format,
+            compression_level,
+            segments,
+            tiles,
+            config,
+            export_format,
+            match_class_pyramid)
+
+    job_instrumentation = disable_instrumentation()
+    return chromosome, output_files, (
+        job_instrumentation.get_report() if job_instrumentation else None)
+
+
+def render_all_chromosomes_in_parallel(
+        match_pair_combinations,
+        all_matches_list,
+        chromosomes,
+        output_dir,
+        image_format='png',
+        compression_level=None,
+        jobs=None,
+        data_dir_name=None,
+        segments=False,
+        tiles=False,
+        config=None,
+        export_format=None):
+    """
+    Parallel batch mode: parse each raw file once in this process, place
+    the genotype arrays in shared memory, and let a pool of jobs worker
+    processes render and save one chromosome each.
+
+    Yields (chromosome, output files) pairs in chromosome order.
+    """
+    raw_data_by_match = load_raw_data_for_all_matches(
+            all_matches_list,
+            data_dir_name)
+
+    shared_memory_blocks, shared_raw_data_layout = \
+        share_raw_data(raw_data_by_match)
+    del raw_data_by_match
+
+    render_jobs = [
+        (chromosome, match_pair_combinations, all_matches_list,
+         output_dir, image_format, compression_level, segments,
+         tiles, config, export_format)
+        for chromosome in chromosomes]
+
+    try:
+        with ProcessPoolExecutor(
+                max_workers=jobs,
+                initializer=init_render_worker,
+                initargs=(shared_raw_data_layout,
+                          instrumentation and instrumentation.mode,
+                          VERBOSITY)) \
+                as executor:
+            for chromosome, output_files, instrumentation_report \
+                    in executor.map(render_and_save_chromosome_in_worker,
+                                    render_jobs):
+                if instrumentation is not None and instrumentation_report:
+                    instrumentation.merge(instrumentation_report)
+                yield chromosome, output_files
+
+    finally:
+        for shared_block in shared_memory_blocks:
+            shared_block.close()
+            shared_block.unlink()
+
+
+def parse_chromosome_list(
+        chromosome_arguments):
+    """
+    Turn the --chromosomes arguments ('all', '7', '1,2,3' ...) into a
+    sorted list of chromosome numbers.
+    """
+    chromosomes = set()
+    for argument in chromosome_arguments:
+        for token in argument.split(','):
+            if token == 'all':
+                chromosomes.update(AUTOSOMES)
+            elif token in [str(i) for i in AUTOSOMES]:
+                chromosomes.add(int(token))
+            elif token:
+                raise argparse.ArgumentTypeError(
+                    "invalid chromosome {0!r}, expected 1-22 or 'all'".format(
+                        token))
+    return sorted(chromosomes)
+
+
+def get_argument_parser():
+    parser = argparse.ArgumentParser(
+            description="Render side-by-side pixel views of sibling raw DNA "
+                        "matches.  Without --chromosomes the program asks "
+                        "for a chromosome and opens the result in a viewer.")
+    parser.add_argument(
+            '--data-dir', default=DATA_FILE_DIRECTORY,
+            help="directory holding the raw DNA files "
+                 "(default: %(default)s)")
+    parser.add_argument(
+            '--siblings', nargs='+', default=siblings_to_render,
+            help="names of the siblings to compare "
+                 "(default: %(default)s)")
+    parser.add_argument(
+            '--extra-match', default=extra_match,
+            help="one additional relative to compare with every sibling")
+    parser.add_argument(
+            '--chromosomes', nargs='+',
+            help="chromosomes to render, e.g. '1 2 3', '1,2,3' or 'all'; "
+                 "renders without prompting and writes the images to "
+                 "--output-dir")
+    parser.add_argument(
+            '--output-dir', default='.',
+            help="directory for rendered images (default: %(default)s)")
+    parser.add_argument(
+            '--format', dest='image_format', default='png',
+            choices=sorted(OUTPUT_FORMATS),
+            help="image format (default: %(default)s)")
+    parser.add_argument(
+            '--compression-level', type=int,
+            help="PNG 0-9 or WebP 0-6; higher is smaller and slower")
+    parser.add_argument(
+            '--jobs', type=int, default=1,
+            help="with --chromosomes, render this many chromosomes at once "
+                 "in separate processes; 0 uses every CPU (default: 1)")
+    parser.add_argument(
+            '--page-width', type=int, default=pixel_config.TARGET_PAGE_WIDTH,
+            help="fit each page into this many pixels by binning SNPs into "
+                 "columns (default: one column per SNP)")
+    parser.add_argument(
+            '--aggregate', default=pixel_config.COLUMN_AGGREGATE,
+            choices=COLUMN_AGGREGATES,
+            help="class shown by a binned column (default: %(default)s)")
+    parser.add_argument(
+            '--axis', dest='axis_mode', default=pixel_config.AXIS_MODE,
+            choices=AXIS_MODES,
+            help="'snp' puts SNPs side by side, 'bp' scales the x-axis by "
+                 "base-pair position (default: %(default)s)")
+    parser.add_argument(
+            '--bp-per-pixel', type=int, default=pixel_config.BP_PER_PIXEL,
+            help="column width on the bp axis (default: %(default)s)")
+    parser.add_argument(
+            '--tiles', action='store_true',
+            help="with --chromosomes, also publish the pages as Deep Zoom "
+                 "images with a whole-genome manifest; tiles are drawn on "
+                 "first request")
+    parser.add_argument(
+            '--prebuild-tiles', action='store_true',
+            help="with --tiles, draw every tile now, for static hosting")
+    parser.add_argument(
+            '--segments', action='store_true',
+            help="with --chromosomes, also write each pair's FIR/HIR/NIR "
+                 "segments to a _segments.tsv file")
+    parser.add_argument(
+            '--export', choices=EXPORT_FORMATS,
+            help="with --chromosomes, also write each chromosome's "
+                 "positions, genotypes, match classes and segments to a "
+                 "_export directory; 'parquet' and 'arrow' need pyarrow")
+    parser.add_argument(
+            '--instrument', choices=INSTRUMENT_MODES, default=INSTRUMENT,
+            help="time every stage and count the work done; 'summary' "
+                 "prints totals at the end, 'jsonl' one JSON line per stage")
+    parser.add_argument(
+            '--instrument-file',
+            help="write the instrumentation there instead of to stderr")
+    parser.add_argument(
+            '--verbose', action='store_true',
+            help="with --chromosomes, print debugging details to stderr; "
+                 "they are always printed without --chromosomes")
+    return parser
+
+
+def get_valid_chromosome_number():
+    SUGGESTED_CHROMOSOME_TO_RENDER = input("""
+        "Enter a valid chromosome number to process 1-22  
+
+        or type 'all' to process every chromosome
+
+        or type 'quit' to exit program     """)
+
+    if SUGGESTED_CHROMOSOME_TO_RENDER == 'quit':
+        print("goodbye")
+        sys.exit()
+
+    elif SUGGESTED_CHROMOSOME_TO_RENDER == 'all':
+        return AUTOSOMES
+
+    elif SUGGESTED_CHROMOSOME_TO_RENDER in [str(i) for i in range(1, 23)]:
+        return [int(SUGGESTED_CHROMOSOME_TO_RENDER)]
+
+    else:
+        return get_valid_chromosome_number()
+
+
+def finish_tile_set(
+        args,
+        chromosomes,
+        all_matches_list):
+    if not args.tiles:
+        return
+
+    tile_dir = get_tile_dir(args.output_dir, all_matches_list)
+    print(write_tile_manifest(tile_dir, chromosomes))
+
+    if args.prebuild_tiles:
+        for chromosome in chromosomes:
+            DeepZoomTiles(tile_dir, "chr{0}".format(chromosome)) \
+                .generate_all_tiles()
+
+
+def render_requested_chromosomes(
+        args,
+        headless,
+        chromosomes,
+        compression_level,
+        match_pair_combinations,
+        all_matches_list):
+    config = get_render_config(
+            TARGET_PAGE_WIDTH=args.page_width,
+            COLUMN_AGGREGATE=args.aggregate,
+            AXIS_MODE=args.axis_mode,
+            BP_PER_PIXEL=args.bp_per_pixel)
+
+    if headless and args.jobs != 1:
+        for chromosome, output_files in render_all_chromosomes_in_parallel(
+                match_pair_combinations,
+                all_matches_list,
+                chromosomes,
+                args.output_dir,
+                args.image_format,
+                compression_level,
+                args.jobs or None,
+                args.data_dir,
+                args.segments,
+                args.tiles,
+                config,
+                args.export):
+            print("\n".join(output_files))
+        finish_tile_set(args, chromosomes, all_matches_list)
+        return
+
+    for chromosome, match_table, match_class_pyramid, chrom_whole_page_image \
+            in render_all_chromosomes(
+                match_pair_combinations,
+                all_matches_list,
+                chromosomes,
+                args.data_dir,
+                config):
+
+        if headless:
+            output_files = save_chromosome_outputs(
+                    chromosome,
+                    match_table,
+                    chrom_whole_page_image,
+                    all_matches_list,
+                    args.output_dir,
+                    args.image_format,
+                    compression_level,
+                    args.segments,
+                    args.tiles,
+                    config,
+                    args.export,
+                    match_class_pyramid)
+            print("\n".join(output_files))
+
+        else:
+            chrom_whole_page_image.show()
+
+    if headless:
+        finish_tile_set(args, chromosomes, all_matches_list)
+
+
+def main(argv=None):
+    global VERBOSITY
+    parser = get_argument_parser()
+    args = parser.parse_args(argv)
+
+    if args.bp_per_pixel < 1:
+        parser.error("--bp-per-pixel must be at least 1")
+
+    headless = args.chromosomes is not None
+
+    if headless:
+        if not args.verbose:
+            VERBOSITY = 0
+
+        try:
+            chromosomes = parse_chromosome_list(args.chromosomes)
+        except argparse.ArgumentTypeError as e:
+            parser.error(str(e))
+
+        compression_level = args.compression_level
+        max_compression = OUTPUT_FORMATS[args.image_format]['max_compression']
+        if compression_level is not None and not (
+                0 <= compression_level <= max_compression):
+            parser.error("--compression-level for {0} must be 0-{1}".format(
+                args.image_format, max_compression))
+
+        if args.export in PYARROW_EXPORT_FORMATS and pyarrow is None:
+            parser.error("--export {0} needs pyarrow".format(args.export))
+
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    else:
+        chromosomes = get_valid_chromosome_number()
+        compression_level = None
+
+    match_pair_combinations, all_matches_list \
+        = get_match_pair_combinations(
+            list(args.siblings),
+            args.extra_match)
+
+    instrument_file = None
+    if args.instrument:
+        if args.instrument_file:
+            instrument_file = open(args.instrument_file, 'w')
+        enable_instrumentation(args.instrument, instrument_file or sys.stderr)
+
+    try:
+        render_requested_chromosomes(
+                args,
+                headless,
+                chromosomes,
+                compression_level,
+                match_pair_combinations,
+                all_matches_list)
+
+    except KitNotFoundError as e:
+        sys.exit(str(e))
+
+    finally:
+        finished_instrumentation = disable_instrumentation()
+        if finished_instrumentation is not None:
+            finished_instrumentation.write_summary()
+        if instrument_file is not None:
+            instrument_file.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -5,22 +5,78 @@ siblings_to_render = ['JULIE', 'ALLISON', 'COLLETTE']
 
 """
 NOTE: raw DNA file names must:
-1) contain name of source vendor (i.e. Ancestry, 23andMe, MyHeritage, etc
-2) contain person's name exactly as listed in 'siblings_to_render' below
-3) contain the word 'raw'
-4) lastly, raw data must must be in  .txt files
+1) contain person's name exactly as listed in 'siblings_to_render' below
+2) contain the word 'raw'
+3) lastly, raw data must be in .txt, .csv or .tsv files (.gz or .zip is fine)
 
 example: 23andMe_JULIE_raw_dna.txt
 
+the vendor format (Ancestry, 23andMe, MyHeritage, FTDNA, LivingDNA) is
+detected from the file contents
+
 copy all relevant raw dna files into the directory your specify
 """
 # optionally you can compare the siblings with one additional relative
 extra_match = ''
 
+# parsed raw files are kept here so later runs skip the text parsing;
+# set to '' to switch the cache off
+RAW_FILE_CACHE_DIRECTORY = '.pixel_cache'
+RAW_FILE_CACHE_MAX_BYTES = 2 * 1024 ** 3
+# raw files are read this many at a time, which helps most on network
+# storage; 1 reads them one after another
+RAW_FILE_LOAD_THREADS = 4
+# drawn comparison strips are kept in memory and in the cache directory,
+# so a pair shown again over the same SNPs is not drawn again; 0 switches
+# either one off.  Strips are cheap to draw from the match classes, so
+# the disk copy, which has to be PNG encoded, is off unless set here.
+STRIP_CACHE_MEMORY_BYTES = 512 * 1024 ** 2
+STRIP_CACHE_MAX_BYTES = 0
+
+# time every pipeline stage and count the work done: None (off),
+# 'summary' for a table at the end or 'jsonl' for one JSON line per stage
+INSTRUMENT = None
+
 # removes a lot of 'noise' SNPs that don't contribute to the analysis
 FILTER_COMPLETELY_MATCHED_SEGMENTS = True
 
+# segment detection (FIR / HIR / NIR regions, written with --segments):
+# up to this many SNPs that break a region within any SEGMENT_MIN_SNPS
+# SNPs are treated as noise; inside the region below there are many more
+SEGMENT_NOISE_TOLERANCE = 3
+# regions shorter than either of these are dropped
+SEGMENT_MIN_SNPS = 100
+SEGMENT_MIN_BP = 1000000
+
+# match table export (--export): SNPs per row group of a Parquet file
+EXPORT_ROW_GROUP_SIZE = 65536
+
+# server mode (python3 -m pixel_server): where it listens, and how much
+# memory parsed kits and compared chromosomes may take before the least
+# recently used are dropped
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8765
+SERVER_KIT_CACHE_BYTES = 1024 ** 3
+SERVER_MATCH_TABLE_CACHE_BYTES = 256 * 1024 ** 2
+# pages whose tiles the server keeps ready to draw, most recently used
+SERVER_OPEN_TILE_SETS = 64
+
+# Deep Zoom tiles written with --tiles
+TILE_SIZE = 256
+TILE_FORMAT = 'png'
+
 ##### optional settings to change appearance of rendered chromosome pairs  ###
+# page width in pixels; None draws one pixel column per SNP, otherwise
+# SNPs are binned into columns and each column shows the 'majority' class
+# or the 'worst' class of its SNPs
+TARGET_PAGE_WIDTH = None
+COLUMN_AGGREGATE = 'majority'
+# x-axis: 'snp' places SNPs side by side in order, 'bp' scales the axis by
+# base-pair position so chromosomes and kits line up
+AXIS_MODE = 'snp'
+BP_PER_PIXEL = 100000
+MILESTONE_BP_SPACING = 10000000
+TICKER_BP_SPACING = 1000000
 FULLY_IDENTICAL_SNP_COLOR = 'limegreen'
 NO_MATCH_SNP_COLOR = 'crimson'
 HALF_IDENTICAL_SNP_COLOR = 'yellow'
@@ -42,7 +98,7 @@ MILESTONE_SPACING = 50
 TICKER_SPACING = 10
 MILESTONE_VERTICAL_POSITION = -25
 TICKER_VERTICAL_POSITION = -15
-TICKMARK_FONT = "arial.tff"
+TICKMARK_FONT = "Arial.ttf"
 TICKMARK_FONT_SIZE = 10
 MILESTONE_FONT_SIZE = 15
 
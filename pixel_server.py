@@ -0,0 +1,624 @@
+#!/usr/bin/env python3
+"""
+    Server mode for pixel_chromosome_view
+
+    One long-running process renders pages for any number of families, so
+    imports, settings and kit parsing are paid for once instead of on
+    every run.  Parsed kits stay in a memory-bounded LRU cache, so a kit
+    shared between families -- a parent used as the extra match of
+    several sibling groups, say -- is parsed only once.  Compared
+    chromosomes are kept the same way, so a page shown again at another
+    width is only drawn again.
+
+    python3 -m pixel_server --port 8765
+    python3 -m pixel_server --unix-socket /tmp/pixel.sock
+
+    API (local use only; there is no authentication):
+
+        GET  /render?siblings=JULIE,ALLISON&extra_match=MOM&chromosome=7
+        POST /render    {"siblings": ["JULIE", "ALLISON"], "chromosome": 7}
+
+            Options: data_dir, extra_match, chromosome or chromosomes,
+            format (png, webp), compression_level, page_width, aggregate,
+            axis, bp_per_pixel.  One chromosome comes back as an image,
+            several as a zip archive of images.
+
+        GET  /tiles/<tile set>/<name>.dzi
+        GET  /tiles/<tile set>/<name>_files/<level>/<col>_<row>.<format>
+        GET  /tiles/<tile set>/manifest.json
+
+            Deep Zoom tile sets published under --tile-dir with --tiles;
+            tiles are drawn the first time they are asked for.
+
+        GET  /status    cache and request counts, as JSON
+
+    license: GPLv3
+"""
+
+import io
+import os
+import re
+import json
+import zipfile
+import traceback
+import argparse
+import threading
+import socketserver
+
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import pixel_config
+import pixel_chromosome_view as pixel_view
+
+
+class KitCache(object):
+    """
+    Parsed kits, { (raw file path, size, mtime_ns) : { chromosome :
+    ChromosomeGenotypes } }, least recently used first out once they take
+    more than max_bytes.  A kit whose raw file changes gets a new key, and
+    the stale one ages out.  Safe to share between threads.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.cache_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._kits = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_kit_bytes(genotypes_by_chromosome):
+        return sum(genotypes.positions.nbytes + genotypes.alleles.nbytes
+                   for genotypes in genotypes_by_chromosome.values())
+
+    @staticmethod
+    def get_kit_keys(all_matches_list, data_dir_name):
+        "{ match name : cache key of its kit as the raw file is now }"
+        kit_index = pixel_view.get_kit_index(
+                os.path.join(pixel_view.this_dir, data_dir_name))
+        kit_keys = {}
+        for known_relative in all_matches_list:
+            kit = pixel_view.find_kit(known_relative, kit_index)
+            kit_keys[known_relative] = (
+                kit['path'], kit['size'], kit['mtime_ns'])
+        return kit_keys
+
+    def get_raw_data(self, all_matches_list, data_dir_name, kit_keys=None):
+        """
+        raw_data_by_match for all_matches_list, as
+        load_raw_data_for_all_matches returns it, loading only the kits
+        that are not cached yet.
+        """
+        if kit_keys is None:
+            kit_keys = self.get_kit_keys(all_matches_list, data_dir_name)
+
+        raw_data_by_match = {}
+        with self._lock:
+            for known_relative, kit_key in kit_keys.items():
+                if kit_key in self._kits:
+                    self._kits.move_to_end(kit_key)
+                    raw_data_by_match[known_relative] = self._kits[kit_key]
+                    self.hits += 1
+
+        missing = [known_relative for known_relative in all_matches_list
+                   if known_relative not in raw_data_by_match]
+        if missing:
+            loaded = pixel_view.load_raw_data_for_all_matches(
+                    missing, data_dir_name)
+            for known_relative in missing:
+                self.add(kit_keys[known_relative], loaded[known_relative])
+            raw_data_by_match.update(loaded)
+
+        return {known_relative: raw_data_by_match[known_relative]
+                for known_relative in all_matches_list}
+
+    def add(self, kit_key, genotypes_by_chromosome):
+        kit_bytes = self.get_kit_bytes(genotypes_by_chromosome)
+        with self._lock:
+            self.misses += 1
+            if kit_key in self._kits or kit_bytes > self.max_bytes:
+                return
+            self._kits[kit_key] = genotypes_by_chromosome
+            self.cache_bytes += kit_bytes
+            while self.cache_bytes > self.max_bytes:
+                _, evicted = self._kits.popitem(last=False)
+                self.cache_bytes -= self.get_kit_bytes(evicted)
+
+    def get_status(self):
+        with self._lock:
+            return {'kits': len(self._kits),
+                    'bytes': self.cache_bytes,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+
+class MatchTableCache(object):
+    """
+    MatchTables of recently rendered chromosomes, with the count pyramid
+    once a page has needed one:
+
+        { (pairs, kit keys, chromosome, filtered) :
+              (MatchTable, match_class_pyramid or None) }
+
+    so a family shown again -- at another page width, say -- skips the
+    comparison and the pyramid.  Least recently used first out once they
+    take more than max_bytes.  Safe to share between threads.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.cache_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._match_tables = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_entry_bytes(entry):
+        match_table, match_class_pyramid = entry
+        return (match_table.positions.nbytes + match_table.alleles.nbytes
+                + match_table.match_classes.nbytes
+                + sum(level_counts.nbytes
+                      for level_counts in match_class_pyramid or ()))
+
+    def get(self, match_table_key, load_match_table, config):
+        """
+        (MatchTable, count pyramid for config) under match_table_key,
+        calling load_match_table() for a MatchTable that is not cached.
+        """
+        with self._lock:
+            entry = self._match_tables.get(match_table_key)
+            if entry is not None:
+                self._match_tables.move_to_end(match_table_key)
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if entry is None:
+            entry = (load_match_table(), None)
+            entry_changed = True
+        else:
+            entry_changed = False
+
+        if entry[1] is None:
+            match_class_pyramid = pixel_view.get_match_class_pyramid(
+                    entry[0], config)
+            if match_class_pyramid is not None:
+                entry = (entry[0], match_class_pyramid)
+                entry_changed = True
+
+        if entry_changed:
+            self.add(match_table_key, entry)
+        return entry
+
+    def add(self, match_table_key, entry):
+        with self._lock:
+            previous_entry = self._match_tables.pop(match_table_key, None)
+            if previous_entry is not None:
+                self.cache_bytes -= self.get_entry_bytes(previous_entry)
+            entry_bytes = self.get_entry_bytes(entry)
+            if entry_bytes > self.max_bytes:
+                return
+            self._match_tables[match_table_key] = entry
+            self.cache_bytes += entry_bytes
+            while self.cache_bytes > self.max_bytes:
+                _, evicted = self._match_tables.popitem(last=False)
+                self.cache_bytes -= self.get_entry_bytes(evicted)
+
+    def get_status(self):
+        with self._lock:
+            return {'match_tables': len(self._match_tables),
+                    'bytes': self.cache_bytes,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+
+class RenderJobError(ValueError):
+    "A render request that cannot be carried out as asked"
+
+
+"""
+A render job, after checking:
+
+    { 'siblings', 'extra_match', 'chromosomes', 'data_dir', 'format',
+      'compression_level', 'page_width', 'aggregate', 'axis',
+      'bp_per_pixel' }
+"""
+INTEGER_OPTIONS = ('compression_level', 'page_width', 'bp_per_pixel')
+POSITIVE_OPTIONS = ('page_width', 'bp_per_pixel')
+
+"""
+Request options that override a setting of the render config.
+"""
+RENDER_CONFIG_OPTIONS = {
+    'page_width': 'TARGET_PAGE_WIDTH',
+    'aggregate': 'COLUMN_AGGREGATE',
+    'axis': 'AXIS_MODE',
+    'bp_per_pixel': 'BP_PER_PIXEL',
+}
+
+
+def get_render_job(
+        options,
+        default_data_dir):
+    """
+    Check the options of a render request, from a JSON body or a query
+    string, and fill in the defaults.  Raises RenderJobError.
+    """
+    def get_list(name):
+        value = options.get(name) or []
+        if isinstance(value, (str, int)):
+            value = str(value).split(',')
+        return [str(item).strip() for item in value if str(item).strip()]
+
+    render_job = {
+        'siblings': get_list('siblings'),
+        'extra_match': str(options.get('extra_match') or ''),
+        'data_dir': str(options.get('data_dir') or default_data_dir),
+        'format': str(options.get('format') or 'png'),
+        'aggregate': options.get('aggregate'),
+        'axis': options.get('axis'),
+    }
+
+    if len(render_job['siblings']) + bool(render_job['extra_match']) < 2:
+        raise RenderJobError("need at least two matches to compare")
+
+    try:
+        render_job['chromosomes'] = pixel_view.parse_chromosome_list(
+                get_list('chromosomes') + get_list('chromosome'))
+    except argparse.ArgumentTypeError as e:
+        raise RenderJobError(str(e))
+    if not render_job['chromosomes']:
+        raise RenderJobError("no chromosome given")
+
+    for name in INTEGER_OPTIONS:
+        value = options.get(name)
+        try:
+            # int() would quietly round a JSON 1.5 down, and take true as 1
+            if isinstance(value, bool) or (
+                    isinstance(value, float) and not value.is_integer()):
+                raise ValueError(value)
+            render_job[name] = int(value) if value not in (None, '') else None
+        except (TypeError, ValueError):
+            raise RenderJobError("{0} must be a whole number".format(name))
+    for name in POSITIVE_OPTIONS:
+        if render_job[name] is not None and render_job[name] < 1:
+            raise RenderJobError("{0} must be at least 1".format(name))
+
+    output_format = pixel_view.OUTPUT_FORMATS.get(render_job['format'])
+    if output_format is None:
+        raise RenderJobError("format must be one of {0}".format(
+            ", ".join(sorted(pixel_view.OUTPUT_FORMATS))))
+    if render_job['compression_level'] is not None and not (
+            0 <= render_job['compression_level']
+            <= output_format['max_compression']):
+        raise RenderJobError("compression_level for {0} must be 0-{1}".format(
+            render_job['format'], output_format['max_compression']))
+    if render_job['aggregate'] not in (None,) + tuple(
+            pixel_view.COLUMN_AGGREGATES):
+        raise RenderJobError("aggregate must be one of {0}".format(
+            ", ".join(pixel_view.COLUMN_AGGREGATES)))
+    if render_job['axis'] not in (None,) + tuple(pixel_view.AXIS_MODES):
+        raise RenderJobError("axis must be one of {0}".format(
+            ", ".join(pixel_view.AXIS_MODES)))
+
+    render_job['config'] = pixel_view.get_render_config(**{
+        setting: render_job[name]
+        for name, setting in RENDER_CONFIG_OPTIONS.items()
+        if render_job[name] is not None})
+
+    return render_job
+
+
+class PixelViewService(object):
+    """
+    What the request handlers share: the kit and match table caches and
+    the tile sets.
+
+    Every page is drawn from its job's own render config, so requests
+    render concurrently.
+    """
+
+    def __init__(self, data_dir, kit_cache_bytes, tile_dir,
+                 match_table_cache_bytes=0):
+        self.data_dir = data_dir
+        self.kit_cache = KitCache(kit_cache_bytes)
+        self.match_table_cache = MatchTableCache(match_table_cache_bytes)
+        self.tile_dir = tile_dir
+        self.requests_served = 0
+        self._tile_sets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, render_job):
+        "Render a checked job; returns (content type, body bytes)"
+        match_pair_combinations, all_matches_list = \
+            pixel_view.get_match_pair_combinations(
+                list(render_job['siblings']),
+                render_job['extra_match'])
+
+        config = render_job['config']
+        kit_keys = self.kit_cache.get_kit_keys(
+                all_matches_list, render_job['data_dir'])
+        raw_data = []
+
+        def get_raw_data():
+            "The family's kits, loaded once the first MatchTable is missing"
+            if not raw_data:
+                raw_data.append(self.kit_cache.get_raw_data(
+                    all_matches_list, render_job['data_dir'], kit_keys))
+            return raw_data[0]
+
+        pages = []
+        for chromosome in render_job['chromosomes']:
+            match_table, match_class_pyramid = self.match_table_cache.get(
+                    (tuple(match_pair_combinations),
+                     tuple(kit_keys[known_relative]
+                           for known_relative in all_matches_list),
+                     chromosome,
+                     config.FILTER_COMPLETELY_MATCHED_SEGMENTS),
+                    lambda: pixel_view.get_chromosome_match_table(
+                        chromosome,
+                        match_pair_combinations,
+                        all_matches_list,
+                        get_raw_data(),
+                        config),
+                    config)
+            chrom_whole_page_image = pixel_view.show_match_graphics(
+                    match_table,
+                    match_pair_combinations,
+                    chromosome,
+                    config,
+                    match_class_pyramid)
+
+            page_file = io.BytesIO()
+            pixel_view.save_match_graphics(
+                    chrom_whole_page_image,
+                    page_file,
+                    render_job['format'],
+                    render_job['compression_level'])
+            pages.append((pixel_view.get_output_file_name(
+                all_matches_list, chromosome, render_job['format']),
+                page_file.getvalue()))
+
+        with self._lock:
+            self.requests_served += 1
+
+        if len(pages) == 1:
+            return ("image/{0}".format(render_job['format']), pages[0][1])
+
+        archive_file = io.BytesIO()
+        with zipfile.ZipFile(archive_file, 'w') as archive:
+            for page_file_name, page_bytes in pages:
+                archive.writestr(page_file_name, page_bytes)
+        return 'application/zip', archive_file.getvalue()
+
+    def get_tile_set(self, tile_set_name, name):
+        """
+        The DeepZoomTiles of one page, kept open for the next tile; only
+        the SERVER_OPEN_TILE_SETS most recently used stay open.
+        """
+        tile_set_key = (tile_set_name, name)
+        with self._lock:
+            deep_zoom_tiles = self._tile_sets.get(tile_set_key)
+            if deep_zoom_tiles is None:
+                deep_zoom_tiles = pixel_view.DeepZoomTiles(
+                        os.path.join(self.tile_dir, tile_set_name), name)
+                self._tile_sets[tile_set_key] = deep_zoom_tiles
+            self._tile_sets.move_to_end(tile_set_key)
+            while len(self._tile_sets) > pixel_config.SERVER_OPEN_TILE_SETS:
+                self._tile_sets.popitem(last=False)
+            return deep_zoom_tiles
+
+    def get_status(self):
+        with self._lock:
+            requests_served = self.requests_served
+        return {'kit_cache': self.kit_cache.get_status(),
+                'match_table_cache': self.match_table_cache.get_status(),
+                'requests_served': requests_served}
+
+
+# a tile set name may hold dots, but not start with one, so '.' and '..'
+# never lead out of the tile directory
+TILE_PATH = re.compile(
+        r'^/tiles/(?P<tile_set>\w[\w.-]*)/'
+        r'(?:(?P<manifest>manifest\.json)'
+        r'|(?P<dzi>[\w-]+)\.dzi'
+        r'|(?P<name>[\w-]+)_files/(?P<level>\d+)/(?P<col>\d+)_(?P<row>\d+)'
+        r'\.(?P<format>\w+))$')
+
+CONTENT_TYPES = {
+    '.json': 'application/json',
+    '.dzi': 'application/xml',
+    '.png': 'image/png',
+    '.webp': 'image/webp',
+}
+
+
+class PixelViewRequestHandler(BaseHTTPRequestHandler):
+    server_version = "PixelView/{0}".format(pixel_view.__version__)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def send_body(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, data):
+        self.send_body(status, 'application/json',
+                       json.dumps(data).encode('utf-8'))
+
+    def send_file(self, file_name):
+        with open(file_name, 'rb') as served_file:
+            self.send_body(200,
+                           CONTENT_TYPES.get(os.path.splitext(file_name)[1],
+                                             'application/octet-stream'),
+                           served_file.read())
+
+    def send_internal_error(self, e):
+        "Log what a handler did not expect and answer it with a JSON 500"
+        self.log_error("%s failed: %s", self.path, traceback.format_exc())
+        self.send_json(500, {'error': "internal error: {0}".format(e)})
+
+    def handle_render(self, options):
+        service = self.server.service
+        try:
+            content_type, body = service.render(
+                    get_render_job(options, service.data_dir))
+        except RenderJobError as e:
+            self.send_json(400, {'error': str(e)})
+        except pixel_view.KitNotFoundError as e:
+            self.send_json(404, {'error': str(e)})
+        except Exception as e:
+            self.send_internal_error(e)
+        else:
+            self.send_body(200, content_type, body)
+
+    def handle_tiles(self, path):
+        tile_path = TILE_PATH.match(path)
+        if tile_path is None:
+            self.send_json(404, {'error': "no such tile"})
+            return
+
+        tile_set_dir = os.path.join(self.server.service.tile_dir,
+                                    tile_path.group('tile_set'))
+        try:
+            if tile_path.group('manifest'):
+                self.send_file(os.path.join(
+                    tile_set_dir, pixel_view.TILE_MANIFEST))
+            elif tile_path.group('dzi'):
+                self.send_file(os.path.join(
+                    tile_set_dir, "{0}.dzi".format(tile_path.group('dzi'))))
+            else:
+                deep_zoom_tiles = self.server.service.get_tile_set(
+                        tile_path.group('tile_set'), tile_path.group('name'))
+                if tile_path.group('format') != deep_zoom_tiles.tile_format:
+                    raise ValueError("tiles are {0}".format(
+                        deep_zoom_tiles.tile_format))
+                self.send_file(deep_zoom_tiles.get_tile(
+                    int(tile_path.group('level')),
+                    int(tile_path.group('col')),
+                    int(tile_path.group('row'))))
+        except (OSError, ValueError) as e:
+            self.send_json(404, {'error': str(e)})
+        except Exception as e:
+            self.send_internal_error(e)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/render':
+            self.handle_render({name: values[-1] for name, values
+                                in parse_qs(url.query).items()})
+        elif url.path.startswith('/tiles/'):
+            self.handle_tiles(url.path)
+        elif url.path == '/status':
+            self.send_json(200, self.server.service.get_status())
+        else:
+            self.send_json(404, {'error': "unknown path {0}".format(url.path)})
+
+    def do_POST(self):
+        if urlsplit(self.path).path != '/render':
+            self.send_json(404, {'error': "unknown path"})
+            return
+        try:
+            options = json.loads(self.rfile.read(
+                int(self.headers.get('Content-Length') or 0)) or b'{}')
+            if not isinstance(options, dict):
+                raise ValueError("expected a JSON object")
+        except ValueError as e:
+            self.send_json(400, {'error': "bad request body: {0}".format(e)})
+            return
+        self.handle_render(options)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(
+        service,
+        host=None,
+        port=None,
+        unix_socket=None):
+    """
+    An HTTP server for service, on a Unix socket when unix_socket is given
+    and on host:port otherwise.  Each request runs on its own thread.
+    """
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, PixelViewRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), PixelViewRequestHandler)
+    server.service = service
+    return server
+
+
+def get_argument_parser():
+    parser = argparse.ArgumentParser(
+            description="Serve pixel views of sibling raw DNA matches over "
+                        "HTTP, keeping parsed kits in memory between "
+                        "requests.")
+    parser.add_argument(
+            '--host', default=pixel_config.SERVER_HOST,
+            help="address to listen on (default: %(default)s)")
+    parser.add_argument(
+            '--port', type=int, default=pixel_config.SERVER_PORT,
+            help="port to listen on (default: %(default)s)")
+    parser.add_argument(
+            '--unix-socket',
+            help="listen on this Unix socket instead of host:port")
+    parser.add_argument(
+            '--data-dir', default=pixel_view.DATA_FILE_DIRECTORY,
+            help="default directory holding the raw DNA files "
+                 "(default: %(default)s)")
+    parser.add_argument(
+            '--kit-cache-bytes', type=int,
+            default=pixel_config.SERVER_KIT_CACHE_BYTES,
+            help="memory for parsed kits (default: %(default)s)")
+    parser.add_argument(
+            '--match-table-cache-bytes', type=int,
+            default=pixel_config.SERVER_MATCH_TABLE_CACHE_BYTES,
+            help="memory for compared chromosomes and their count "
+                 "pyramids (default: %(default)s)")
+    parser.add_argument(
+            '--tile-dir', default='.',
+            help="directory holding tile sets published with --tiles "
+                 "(default: %(default)s)")
+    return parser
+
+
+def main(argv=None):
+    args = get_argument_parser().parse_args(argv)
+
+    pixel_view.VERBOSITY = 0
+    server = create_server(
+            PixelViewService(args.data_dir, args.kit_cache_bytes,
+                             args.tile_dir, args.match_table_cache_bytes),
+            args.host,
+            args.port,
+            args.unix_socket)
+
+    print("serving on {0}".format(
+        args.unix_socket or "http://{0}:{1}".format(*server.server_address)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.unix_socket and os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+
+
+if __name__ == '__main__':
+    main()
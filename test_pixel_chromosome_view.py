@@ -0,0 +1,613 @@
+"""
+    Tests for pixel_chromosome_view
+
+    python3 -m pytest -q
+
+    license: GPLv3
+"""
+
+import os
+import gzip
+import zipfile
+import multiprocessing
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import pixel_benchmark
+import pixel_chromosome_view as pixel_view
+import pixel_server
+
+
+# three small 23andMe kits of chromosome 21, each missing a few SNPs, and
+# the page the original per-SNP code rendered from them
+TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'test_data')
+TEST_DATA_SIBLINGS = ['ALICE', 'BRUNO', 'CLARA']
+
+
+def read_reference_kit(name, chromosome=21):
+    "{ position : (allele 1, allele 2) }, read as the original code did"
+    reference_kit = {}
+    with open(os.path.join(TEST_DATA_DIR,
+                           '23andMe_{0}_raw.txt'.format(name))) as raw_file:
+        for line in raw_file:
+            if line.startswith('#'):
+                continue
+            raw_row = line.rstrip('\n').split('\t')
+            if raw_row[1] == str(chromosome):
+                reference_kit[int(raw_row[2])] = (raw_row[3][0],
+                                                  raw_row[3][1])
+    return reference_kit
+
+
+def get_reference_match_class(mpA, mpB):
+    "The match class of a pair at one SNP, compared as the original code did"
+    mpA_1, mpA_2 = mpA
+    mpB_1, mpB_2 = mpB
+    if (mpA_1 == mpB_1 and mpA_2 == mpB_2) or (
+            mpA_1 == mpB_2 and mpA_2 == mpB_1):
+        return pixel_view.FULL_MATCH_SNP
+    elif (mpA_1 == mpB_1 or mpA_2 == mpB_2) or (
+            mpA_1 == mpB_2 or mpA_2 == mpB_1):
+        return pixel_view.HALF_MATCH_SNP
+    return pixel_view.NO_MATCH_SNP
+
+
+def test_match_classes_equal_the_per_SNP_reference(monkeypatch):
+    monkeypatch.setattr(pixel_view, 'RAW_FILE_CACHE_DIRECTORY', '')
+    reference_kits = {name: read_reference_kit(name)
+                      for name in TEST_DATA_SIBLINGS}
+    match_pair_combinations, all_matches_list = \
+        pixel_view.get_match_pair_combinations(TEST_DATA_SIBLINGS, '')
+
+    # only SNPs where some sibling has another allele are kept
+    common_positions = set.intersection(
+            *(set(reference_kit) for reference_kit in reference_kits.values()))
+    reference_positions = [
+        position for position in sorted(common_positions)
+        if len(set(allele for reference_kit in reference_kits.values()
+                   for allele in reference_kit[position])) > 1]
+    reference_match_classes = [
+        [get_reference_match_class(reference_kits[name_A][position],
+                                   reference_kits[name_B][position])
+         for position in reference_positions]
+        for name_A, name_B in match_pair_combinations]
+
+    match_table = pixel_view.get_chromosome_match_table(
+            21, match_pair_combinations, all_matches_list,
+            pixel_view.load_raw_data_for_all_matches(
+                all_matches_list, TEST_DATA_DIR),
+            pixel_view.get_render_config())
+
+    assert match_table.positions.tolist() == reference_positions
+    assert match_table.match_classes.tolist() == reference_match_classes
+
+
+def test_common_genotypes_equal_the_set_intersection(monkeypatch):
+    monkeypatch.setattr(pixel_view, 'RAW_FILE_CACHE_DIRECTORY', '')
+    reference_kits = {name: read_reference_kit(name)
+                      for name in TEST_DATA_SIBLINGS}
+    reference_positions = sorted(set.intersection(
+            *(set(reference_kits[name]) for name in TEST_DATA_SIBLINGS)))
+
+    match_genotypes = pixel_view.get_match_pixel_dicts_for_siblings_to_render(
+            21, TEST_DATA_SIBLINGS, pixel_view.load_raw_data_for_all_matches(
+                TEST_DATA_SIBLINGS, TEST_DATA_DIR))
+    common_genotypes = pixel_view.get_common_key_SNP_dict(
+            pixel_view.get_common_keys(match_genotypes), match_genotypes)
+
+    assert common_genotypes.positions.tolist() == reference_positions
+    assert common_genotypes.names == tuple(TEST_DATA_SIBLINGS)
+    for name, match_alleles in zip(common_genotypes.names,
+                                   common_genotypes.alleles):
+        assert [(chr(allele_1), chr(allele_2))
+                for allele_1, allele_2 in match_alleles.tolist()] == \
+            [reference_kits[name][position]
+             for position in reference_positions]
+
+
+def test_page_is_pixel_identical_to_the_original_rendering(monkeypatch):
+    monkeypatch.setattr(pixel_view, 'RAW_FILE_CACHE_DIRECTORY', '')
+    match_pair_combinations, all_matches_list = \
+        pixel_view.get_match_pair_combinations(TEST_DATA_SIBLINGS, '')
+
+    page = pixel_view.render_chromosome(
+            21, match_pair_combinations, all_matches_list,
+            pixel_view.load_raw_data_for_all_matches(
+                all_matches_list, TEST_DATA_DIR),
+            pixel_view.get_render_config())
+
+    known_good_page = Image.open(os.path.join(
+        TEST_DATA_DIR, 'ALICE_BRUNO_CLARA_chr21.png')).convert('RGB')
+    assert page.size == known_good_page.size
+    assert np.array_equal(np.asarray(page), np.asarray(known_good_page))
+
+
+# (chromosome, position, genotype), out of order, with an X row and a
+# no-call; every vendor fixture below holds these rows
+VENDOR_FIXTURE_ROWS = [
+    ('1', '752566', 'CC'), ('1', '82154', 'AG'), ('X', '5000', 'AA'),
+    ('2', '1000', 'TT'), ('1', '800000', '--')]
+
+
+def get_tsv_fixture(header, split_alleles=False):
+    return header + ''.join(
+        "rs{0}\t{1}\t{2}\t{3}\n".format(
+            row_number, chromosome, position,
+            '\t'.join(genotype) if split_alleles else genotype)
+        for row_number, (chromosome, position, genotype)
+        in enumerate(VENDOR_FIXTURE_ROWS))
+
+
+def get_csv_fixture(header):
+    return header + ''.join(
+        '"rs{0}","{1}","{2}","{3}"\n'.format(row_number, *row)
+        for row_number, row in enumerate(VENDOR_FIXTURE_ROWS))
+
+
+VENDOR_FIXTURES = [
+    ('23andMe', '23andMe_JULIE_raw.txt', get_tsv_fixture(
+        "# This data file generated by 23andMe at: Mon Jan 04 2021\n"
+        "# rsid\tchromosome\tposition\tgenotype\n")),
+    ('AncestryDNA', 'AncestryDNA_JULIE_raw.txt', get_tsv_fixture(
+        "#AncestryDNA raw data download\n"
+        "rsid\tchromosome\tposition\tallele1\tallele2\n",
+        split_alleles=True)),
+    ('MyHeritage', 'MyHeritage_JULIE_raw.csv', get_csv_fixture(
+        "# MyHeritage DNA raw data.\n"
+        "RSID,CHROMOSOME,POSITION,RESULT\n")),
+    ('FTDNA', 'FTDNA_JULIE_raw.csv.gz', get_csv_fixture(
+        "RSID,CHROMOSOME,POSITION,RESULT\n")),
+    ('LivingDNA', 'LivingDNA_JULIE_raw.zip', get_tsv_fixture(
+        "# Living DNA customer genotype data download file version: 1.0.1\n"
+        "# rsid\tchromosome\tposition\tgenotype\n")),
+]
+
+
+def write_raw_fixture(raw_file_name, text):
+    if raw_file_name.endswith('.gz'):
+        with gzip.open(raw_file_name, 'wt') as raw_file:
+            raw_file.write(text)
+    elif raw_file_name.endswith('.zip'):
+        with zipfile.ZipFile(raw_file_name, 'w') as archive:
+            archive.writestr('JULIE_raw.txt', text)
+    else:
+        with open(raw_file_name, 'w') as raw_file:
+            raw_file.write(text)
+
+
+@pytest.mark.parametrize('vendor, file_name, text', VENDOR_FIXTURES,
+                         ids=[fixture[0] for fixture in VENDOR_FIXTURES])
+def test_vendor_files_are_detected_and_parsed(tmp_path, vendor, file_name,
+                                              text):
+    raw_file_name = str(tmp_path / file_name)
+    write_raw_fixture(raw_file_name, text)
+
+    assert pixel_view.detect_raw_file_vendor(raw_file_name) == vendor
+
+    genotypes_by_chromosome = pixel_view.load_raw_file_by_chromosome(
+            raw_file_name)
+    assert sorted(genotypes_by_chromosome) == list(pixel_view.AUTOSOMES)
+    assert genotypes_by_chromosome[1].positions.tolist() == \
+        [82154, 752566, 800000]
+    assert genotypes_by_chromosome[1].alleles.tobytes() == b'AGCC--'
+    assert genotypes_by_chromosome[2].positions.tolist() == [1000]
+    assert genotypes_by_chromosome[2].alleles.tobytes() == b'TT'
+    assert all(len(genotypes_by_chromosome[chromosome].positions) == 0
+               for chromosome in pixel_view.AUTOSOMES[2:])
+
+
+def test_files_that_are_not_DNA_data_are_rejected(tmp_path):
+    raw_file_name = str(tmp_path / 'JULIE_raw_notes.txt')
+    write_raw_fixture(raw_file_name,
+                      "Notes on the family tree\nJulie, born 1950\n")
+
+    with pytest.raises(ValueError):
+        pixel_view.detect_raw_file_vendor(raw_file_name)
+    with pytest.raises(ValueError):
+        pixel_view.load_raw_file_by_chromosome(raw_file_name)
+
+
+def get_simulated_pair_regions(
+        seed,
+        chromosome,
+        SNPs_per_chromosome=20000):
+    """
+    Found and true regions of the first two siblings of a simulated
+    family, over the SNPs the noise filter keeps.  Both kits get the
+    benchmark's no-call rate.
+    """
+    rng = np.random.default_rng(seed)
+    positions, genotypes, inherited = pixel_benchmark.generate_chromosome(
+            rng, chromosome, SNPs_per_chromosome, 2)
+    name_A, name_B = pixel_benchmark.SIBLING_NAMES[:2]
+
+    alleles = np.stack((genotypes[name_A], genotypes[name_B]))
+    alleles[rng.random(alleles.shape[:2])
+            < pixel_benchmark.KIT_NO_CALL_RATE] = ord('-')
+    match_classes, kept = pixel_view.classify_match_pairs(
+            alleles, [(0, 1)], [0, 1])
+
+    found_regions = pixel_view.get_pair_regions(
+            match_classes[0][kept], positions[kept],
+            pixel_view.get_render_config())
+    true_regions = pixel_benchmark.get_true_pair_regions(
+            inherited, name_A, name_B)[kept]
+    return found_regions, true_regions
+
+
+def test_pair_regions_follow_inheritance():
+    found_regions = []
+    true_regions = []
+    for seed in range(3):
+        for chromosome in range(1, 9):
+            found, true = get_simulated_pair_regions(seed, chromosome)
+            found_regions.append(found)
+            true_regions.append(true)
+    found_regions = np.concatenate(found_regions)
+    true_regions = np.concatenate(true_regions)
+
+    assert np.mean(found_regions == true_regions) > 0.95
+    for region in pixel_view.SEGMENT_NAMES:
+        assert abs(np.mean(found_regions == region)
+                   - np.mean(true_regions == region)) < 0.03
+
+
+def test_scattered_no_matches_are_not_bridged():
+    # a non identical region: a noMatch SNP every 9 SNPs, between two
+    # half identical regions with a little noise
+    half_identical = np.full(300, pixel_view.HALF_MATCH_SNP, dtype=np.uint8)
+    half_identical[[50, 51, 220]] = pixel_view.NO_MATCH_SNP
+    non_identical = np.full(300, pixel_view.HALF_MATCH_SNP, dtype=np.uint8)
+    non_identical[::9] = pixel_view.NO_MATCH_SNP
+    pair_match_classes = np.concatenate(
+            (half_identical, non_identical, half_identical))
+    positions = np.arange(len(pair_match_classes), dtype=np.int32) * 20000
+
+    pair_regions = pixel_view.get_pair_regions(
+            pair_match_classes, positions, pixel_view.get_render_config())
+
+    assert (pair_regions[:300] == pixel_view.HIR_SEGMENT).all()
+    assert (pair_regions[340:560] == pixel_view.NIR_SEGMENT).all()
+    assert (pair_regions[640:] == pixel_view.HIR_SEGMENT).all()
+
+
+def test_kit_overwritten_in_place_is_parsed_again(tmp_path, monkeypatch):
+    monkeypatch.setattr(pixel_view, 'RAW_FILE_CACHE_DIRECTORY',
+                        str(tmp_path / 'cache'))
+    monkeypatch.setattr(pixel_view, '_kit_indexes', {})
+    data_file_dir = tmp_path / 'raw_dna'
+    data_file_dir.mkdir()
+    rows = [(1, position, 'AG') for position in range(1000, 3000, 10)]
+
+    def write_kit(kit_rows):
+        pixel_benchmark.write_kit(str(data_file_dir), 'JULIE',
+                                  pixel_benchmark.KIT_FORMATS[0], kit_rows)
+
+    def load_SNP_count():
+        raw_data = pixel_view.load_raw_data_for_all_matches(
+                ['JULIE'], str(data_file_dir))
+        return len(raw_data['JULIE'][1].positions)
+
+    write_kit(rows)
+    assert load_SNP_count() == 200
+
+    dir_stat = data_file_dir.stat()
+    write_kit(rows[:50])
+    os.utime(data_file_dir, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+    assert load_SNP_count() == 50
+
+    # a fresh process, reading the kit index from disk
+    monkeypatch.setattr(pixel_view, '_kit_indexes', {})
+    assert load_SNP_count() == 50
+
+
+def test_tiles_are_drawn_from_the_page_columns(tmp_path, monkeypatch):
+    monkeypatch.setattr(pixel_view, 'RAW_FILE_CACHE_DIRECTORY', '')
+    family_dir = str(tmp_path / 'family')
+    pixel_benchmark.generate_family(family_dir, 2, 3000, [21])
+    match_pair_combinations, all_matches_list = \
+        pixel_view.get_match_pair_combinations(
+            pixel_benchmark.SIBLING_NAMES[:2],
+            pixel_benchmark.EXTRA_MATCH_NAME)
+    config = pixel_view.get_render_config()
+    match_table = pixel_view.get_chromosome_match_table(
+            21, match_pair_combinations, all_matches_list,
+            pixel_view.load_raw_data_for_all_matches(
+                all_matches_list, family_dir),
+            config)
+
+    pixel_view.save_deep_zoom_source(
+            match_table, 21, str(tmp_path), 'chr21', config)
+    deep_zoom_tiles = pixel_view.DeepZoomTiles(str(tmp_path), 'chr21')
+    page = np.asarray(pixel_view.show_match_graphics(
+            match_table, match_pair_combinations, 21, config))
+    assert page.shape[:2] == (deep_zoom_tiles.height, deep_zoom_tiles.width)
+
+    level = deep_zoom_tiles.max_level
+    columns, rows = deep_zoom_tiles.get_tile_count(level)
+    for col in range(columns):
+        for row in range(rows):
+            tile = np.asarray(Image.open(
+                deep_zoom_tiles.get_tile(level, col, row)).convert('RGB'))
+            top, left = row * deep_zoom_tiles.tile_size, \
+                col * deep_zoom_tiles.tile_size
+            page_part = page[top:top + tile.shape[0],
+                             left:left + tile.shape[1]]
+            # only where a tick mark overlaps the SNP lines may they differ
+            assert (tile != page_part).any(axis=2).mean() < 0.01
+
+    for level in range(deep_zoom_tiles.max_level):
+        assert Image.open(deep_zoom_tiles.get_tile(level, 0, 0)).size == tuple(
+            min(size, deep_zoom_tiles.tile_size)
+            for size in deep_zoom_tiles.get_level_size(level))
+
+
+def test_render_job_needs_positive_widths():
+    for option in ('page_width', 'bp_per_pixel'):
+        for value in ('0', '-5'):
+            with pytest.raises(pixel_server.RenderJobError):
+                pixel_server.get_render_job(
+                    {'siblings': 'JULIE,ALLISON', 'chromosome': '7',
+                     option: value}, 'raw_dna')
+
+
+def test_empty_strip_is_not_stored_on_disk(tmp_path, monkeypatch):
+    monkeypatch.setattr(pixel_view, 'RAW_FILE_CACHE_DIRECTORY', str(tmp_path))
+    monkeypatch.setattr(pixel_view, 'STRIP_CACHE_MAX_BYTES', 1024 ** 2)
+    config = pixel_view.get_render_config()
+
+    strip_image = pixel_view.get_comparison_strip(
+            np.zeros(0, dtype=np.uint8), config)
+
+    assert strip_image.width == 0
+    assert not os.path.isdir(pixel_view.get_strip_cache_dir())
+
+
+def test_raw_file_cache_is_shared_between_processes(tmp_path, monkeypatch):
+    monkeypatch.setattr(pixel_view, 'RAW_FILE_CACHE_DIRECTORY',
+                        str(tmp_path / 'cache'))
+    data_file_dir = str(tmp_path / 'raw_dna')
+    os.makedirs(data_file_dir)
+    kit_rows = [(1, position, 'AG') for position in range(1000, 3000, 10)]
+    raw_file_names = [
+        pixel_benchmark.write_kit(data_file_dir, name,
+                                  pixel_benchmark.KIT_FORMATS[0], kit_rows[i:])
+        for i, name in enumerate(pixel_benchmark.SIBLING_NAMES)]
+    cache_dir = pixel_view.get_raw_file_cache_dir()
+    os.makedirs(cache_dir)
+
+    # another process has stored an entry but not indexed it yet
+    other_entry_dir = pixel_view.get_raw_file_cache_entry_dir(
+            cache_dir, 'f' * 64)
+    os.makedirs(other_entry_dir)
+
+    with multiprocessing.get_context('fork').Pool(len(raw_file_names)) as pool:
+        pool.map(pixel_view.load_raw_file_with_cache, raw_file_names)
+
+    assert os.path.isdir(other_entry_dir)
+    raw_file_cache_index = pixel_view.read_raw_file_cache_index(cache_dir)
+    assert sorted(raw_file_cache_index) == sorted(
+        os.path.abspath(raw_file_name) for raw_file_name in raw_file_names)
+
+
+def test_headless_run_prints_only_output_files(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(pixel_view, 'RAW_FILE_CACHE_DIRECTORY', '')
+    monkeypatch.setattr(pixel_view, 'VERBOSITY', 2)
+    family_dir = str(tmp_path / 'family')
+    pixel_benchmark.generate_family(family_dir, 2, 1000, [21])
+    output_dir = str(tmp_path / 'out')
+
+    pixel_view.main(['--data-dir', family_dir,
+                     '--siblings'] + pixel_benchmark.SIBLING_NAMES[:2] +
+                    ['--chromosomes', '21', '--output-dir', output_dir])
+
+    output_files = capsys.readouterr().out.split()
+    assert output_files
+    assert all(os.path.isfile(output_file) for output_file in output_files)
+
+
+def test_color_lookup_table_is_shared_by_configs_with_the_same_colors():
+    assert pixel_view.get_SNP_color_lookup_table(
+        pixel_view.get_render_config(TARGET_PAGE_WIDTH=1000)) is \
+        pixel_view.get_SNP_color_lookup_table(
+            pixel_view.get_render_config(TARGET_PAGE_WIDTH=2000))
+
+
+def test_incremental_session_matches_batch_render(tmp_path, monkeypatch):
+    monkeypatch.setattr(pixel_view, 'RAW_FILE_CACHE_DIRECTORY', '')
+    family_dir = str(tmp_path / 'family')
+    pixel_benchmark.generate_family(family_dir, 3, 2000, [21])
+    siblings = pixel_benchmark.SIBLING_NAMES[:3]
+    extra_match = pixel_benchmark.EXTRA_MATCH_NAME
+    config = pixel_view.get_render_config()
+
+    def assert_same_page(session):
+        match_pair_combinations, all_matches_list = \
+            pixel_view.get_match_pair_combinations(
+                session.siblings_to_render, session.extra_match)
+        batch_page = pixel_view.render_chromosome(
+                21, match_pair_combinations, all_matches_list,
+                pixel_view.load_raw_data_for_all_matches(
+                    all_matches_list, family_dir),
+                config)
+        assert np.array_equal(np.asarray(session.render(21)),
+                              np.asarray(batch_page))
+
+    session = pixel_view.IncrementalRenderSession(
+            siblings[:1], data_dir_name=family_dir, config=config)
+    assert_same_page(session)
+    for sibling in siblings[1:]:
+        session.add_sibling(sibling)
+        assert_same_page(session)
+    session.set_extra_match(extra_match)
+    assert_same_page(session)
+
+
+def test_raw_file_cache_survives_eviction(tmp_path, monkeypatch):
+    monkeypatch.setattr(pixel_view, 'RAW_FILE_CACHE_DIRECTORY',
+                        str(tmp_path / 'cache'))
+    monkeypatch.setattr(pixel_view, 'RAW_FILE_CACHE_MAX_BYTES', 1000)
+    data_file_dir = str(tmp_path / 'raw_dna')
+    os.makedirs(data_file_dir)
+    kit_rows = [(1, position, 'AG') for position in range(1000, 3000, 10)]
+    raw_file_name = pixel_benchmark.write_kit(
+            data_file_dir, 'JULIE', pixel_benchmark.KIT_FORMATS[0], kit_rows)
+
+    # the kit alone is larger than the cache may be
+    genotypes_by_chromosome = pixel_view.load_raw_file_with_cache(
+            raw_file_name)
+    assert len(genotypes_by_chromosome[1].positions) == 200
+
+    # another process evicts the entry while this one reads it
+    cache_dir = pixel_view.get_raw_file_cache_dir()
+    record = pixel_view.read_raw_file_cache_index(cache_dir)[
+        os.path.abspath(raw_file_name)]
+    os.remove(os.path.join(pixel_view.get_raw_file_cache_entry_dir(
+        cache_dir, record['sha256']), 'positions.npy'))
+    genotypes_by_chromosome = pixel_view.load_raw_file_with_cache(
+            raw_file_name)
+    assert len(genotypes_by_chromosome[1].positions) == 200
+
+
+def test_pairs_of_similar_names_keep_their_own_segments():
+    names = ('MARY', 'MARIA', 'JOHN', 'JOHNNY')
+    assert pixel_view.get_name_abbreviations(names) == {
+        'MARY': 'MARY', 'MARIA': 'MARI', 'JOHN': 'JOHN', 'JOHNNY': 'JOHNN'}
+
+    rng = np.random.default_rng(0)
+    alleles = rng.choice(np.frombuffer(b'ACGT', dtype=np.uint8),
+                         size=(len(names), 500, 2))
+    match_pair_combinations = pixel_view.get_match_pair_combinations(
+            list(names), '')[0]
+    match_table = pixel_view.insert_combo_match_type_into_common_key_SNP_dict(
+            pixel_view.CommonGenotypes(
+                np.arange(500, dtype=np.int32) * 1000, names, alleles),
+            match_pair_combinations)
+
+    assert len(set(match_table.pair_labels)) == len(match_pair_combinations)
+    assert len(pixel_view.find_match_segments(match_table)) == \
+        len(match_pair_combinations)
+
+
+def get_export_match_table():
+    "A small MatchTable of two pairs whose names share three letters"
+    names = ('MARY', 'MARIA', 'JOHN')
+    rng = np.random.default_rng(1)
+    alleles = rng.choice(np.frombuffer(b'ACGT', dtype=np.uint8),
+                         size=(len(names), 300, 2))
+    match_pair_combinations = pixel_view.get_match_pair_combinations(
+            ['MARY', 'MARIA'], 'JOHN')[0]
+    match_table = pixel_view.insert_combo_match_type_into_common_key_SNP_dict(
+            pixel_view.CommonGenotypes(
+                np.arange(300, dtype=np.int32) * 1000, names, alleles),
+            match_pair_combinations)
+    return match_table, pixel_view.find_match_segments(match_table)
+
+
+@pytest.mark.parametrize('export_format', ['npz', 'npy'])
+def test_numpy_export_round_trip(tmp_path, export_format):
+    match_table, match_segments = get_export_match_table()
+    output_files = pixel_view.export_match_table(
+            match_table, match_segments, str(tmp_path), 21, export_format)
+
+    export_path = output_files[0] if export_format == 'npz' \
+        else os.path.dirname(output_files[0])
+    loaded_match_table, loaded_match_segments = \
+        pixel_view.load_exported_match_table(export_path)
+
+    for field, loaded_field in zip(match_table, loaded_match_table):
+        assert np.array_equal(np.asarray(field), np.asarray(loaded_field))
+    assert loaded_match_segments == match_segments
+
+
+@pytest.mark.parametrize('export_format', ['parquet', 'arrow'])
+def test_arrow_export_round_trip(tmp_path, export_format):
+    pyarrow = pytest.importorskip('pyarrow')
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    match_table, match_segments = get_export_match_table()
+    SNP_file, segments_file = pixel_view.export_match_table(
+            match_table, match_segments, str(tmp_path), 21, export_format)
+
+    def read_table(file_name):
+        if export_format == 'parquet':
+            return pyarrow.parquet.read_table(file_name)
+        return pyarrow.ipc.open_file(pyarrow.memory_map(file_name)).read_all()
+
+    SNP_table = read_table(SNP_file)
+    assert SNP_table.num_columns == 1 + len(match_table.names) + \
+        len(match_table.pair_labels)
+    assert np.array_equal(SNP_table['position'].to_numpy(),
+                          match_table.positions)
+    for name, match_alleles in zip(match_table.names, match_table.alleles):
+        assert SNP_table[name].to_pylist() == [
+            bytes(alleles).decode() for alleles in match_alleles]
+    for pair_column_name, pair_match_classes in zip(
+            ('MARY_MARIA_Match', 'MARY_JOHN_Match', 'MARIA_JOHN_Match'),
+            match_table.match_classes):
+        assert np.array_equal(SNP_table[pair_column_name].to_numpy(),
+                              pair_match_classes)
+
+    segments_table = read_table(segments_file)
+    assert [pixel_view.MatchSegment(*segment) for segment in zip(
+        *(segments_table[field].to_pylist()
+          for field in pixel_view.MatchSegment._fields))] == [
+        segment for pair_segments in match_segments.values()
+        for segment in pair_segments]
+
+
+def test_render_job_needs_whole_numbers():
+    for option in ('page_width', 'bp_per_pixel', 'compression_level'):
+        for value in (1.5, '1.5', True, 'wide'):
+            with pytest.raises(pixel_server.RenderJobError):
+                pixel_server.get_render_job(
+                    {'siblings': 'JULIE,ALLISON', 'chromosome': '7',
+                     option: value}, 'raw_dna')
+    assert pixel_server.get_render_job(
+        {'siblings': 'JULIE,ALLISON', 'chromosome': '7',
+         'page_width': 2000.0}, 'raw_dna')['page_width'] == 2000
+
+
+def test_tile_paths_stay_in_the_tile_directory():
+    assert pixel_server.TILE_PATH.match(
+        '/tiles/JULIE_ALLISON_tiles/chr7_files/9/0_0.png')
+    for path in ('/tiles/../manifest.json', '/tiles/./manifest.json',
+                 '/tiles/../chr7.dzi', '/tiles/.hidden/manifest.json',
+                 '/tiles/../chr7_files/9/0_0.png'):
+        assert pixel_server.TILE_PATH.match(path) is None
+
+
+def test_parallel_render_equals_serial_render(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(pixel_view, 'RAW_FILE_CACHE_DIRECTORY', '')
+    family_dir = str(tmp_path / 'family')
+    pixel_benchmark.generate_family(family_dir, 3, 1500, [19, 20, 21])
+    arguments = ['--data-dir', family_dir,
+                 '--siblings'] + pixel_benchmark.SIBLING_NAMES[:3] + \
+                ['--extra-match', pixel_benchmark.EXTRA_MATCH_NAME,
+                 '--chromosomes', '19,20,21', '--segments']
+
+    output_files = {}
+    for jobs in ('1', '2'):
+        output_dir = str(tmp_path / 'jobs_{0}'.format(jobs))
+        pixel_view.main(arguments + ['--output-dir', output_dir,
+                                     '--jobs', jobs])
+        output_files[jobs] = [
+            os.path.relpath(output_file, output_dir)
+            for output_file in capsys.readouterr().out.split()]
+
+    assert output_files['1'] == output_files['2']
+    assert len(output_files['1']) == 6
+    for output_file in output_files['1']:
+        serial_file, parallel_file = (
+            os.path.join(str(tmp_path / 'jobs_{0}'.format(jobs)), output_file)
+            for jobs in ('1', '2'))
+        if output_file.endswith('.png'):
+            assert np.array_equal(np.asarray(Image.open(serial_file)),
+                                  np.asarray(Image.open(parallel_file)))
+        else:
+            with open(serial_file) as serial, open(parallel_file) as parallel:
+                assert serial.read() == parallel.read()